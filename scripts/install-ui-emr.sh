@@ -120,6 +120,10 @@ scrape_configs:
       target_label: instance_type
     - source_labels: [__meta_ec2_tag_aws_elasticmapreduce_instance_group_role]
       target_label: role
+  - job_name: 'xonai_apiserver'
+    metrics_path: /internal/metrics
+    static_configs:
+    - targets: ['localhost:8000']
 EOF
     sudo sed "s/REGION/${EC2_REGION}/g" /tmp/scrape_config.yaml | sudo tee /etc/victoria/conf/scrape_config.yaml
     sudo chown victoria:victoria /etc/victoria/conf/scrape_config.yaml
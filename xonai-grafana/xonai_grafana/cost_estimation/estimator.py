@@ -12,31 +12,49 @@
 
 """Module containing cost estimation functionality."""
 import datetime
-import json
 import gzip
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
 from enum import Enum
+from functools import partial
 from os import path
-from typing import Tuple, Dict, List, Iterator, Self
+from typing import Tuple, Dict, List, Iterator, Self, Optional, Callable, TypeVar, Generic, Iterable, Set, Union
+import numpy as np
 from botocore.client import BaseClient
+from botocore.exceptions import ClientError
 from retrying import retry
-from xonai_grafana.schemata.cloud_objects import InstanceResGroup, Ec2Instance
+from xonai_grafana.cost_estimation.fetch_cost_info import stream_ec2_index, stream_emr_index, get_index_file, read_index
+from xonai_grafana.cost_estimation.spot_store import SpotPriceStore, Interval
+from xonai_grafana.schemata.cloud_objects import InstanceResGroup, Ec2Instance, DescribedEmrCluster
+from xonai_grafana.utils.caching import LruCache, SingleFlight, PersistentCache, estimate_size
+from xonai_grafana.utils.cluster_store import ClusterMetadataStore
 from xonai_grafana.utils.logging import LoggerUtils
+from xonai_grafana.utils.rate_limiting import is_throttling_error
 
 logger = LoggerUtils.create_logger('estimator')
 resource_path = path.join(path.dirname(path.abspath(__file__)), 'resources')
+epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
 
 """Type aliases."""
 InstanceInfo = Dict[str, Dict[str, str]]
 SpotPriceHistory = Dict[datetime, float]
 CostMap = Dict[str, float]
-CostCache = Dict[str, CostMap]
+CostCache = PersistentCache[CostMap]
+Pricing = TypeVar('Pricing')
+Hours = Union[float, np.ndarray]  # scalars for single instances, arrays for vectorized estimations
+InstanceCosts = Dict[str, Tuple[float, float, float]]  # EC2, EMR, and EBS costs of ended instances per instance ID
 
 
 def is_error_retrieable(exception) -> bool:
-    """Used for :func:`get_cluster_cost`, called when AWS API issues like throttling occur."""
+    """Used for :func:`get_cluster_cost`, called when AWS API issues like throttling (4xx status) or server errors (5xx status) occur."""
     try:
-        return exception.response['Error']['Code'].startswith("5")
-    except AttributeError:
+        error_code = exception.response['Error']['Code']
+        status_code = exception.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return is_throttling_error(error_code) or status_code >= 500 or error_code.startswith("5")
+    except (AttributeError, KeyError, TypeError):
         return False
 
 
@@ -100,49 +118,142 @@ class EstimationUtils:
         """Calculate costs based on hourly prices."""
         return float(seconds_passed) * hourly_price / 3600.0
 
+    @classmethod
+    def get_epoch_micros(cls, timestamp: datetime) -> int:
+        """Returns the microseconds since the Unix epoch of a timezone-aware timestamp, without float rounding."""
+        return (timestamp - epoch) // datetime.timedelta(microseconds=1)
+
+
+class PricingIndex:
+    """Loads the compact per-region price indexes written by fetch_cost_info.py."""
+    @classmethod
+    def load(cls, res_path: str, service: str, region: str, stream_index: Callable[[str], Dict]) -> Optional[Dict]:
+        """Returns the index of a service & region, the raw offer file is streamed when the index is missing or older than it."""
+        raw_file = path.join(res_path, service, region + '.json.gz')
+        index_file = get_index_file(raw_file)
+        if path.exists(index_file) and (not path.exists(raw_file) or path.getmtime(index_file) >= path.getmtime(raw_file)):
+            index = read_index(index_file)
+            if index is not None:
+                return index
+        if not path.exists(raw_file):
+            logger.warning('%s file for region %s at %s missing, please install it with the setup script', service.upper(), region, raw_file)
+            return None
+        logger.info('No up-to-date index for %s, parsing the full offer file', raw_file)
+        return stream_index(raw_file)
+
+
+class PricingRegistry(Generic[Pricing]):
+    """
+        Keeps the pricing objects of several regions resident. Regions are loaded lazily on first use, concurrent first uses share one load.
+        Least recently used regions are evicted when the summed size of all loaded regions exceeds the memory budget, the most recently
+        loaded region stays resident even if it alone exceeds the budget.
+        Resident regions can be reloaded in a background worker, requests keep using the previous object until the new one is swapped in.
+    """
+    def __init__(self, load_pricing: Callable[[str], Pricing], max_bytes: int):
+        self.load_pricing = load_pricing
+        self.pricings = LruCache(max_bytes)  # weighted by estimated memory footprint
+        self._loads = SingleFlight()
+        self._reloader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pricing-reload')  # one rebuild at a time bounds peak memory
+
+    def _load(self, region: str) -> Pricing:
+        pricing = self.load_pricing(region)
+        size = estimate_size(pricing)
+        if size > self.pricings.max_weight:
+            logger.warning('Pricing info for region %s takes about %d MB, more than the budget of %d MB, keeping it as the only resident region',
+                           region, size // (1024 * 1024), self.pricings.max_weight // (1024 * 1024))
+            size = self.pricings.max_weight  # larger entries would not be cached at all, all other regions are evicted instead
+        self.pricings.put(region, pricing, size)
+        logger.info('Loaded pricing info for region %s, %d region(s) resident', region, len(self.pricings))
+        return pricing
+
+    def get(self, region: str) -> Pricing:
+        """Returns the pricing object of a region, loads it if it is not resident."""
+        pricing = self.pricings.get(region)
+        if pricing is None:
+            pricing = self._loads.run(region, lambda: self._load(region))
+        return pricing
+
+    def _reload(self, region: str) -> None:
+        if region not in self.pricings:  # evicted in the meantime, loaded from the new files on next use
+            return
+        try:
+            self._loads.run(region, lambda: self._load(region))
+        except Exception as e:  # the previous object stays resident
+            logger.warning('Reloading pricing info for region %s failed:', region, exc_info=e)
+
+    def reload(self, regions: Optional[Iterable[str]] = None) -> List[str]:
+        """Schedules the rebuild of resident regions (all by default) and returns the scheduled ones, other regions are loaded fresh on use."""
+        resident_regions = self.pricings.keys()
+        scheduled_regions = resident_regions if regions is None else [region for region in regions if region in resident_regions]
+        for region in scheduled_regions:
+            self._reloader.submit(self._reload, region)
+        return scheduled_regions
+
+
+class PricingWatcher:
+    """
+        Polls the modification times of the resource files and reloads the regions whose files changed.
+        A region is only reloaded once its files were unchanged for a full interval, so partially completed downloads are not picked up.
+    """
+    def __init__(self, pricing_registry: PricingRegistry, res_path: str = resource_path, interval: float = 60):
+        self.pricing_registry = pricing_registry
+        self.res_path = res_path
+        self.interval = interval
+        self._pending_regions: Set[str] = set()
+        self._modification_times = self._get_modification_times()
+        self._stopped = threading.Event()
+
+    def _get_modification_times(self) -> Dict[str, float]:
+        modification_times: Dict[str, float] = {}
+        for service in ('ec2', 'emr', 'dbx'):
+            service_path = path.join(self.res_path, service)
+            if not path.isdir(service_path):
+                continue
+            for entry in os.scandir(service_path):
+                if entry.name.endswith('.gz'):  # skips temporary files of downloads in progress
+                    modification_times[path.join(service, entry.name)] = entry.stat().st_mtime
+        return modification_times
+
+    def check(self) -> List[str]:
+        """Compares the resource files with the previous check and returns the regions scheduled for reloading."""
+        modification_times = self._get_modification_times()
+        changed_files = {file for file in modification_times.keys() | self._modification_times.keys()
+                         if modification_times.get(file) != self._modification_times.get(file)}
+        self._modification_times = modification_times
+        changed_regions: Set[Optional[str]] = set()
+        for file in changed_files:
+            (service, file_name) = path.split(file)
+            changed_regions.add(None if service == 'dbx' else file_name.split('.', 1)[0])  # DBU info applies to all regions
+        settled_regions = self._pending_regions - changed_regions
+        self._pending_regions = (self._pending_regions - settled_regions) | changed_regions
+        if len(settled_regions) == 0:
+            return []
+        logger.info('Resource files changed, reloading pricing info')
+        return self.pricing_registry.reload(None if None in settled_regions else settled_regions)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                logger.warning('Checking resource files failed:', exc_info=e)
+
+    def start(self) -> None:
+        """Starts polling in a daemon thread."""
+        threading.Thread(target=self._run, name='pricing-watcher', daemon=True).start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
 
 class DbxPricing:
     """Class for Databricks cost estimations, parses and holds EC2 and DBU cost info located under resources/."""
     def __init__(self, region: str, res_path: str = resource_path):
         self.region = region
         # EC2 prices:
-        ec2_pricing = {'products': {}}
-        ec2_file = path.join(res_path, 'ec2', region + '.json.gz')
-        if path.exists(ec2_file):
-            with gzip.open(ec2_file, mode="rt") as f:
-                region_content = f.read()
-                ec2_pricing = json.loads(region_content)
-        else:
-            logger.warning('EC2 file for region %s at %s missing, please install it with the setup script', region, ec2_file)
-        ec2_sku_to_instance_type = {}
-        self.instance_type_info: InstanceInfo = {}
-        for sku in ec2_pricing['products']:
-            try:
-                attr = ec2_pricing['products'][sku]['attributes']
-                if attr['tenancy'] == 'Shared' and attr['operatingSystem'] == 'Linux' and attr['operation'] == 'RunInstances' \
-                        and attr['capacitystatus'] == 'Used':
-                    ec2_sku_to_instance_type[sku] = attr['instanceType']
-                    if 'instanceType' in attr:
-                        self.instance_type_info[attr['instanceType']] = attr
-            except KeyError:
-                pass
-        self.ec2_prices: CostMap = {}
-        for sku, instance_type in ec2_sku_to_instance_type.items():
-            sku_info = ec2_pricing['terms']['OnDemand'][sku]
-            if len(sku_info) > 1:
-                logger.warning('More than one SKU for %s in %s', sku_info, ec2_file)
-                continue
-            _, sku_info_value = sku_info.popitem()
-            price_dimensions = sku_info_value['priceDimensions']
-            if len(sku_info) > 1:
-                logger.warning('More than price dimension for %s in %s', price_dimensions, ec2_file)
-                continue
-            _, price_dimensions_value = price_dimensions.popitem()
-            price = float(price_dimensions_value['pricePerUnit']['USD'])
-            if self.available_ec2_price(instance_type):
-                logger.warning('Instance type info for %s already added', instance_type)
-                continue
-            self.ec2_prices[instance_type] = price
+        ec2_index = PricingIndex.load(res_path, 'ec2', region, stream_ec2_index) or {}
+        self.instance_type_info: InstanceInfo = ec2_index.get('instance_type_info', {})
+        self.ec2_prices: CostMap = ec2_index.get('ec2_prices', {})
         # DBU info:
         cost_per_dbu: Dict[Tuple[DbxClusterType, str], float] = {}
         with gzip.open(path.join(resource_path, 'dbx', 'cost_per_dbu_aws.tsv.gz', ), mode="rt") as f:
@@ -222,71 +333,12 @@ class Ec2EmrPricing:
     def __init__(self, region: str, res_path: str):
         self.region = region
         # Populate EMR prices:
-        emr_file = path.join(res_path, 'emr', region + '.json.gz')
-        emr_pricing = {'products': {}}
-        if path.exists(emr_file):
-            with gzip.open(emr_file, mode="rt") as f:
-                region_content = f.read()
-                emr_pricing = json.loads(region_content)
-        else:
-            logger.warning('EMR file for region %s at %s missing, please install it with the setup script', region, emr_file)
-        sku_map_emr = {}  # sku to instance type mappings
-        for sku in emr_pricing['products']:
-            if (('softwareType' in emr_pricing['products'][sku]['attributes'].keys()) and
-                    (emr_pricing['products'][sku]['attributes']['softwareType'] == 'EMR')):
-                sku_map_emr[sku] = emr_pricing['products'][sku]['attributes']['instanceType']
-        self.emr_prices: CostMap = {}
-        for sku, instance_type in sku_map_emr.items():
-            sku_info = emr_pricing['terms']['OnDemand'][sku]
-            if len(sku_info) > 1:
-                logger.warning('More than one SKU for %s in %s', sku_info, emr_file)
-                continue
-            _, sku_info_value = sku_info.popitem()
-            price_dimensions = sku_info_value['priceDimensions']
-            if len(sku_info) > 1:
-                logger.warning('More than one price dimension for %s in %s', price_dimensions, emr_file)
-                continue
-            _, price_dimensions_value = price_dimensions.popitem()
-            price = float(price_dimensions_value['pricePerUnit']['USD'])
-            self.emr_prices[instance_type] = price
+        emr_index = PricingIndex.load(res_path, 'emr', region, stream_emr_index) or {}
+        self.emr_prices: CostMap = emr_index.get('emr_prices', {})
         # Populate EC2 prices:
-        ec2_pricing = {'products': {}}
-        ec2_file = path.join(res_path, 'ec2', region + '.json.gz')
-        if path.exists(ec2_file):
-            with gzip.open(ec2_file, mode="rt") as f:
-                region_content = f.read()
-                ec2_pricing = json.loads(region_content)
-        else:
-            logger.warning('EC2 file for region %s at %s missing, please install it with the setup script', region, ec2_file)
-        self.instance_type_info: InstanceInfo = {}  # for instance info panel
-        sku_map_ec2 = {}  # sku to instance type mappings
-        for sku in ec2_pricing['products']:
-            try:
-                attr = ec2_pricing['products'][sku]['attributes']
-                if attr['tenancy'] == 'Shared' and attr['operatingSystem'] == 'Linux' and attr['operation'] == 'RunInstances' \
-                        and attr['capacitystatus'] == 'Used':
-                    sku_map_ec2[sku] = attr['instanceType']
-                    if 'instanceType' in attr:
-                        self.instance_type_info[attr['instanceType']] = attr
-            except KeyError:
-                pass
-        self.ec2_prices: CostMap = {}
-        for sku, instance_type in sku_map_ec2.items():
-            sku_info = ec2_pricing['terms']['OnDemand'][sku]
-            if len(sku_info) > 1:
-                logger.warning('More than one SKU present in %s for %s', ec2_file, sku_info)
-                continue
-            _, sku_info_value = sku_info.popitem()
-            price_dimensions = sku_info_value['priceDimensions']
-            if len(sku_info) > 1:
-                logger.warning('More than one price dimension present in %s for %s', ec2_file, price_dimensions)
-                continue
-            _, price_dimensions_value = price_dimensions.popitem()
-            price = float(price_dimensions_value['pricePerUnit']['USD'])
-            if self.available_ec2_price(instance_type):
-                logger.warning('Instance price for %s from %s already added', instance_type, ec2_file)
-                continue
-            self.ec2_prices[instance_type] = price
+        ec2_index = PricingIndex.load(res_path, 'ec2', region, stream_ec2_index) or {}
+        self.instance_type_info: InstanceInfo = ec2_index.get('instance_type_info', {})  # for instance info panel
+        self.ec2_prices: CostMap = ec2_index.get('ec2_prices', {})
 
     def available_ec2_price(self, instance_type) -> bool:
         """Check whether EC2 list price is available for the instance."""
@@ -318,34 +370,88 @@ class Ec2EmrPricing:
         return {}
 
 
+class InstanceColumns:
+    """
+        Instances of a cluster as columns, ordered by group and listing: Group and instance type indices, spot market flags, instance IDs,
+        creation & termination times, and hours run. Instance types and groups are stored once.
+    """
+    def __init__(self, groups: List[InstanceResGroup], group_instances: List[List[Ec2Instance]]):
+        self.groups = groups
+        instances = [(group_id, instance) for group_id, instances in enumerate(group_instances) for instance in instances]
+        type_index: Dict[str, int] = {}
+        self.group_ids = np.array([group_id for (group_id, _) in instances], dtype=np.int64)
+        self.type_ids = np.array([type_index.setdefault(instance.instance_type, len(type_index)) for (_, instance) in instances], dtype=np.int64)
+        self.instance_types: List[str] = list(type_index.keys())
+        self.spot_mask = np.array([instance.market_type == "SPOT" for (_, instance) in instances], dtype=bool)
+        self.creation_times: List[datetime] = [instance.creation_ts for (_, instance) in instances]
+        self.termination_times: List[datetime] = [instance.termination_ts for (_, instance) in instances]
+        self.instance_ids: List[Optional[str]] = [instance.instance_id for (_, instance) in instances]
+        self.ended_mask = np.array([instance.has_ended for (_, instance) in instances], dtype=bool)
+        creation_micros = np.array([EstimationUtils.get_epoch_micros(timestamp) for timestamp in self.creation_times], dtype=np.int64)
+        self.termination_micros = np.array([EstimationUtils.get_epoch_micros(timestamp) for timestamp in self.termination_times], dtype=np.int64)
+        self.hours_run = (self.termination_micros - creation_micros) / 1e6 / 3600  # same rounding as timedelta.total_seconds() / 3600
+
+    def __len__(self) -> int:
+        return len(self.group_ids)
+
+    def select(self, positions: np.ndarray) -> Self:
+        """Returns the columns of the instances at the given positions, groups and instance types are shared."""
+        selection = copy(self)
+        selection.group_ids = self.group_ids[positions]
+        selection.type_ids = self.type_ids[positions]
+        selection.spot_mask = self.spot_mask[positions]
+        selection.creation_times = [self.creation_times[i] for i in positions]
+        selection.termination_times = [self.termination_times[i] for i in positions]
+        selection.instance_ids = [self.instance_ids[i] for i in positions]
+        selection.ended_mask = self.ended_mask[positions]
+        selection.termination_micros = self.termination_micros[positions]
+        selection.hours_run = self.hours_run[positions]
+        return selection
+
+    def get_spot_types(self) -> Dict[str, np.ndarray]:
+        """Returns the positions of spot instances per instance type."""
+        spot_types: Dict[str, np.ndarray] = {}
+        for type_id in np.unique(self.type_ids[self.spot_mask]):
+            spot_types[self.instance_types[type_id]] = np.flatnonzero(self.spot_mask & (self.type_ids == type_id))
+        return spot_types
+
+
 class EmrCostEstimator:
     """
         Class for estimating EMR on-demand and spot costs in instance fleets and groups.
-        Holds an EMR client for calling ListInstanceGroups, ListInstanceFleets, ListInstances, and DescribeCluster.
+        Holds an EMR client for calling ListInstanceGroups, ListInstanceFleets, ListInstances, and DescribeCluster. Whether a cluster uses
+        instance groups or fleets is taken from its description, all instances of a cluster are listed in one pagination.
         Holds a :class:`SpotPricing` object with an EC2 client for calling ec2:DescribeSpotPriceHistory.
+        Costs of instances that have ended are cached per cluster if a cache is supplied, so refreshes of long-running clusters only
+        price running and newly listed instances.
         Inspired by https://github.com/memosstilvi/emr-cost-calculator.
     """
-    def __init__(self, emr_client: BaseClient, ec2_client: BaseClient, region: str, res_path: str = resource_path):
+    def __init__(self, emr_client: BaseClient, ec2_client: BaseClient, region: str, res_path: str = resource_path,
+                 pricing_registry: Optional[PricingRegistry[Ec2EmrPricing]] = None, spot_store: Optional[SpotPriceStore] = None,
+                 instance_cost_cache: Optional[LruCache] = None, cluster_store: Optional[ClusterMetadataStore] = None):
         self.emr_client = emr_client
+        if cluster_store is None:  # descriptions are only shared with the panels if a store is supplied
+            cluster_store = ClusterMetadataStore(PersistentCache('cluster_descriptions', 1000, None, DescribedEmrCluster.model_dump_json,
+                                                                 DescribedEmrCluster.model_validate_json))
+        self.cluster_store = cluster_store
+        self.collection_types = LruCache(10000)  # collection types learned from rejected instance group operations, keyed by cluster ID
+        self.region = region
+        self.instance_cost_cache = instance_cost_cache  # InstanceCosts per cluster ID, weighted by instance count
         try:
-            self.spot_pricing = SpotPricing(ec2_client)
+            self.spot_pricing = SpotPricing(ec2_client, spot_store)
         except Exception as e:
             logger.warning('Could not connect to AWS EC2 API:', exc_info=e)
-        self.ec2_emr_pricing = Ec2EmrPricing(region, res_path)
+        if pricing_registry is None:  # registry for a single region
+            pricing_registry = PricingRegistry(lambda pricing_region: Ec2EmrPricing(pricing_region, res_path), sys.maxsize)
+        self.pricing_registry = pricing_registry
 
-    def _get_ec2_cost(self, instance: Ec2Instance, avail_zone) -> float:
-        """Return the on demand or spot estimation for the instance in given availability zone"""
-        try:
-            if instance.market_type == "SPOT":
-                return self.spot_pricing.estimate_price_for_period(instance.instance_type, avail_zone, instance.creation_ts, instance.termination_ts)
-            ec2_price = self.ec2_emr_pricing.get_ec2_price(instance.instance_type)
-            return ec2_price * ((instance.termination_ts - instance.creation_ts).total_seconds() / 3600)
-        except Exception as e:
-            logger.warning('Problems with estimating costs for %s %s', instance.market_type, instance.instance_type, exc_info=e)
-            return 0.0
+    @property
+    def ec2_emr_pricing(self) -> Ec2EmrPricing:
+        """Returns the list prices of the estimator's region, resident in the shared registry."""
+        return self.pricing_registry.get(self.region)
 
     @classmethod
-    def _estimate_root_volume_cost(cls, hours_run: float) -> float:
+    def _estimate_root_volume_cost(cls, hours_run: Hours) -> Hours:
         """
             Estimates the root volume cost with several simplifying assumptions: By default, 15 GiB SSD (gp2) are attached to each cluster
             instance. 0.1$ per GB-month is used as the price which is multiplied by 0.931323 to get GiB-month. A month equals 720 hours in
@@ -354,7 +460,7 @@ class EmrCostEstimator:
         return 15 * 0.1 * 0.931323 * hours_run / 720
 
     @classmethod
-    def _estimate_ebs_storage_cost(cls, hours_run: float, vol_type: str, vol_size: int) -> float:
+    def _estimate_ebs_storage_cost(cls, hours_run: Hours, vol_type: str, vol_size: int) -> Hours:
         """
             Estimates the storage cost with several simplifying assumptions: The us-east-1 prices from https://aws.amazon.com/ebs/pricing/
             are used which are multiplied by 0.931323 to get GiB-month. A month equals 720 hours in the calculation below.
@@ -377,8 +483,8 @@ class EmrCostEstimator:
         return vol_size * vol_price * 0.931323 * hours_run / 720
 
     @classmethod
-    def _estimate_ebs_costs(cls, block_devices: List[Dict], hours_run: float) -> float:
-        """Estimates an instance's EBS costs."""
+    def _estimate_ebs_costs(cls, block_devices: List[Dict], hours_run: Hours) -> Hours:
+        """Estimates an instance's EBS costs, or the costs of several instances of a group if an array of hours is passed."""
         ebs_costs = EmrCostEstimator._estimate_root_volume_cost(hours_run)
         for block_device in block_devices:
             try:
@@ -409,31 +515,58 @@ class EmrCostEstimator:
             instance_fleets.append(inst_fleet)
         return instance_fleets
 
-    def _get_instances(self, instance_group: InstanceResGroup, cluster_id: str, fleet=False) -> Iterator[Ec2Instance]:
-        """Fetch and merges the cluster's instances via calls to elasticmapreduce:ListInstances."""
-        instance_list = []
-        list_instances_args = {'ClusterId': cluster_id, 'InstanceGroupId': instance_group.group_id}
-        if fleet:
-            list_instances_args = {'ClusterId': cluster_id, 'InstanceFleetId': instance_group.group_id}
+    def _get_groups(self, cluster_id: str) -> List[InstanceResGroup]:
+        """
+            Fetch the cluster's instance groups or fleets depending on its collection type. If the description does not contain the type,
+            instance groups are tried first and fleet clusters are recognized by the rejection of group operations.
+        """
+        collection_type: Optional[str] = self.collection_types.get(cluster_id)
+        if collection_type is None:
+            collection_type = self.cluster_store.get_collection_type(self.emr_client, cluster_id)
+        if collection_type == 'INSTANCE_FLEET':
+            return self._get_instance_fleets(cluster_id)
+        if collection_type == 'INSTANCE_GROUP':
+            return self._get_instance_groups(cluster_id)
+        try:
+            instance_groups = self._get_instance_groups(cluster_id)
+            self.collection_types.put(cluster_id, 'INSTANCE_GROUP')
+        except ClientError as e:  # ListInstanceGroups op does not support clusters that use instance fleets => use ListInstanceFleets op
+            if e.response.get('Error', {}).get('Code') != 'InvalidRequestException':
+                raise
+            instance_groups = self._get_instance_fleets(cluster_id)
+            self.collection_types.put(cluster_id, 'INSTANCE_FLEET')
+        return instance_groups
+
+    def _get_instances(self, cluster_id: str) -> Iterator[Tuple[Optional[str], Ec2Instance]]:
+        """Fetch the cluster's instances with their group or fleet IDs via paginated calls to elasticmapreduce:ListInstances."""
+        list_instances_args = {'ClusterId': cluster_id}
         while True:
             batch = self.emr_client.list_instances(**list_instances_args)
-            instance_list.extend(batch['Instances'])
+            for instance_info in batch['Instances']:
+                instance = self._parse_instance(instance_info, cluster_id)
+                if instance is not None:
+                    yield instance_info.get('InstanceGroupId', instance_info.get('InstanceFleetId')), instance
             try:
                 list_instances_args['Marker'] = batch['Marker']
             except KeyError:
                 break
-        for instance_info in instance_list:
+
+    @classmethod
+    def _parse_instance(cls, instance_info: Dict, cluster_id: str) -> Optional[Ec2Instance]:
+        """Creates an instance from a ListInstances entry, running instances end now."""
+        try:
+            creation_time = instance_info['Status']['Timeline']['CreationDateTime']
             try:
-                creation_time = instance_info['Status']['Timeline']['CreationDateTime']
-                try:
-                    end_date_time = instance_info['Status']['Timeline']['EndDateTime']
-                except KeyError:
-                    end_date_time = datetime.datetime.now(tz=creation_time.tzinfo)  # use same TZ as creation time, datetime.now() not tz-aware
-                inst = Ec2Instance(instance_info['Status']['Timeline']['CreationDateTime'], end_date_time, instance_info['InstanceType'],
-                                   instance_info['Market'], instance_info['EbsVolumes'])
-                yield inst
-            except AttributeError as e:
-                logger.warning('Issue while computing instance cost for cluster %s', cluster_id, exc_info=e)
+                end_date_time = instance_info['Status']['Timeline']['EndDateTime']
+            except KeyError:
+                end_date_time = datetime.datetime.now(tz=creation_time.tzinfo)  # use same TZ as creation time, datetime.now() not tz-aware
+            inst = Ec2Instance(instance_info['Status']['Timeline']['CreationDateTime'], end_date_time, instance_info['InstanceType'],
+                               instance_info['Market'], instance_info['EbsVolumes'], instance_info.get('Id'),
+                               'EndDateTime' in instance_info['Status']['Timeline'])
+            return inst
+        except AttributeError as e:
+            logger.warning('Issue while computing instance cost for cluster %s', cluster_id, exc_info=e)
+            return None
 
     @classmethod
     def _get_ebs_block_devices(cls, spec_map) -> List[Dict]:
@@ -445,53 +578,104 @@ class EmrCostEstimator:
 
     def _get_avail_zone(self, cluster_id) -> str:
         """Return availability zone of the cluster."""
-        cluster_description = self.emr_client.describe_cluster(ClusterId=cluster_id)
-        return cluster_description['Cluster']['Ec2InstanceAttributes']['Ec2AvailabilityZone']
+        return self.cluster_store.get_avail_zone(self.emr_client, cluster_id)
+
+    def _prefetch_spot_prices(self, columns: InstanceColumns, avail_zone: str) -> None:
+        """Fetches the spot price histories of all spot instance types of a cluster in as few API calls as possible."""
+        windows: Dict[str, Tuple[datetime, datetime]] = {}
+        for inst_type, type_ids in columns.get_spot_types().items():
+            windows[inst_type] = (min(columns.creation_times[i] for i in type_ids), max(columns.termination_times[i] for i in type_ids))
+        if len(windows) == 0:
+            return
+        try:
+            self.spot_pricing.prefetch_prices(avail_zone, windows)
+        except Exception as e:  # prices are fetched per instance type later on
+            logger.warning('Could not prefetch spot prices in %s:', avail_zone, exc_info=e)
+
+    def get_instance_columns(self, cluster_id: str) -> InstanceColumns:
+        """Lists all instances of a cluster and assigns them to its instance groups or fleets."""
+        instance_groups: List[InstanceResGroup] = self._get_groups(cluster_id)
+        group_positions = {instance_group.group_id: position for position, instance_group in enumerate(instance_groups)}
+        group_instances: List[List[Ec2Instance]] = [[] for _ in instance_groups]
+        for group_id, instance in self._get_instances(cluster_id):
+            if group_id not in group_positions:
+                logger.warning('Skipping instance %s of unknown group %s in cluster %s', instance.instance_id, group_id, cluster_id)
+                continue
+            group_instances[group_positions[group_id]].append(instance)
+        return InstanceColumns(instance_groups, group_instances)
+
+    def estimate_instance_costs(self, columns: InstanceColumns, avail_zone: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns the EC2, EMR, and EBS costs of every instance, computed per instance type or group instead of per instance."""
+        self._prefetch_spot_prices(columns, avail_zone)
+        pricing = self.ec2_emr_pricing
+        type_ec2_prices = np.zeros(len(columns.instance_types))
+        for type_id in np.unique(columns.type_ids[~columns.spot_mask]):  # list prices are only looked up for on-demand instances
+            type_ec2_prices[type_id] = pricing.get_ec2_price(columns.instance_types[type_id])
+        type_emr_prices = np.array([pricing.get_emr_price(inst_type) for inst_type in columns.instance_types], dtype=np.float64)
+        ec2_costs = type_ec2_prices[columns.type_ids] * columns.hours_run  # on demand, spot instances are overwritten below
+        for inst_type, type_ids in columns.get_spot_types().items():
+            try:
+                ec2_costs[type_ids] = self.spot_pricing.estimate_prices_for_periods(inst_type, avail_zone, [columns.creation_times[i] for i in type_ids],
+                                                                                    [columns.termination_times[i] for i in type_ids])
+            except Exception as e:
+                logger.warning('Problems with estimating costs for %s %s', 'SPOT', inst_type, exc_info=e)
+                ec2_costs[type_ids] = 0.0
+        emr_costs = type_emr_prices[columns.type_ids] * columns.hours_run
+        ebs_costs = np.zeros(len(columns))
+        for group_id, instance_group in enumerate(columns.groups):
+            group_mask = columns.group_ids == group_id
+            if group_mask.any():
+                ebs_costs[group_mask] = self._estimate_ebs_costs(instance_group.ebs_block_devices, columns.hours_run[group_mask])
+        return ec2_costs, emr_costs, ebs_costs
+
+    def estimate_incremental_costs(self, cluster_id: str, columns: InstanceColumns, avail_zone: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+            Returns the EC2, EMR, and EBS costs of every instance like :func:`estimate_instance_costs`, but takes the costs of ended instances
+            from the cache. Newly ended instances are cached once their spot prices have settled, i.e., the minimum fetch gap has passed.
+        """
+        if self.instance_cost_cache is None:
+            return self.estimate_instance_costs(columns, avail_zone)
+        cached_costs: InstanceCosts = self.instance_cost_cache.get(cluster_id, {})
+        cached_mask = np.array([instance_id in cached_costs for instance_id in columns.instance_ids], dtype=bool)
+        costs = np.zeros((3, len(columns)))
+        if cached_mask.any():
+            costs[:, cached_mask] = np.array([cached_costs[columns.instance_ids[i]] for i in np.flatnonzero(cached_mask)]).T
+        pending_positions = np.flatnonzero(~cached_mask)
+        if len(pending_positions) > 0:
+            costs[:, pending_positions] = self.estimate_instance_costs(columns.select(pending_positions), avail_zone)
+        settled_before = EstimationUtils.get_epoch_micros(datetime.datetime.now(tz=datetime.timezone.utc)) - self.spot_pricing.min_fetch_gap
+        has_id = np.array([instance_id is not None for instance_id in columns.instance_ids], dtype=bool)
+        settled_positions = np.flatnonzero(~cached_mask & has_id & columns.ended_mask & (columns.termination_micros < settled_before))
+        if len(settled_positions) > 0:  # replaced instead of updated, concurrent readers keep a consistent map
+            updated_costs: InstanceCosts = {**cached_costs, **{columns.instance_ids[i]: (float(costs[0, i]), float(costs[1, i]), float(costs[2, i]))
+                                                               for i in settled_positions}}
+            self.instance_cost_cache.put(cluster_id, updated_costs, weight=len(updated_costs))
+        return costs[0], costs[1], costs[2]
+
+    @classmethod
+    def aggregate_costs(cls, columns: InstanceColumns, ec2_costs: np.ndarray, emr_costs: np.ndarray, ebs_costs: np.ndarray) -> CostMap:
+        """
+            Sums instance costs per group type and in total. Keys are ordered by first occurrence and sums accumulate in instance order,
+            exactly like an instance-by-instance loop.
+        """
+        cost_dict: CostMap = {}
+        group_types = np.array([instance_group.group_type for instance_group in columns.groups], dtype=object)[columns.group_ids]
+        for group_type in dict.fromkeys(group_types):  # group types in order of first occurrence
+            type_mask = group_types == group_type
+            cost_dict[group_type + '.EC2'] = float(np.cumsum(ec2_costs[type_mask])[-1])
+            cost_dict[group_type + '.EMR'] = float(np.cumsum(emr_costs[type_mask])[-1])
+            cost_dict[group_type + '.EBS'] = float(np.cumsum(ebs_costs[type_mask])[-1])
+            cost_dict.setdefault('TOTAL', 0.0)  # placed after the keys of the first group type
+        if len(columns) > 0:
+            cost_dict['TOTAL'] = float(np.cumsum(ec2_costs + emr_costs + ebs_costs)[-1])
+        return cost_dict
 
-    @retry(wait_exponential_multiplier=1000, wait_exponential_max=10000, retry_on_exception=is_error_retrieable)
+    @retry(wait_exponential_multiplier=1000, wait_exponential_max=10000, stop_max_attempt_number=5, stop_max_delay=30000, retry_on_exception=is_error_retrieable)
     def estimate_cluster_cost(self, cluster_id) -> CostMap:
         """Merges cost info of different components / instance groups to get total costs."""
-        cost_dict: CostMap = {}
         avail_zone = self._get_avail_zone(cluster_id)
-        try:
-            instance_groups: List[InstanceResGroup] = self._get_instance_groups(cluster_id)
-            for instance_group in instance_groups:
-                for instance in self._get_instances(instance_group, cluster_id):
-                    ec2_cost: float = self._get_ec2_cost(instance, avail_zone)
-                    if ec2_cost is None:
-                        ec2_cost = 0
-                    group_type = instance_group.group_type
-                    cost_dict.setdefault(group_type + '.EC2', 0)
-                    cost_dict[group_type + '.EC2'] += ec2_cost
-                    cost_dict.setdefault(group_type + '.EMR', 0)
-                    hours_run = (instance.termination_ts - instance.creation_ts).total_seconds() / 3600
-                    emr_cost = self.ec2_emr_pricing.get_emr_price(instance.instance_type) * hours_run
-                    cost_dict[group_type + '.EMR'] += emr_cost
-                    cost_dict.setdefault(group_type + '.EBS', 0)
-                    ebs_cost = self._estimate_ebs_costs(instance_group.ebs_block_devices, hours_run)
-                    cost_dict[group_type + '.EBS'] += ebs_cost
-                    cost_dict.setdefault('TOTAL', 0)
-                    cost_dict['TOTAL'] += ec2_cost + emr_cost + ebs_cost
-        except Exception:  # ListInstanceGroups op does not support clusters that use instance fleets => use ListInstanceFleets op
-            instance_fleets: List[InstanceResGroup] = self._get_instance_fleets(cluster_id)
-            for instance_fleet in instance_fleets:
-                for instance in self._get_instances(instance_fleet, cluster_id, True):
-                    ec2_cost: float = self._get_ec2_cost(instance, avail_zone)
-                    if ec2_cost is None:
-                        ec2_cost = 0
-                    group_type = instance_fleet.group_type
-                    cost_dict.setdefault(group_type + '.EC2', 0)
-                    cost_dict[group_type + '.EC2'] += ec2_cost
-                    cost_dict.setdefault(group_type + '.EMR', 0)
-                    hours_run = (instance.termination_ts - instance.creation_ts).total_seconds() / 3600
-                    emr_cost = self.ec2_emr_pricing.get_emr_price(instance.instance_type) * hours_run
-                    cost_dict[group_type + '.EMR'] += emr_cost
-                    cost_dict.setdefault(group_type + '.EBS', 0)
-                    ebs_cost = self._estimate_ebs_costs(instance_fleet.ebs_block_devices, hours_run)
-                    cost_dict[group_type + '.EBS'] += ebs_cost
-                    cost_dict.setdefault('TOTAL', 0)
-                    cost_dict['TOTAL'] += ec2_cost + emr_cost + ebs_cost
-        return cost_dict
+        columns = self.get_instance_columns(cluster_id)
+        return self.aggregate_costs(columns, *self.estimate_incremental_costs(cluster_id, columns, avail_zone))
 
     def close_clients(self):
         """Close embedded clients."""
@@ -499,34 +683,80 @@ class EmrCostEstimator:
         self.spot_pricing.ec2_client.close()
 
 
+class SpotPriceSeries:
+    """
+        Spot price history of one instance type in one availability zone as sorted arrays of epoch microseconds and prices.
+        A price applies from its timestamp until the next one, the first price also before its timestamp. The cumulative cost at every
+        timestamp is precomputed, so the cost of a period takes two binary searches and a subtraction.
+    """
+    def __init__(self, history: SpotPriceHistory):
+        sorted_timestamps = sorted(history.keys())
+        self.timestamps = np.array([EstimationUtils.get_epoch_micros(timestamp) for timestamp in sorted_timestamps], dtype=np.int64)
+        self.prices = np.array([history[timestamp] for timestamp in sorted_timestamps], dtype=np.float64)
+        segment_costs = np.diff(self.timestamps) / 1e6 * self.prices[:-1] / 3600.0
+        self.cumulative_costs = np.concatenate((np.zeros(1), np.cumsum(segment_costs)))  # cost from the first timestamp until each timestamp
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def get_costs(self, start_micros: np.ndarray, end_micros: np.ndarray) -> np.ndarray:
+        """Returns the costs of periods given as epoch microseconds, vectorized over all periods."""
+        if len(self.timestamps) == 0:
+            return np.zeros(len(start_micros))
+        start_ids = np.maximum(np.searchsorted(self.timestamps, start_micros, side='right') - 1, 0)  # active price at start
+        end_ids = np.maximum(np.searchsorted(self.timestamps, end_micros, side='right') - 1, 0)
+        next_ids = np.minimum(start_ids + 1, len(self.timestamps) - 1)
+        single_interval_costs = (end_micros - start_micros) / 1e6 * self.prices[start_ids] / 3600.0
+        first_costs = (self.timestamps[next_ids] - start_micros) / 1e6 * self.prices[start_ids] / 3600.0  # until the first price change
+        intermediate_costs = self.cumulative_costs[end_ids] - self.cumulative_costs[next_ids]
+        last_costs = (end_micros - self.timestamps[end_ids]) / 1e6 * self.prices[end_ids] / 3600.0  # since the last price change
+        return np.where(start_ids == end_ids, single_interval_costs, first_costs + intermediate_costs + last_costs)
+
+
 class SpotPricing:
     """
         Holds and returns spot price histories for particular instances, fetched via calls
-        to ec2:DescribeSpotPriceHistory.
+        to ec2:DescribeSpotPriceHistory. The covered time intervals are tracked per instance type & availability zone, only
+        missing sub-intervals are fetched and merged into the history. An optional store persists histories across restarts.
         Inspired by https://github.com/memosstilvi/emr-cost-calculator.
     """
-    def __init__(self, ec2_client: BaseClient):
-        self.ec2_client = ec2_client
-        self.spot_prices: Dict[Tuple[str, str], SpotPriceHistory] = {}  # instance type/avail_zone as keys
-
-    def _populate_missing_prices(self, inst_type: str, avail_zone: str, start_time: datetime, end_time: datetime) -> None:
-        """
-            Fetches spot prices per instance type and availability zone for given interval via EC2 API calls
-            and populates internal history map.
-        """
-        if (inst_type, avail_zone) in self.spot_prices:
-            prices = self.spot_prices[(inst_type, avail_zone)]
-            sorted_keys = sorted(prices.keys())
-            if end_time - sorted_keys[-1] < datetime.timedelta(days=1, hours=1) and sorted_keys[0] < start_time:
-                return  # end time at most 25 hours after last entry and start time after first entry => relevant dates already present
-        else:
-            prices: SpotPriceHistory = {}
-        previous_ts = None
+    def __init__(self, ec2_client: Optional[BaseClient], store: Optional[SpotPriceStore] = None):
+        self.ec2_client = ec2_client  # nothing is fetched without a client
+        self.store = store
+        self.min_fetch_gap = datetime.timedelta(minutes=15) // datetime.timedelta(microseconds=1)  # shorter gaps next to fetched prices, e.g. of running clusters, are not fetched
+        self._spot_prices: Dict[Tuple[str, str], SpotPriceHistory] = {}  # instance type/avail_zone as keys
+        self._price_series: Dict[Tuple[str, str], SpotPriceSeries] = {}  # same keys, arrays for estimations
+        self._coverage: Dict[Tuple[str, str], List[Interval]] = {}  # same keys, sorted intervals of epoch microseconds
+        self._lock = threading.RLock()  # guards histories & coverage, estimators are shared by concurrent cost estimations
+        self._fetches = SingleFlight()  # concurrent fetches of the same prices share one paginated API call
+
+    @property
+    def spot_prices(self) -> Dict[Tuple[str, str], SpotPriceHistory]:
+        """Returns the raw price histories with instance type/avail_zone as keys."""
+        return self._spot_prices
+
+    @spot_prices.setter
+    def spot_prices(self, spot_prices: Dict[Tuple[str, str], SpotPriceHistory]) -> None:
+        self._spot_prices = spot_prices
+        self._price_series = {key: SpotPriceSeries(prices) for key, prices in spot_prices.items()}
+        self._coverage = {}
+
+    def _load_stored_prices(self, inst_type: str, avail_zone: str) -> None:
+        """Loads the persisted history of an instance type & availability zone when it is used for the first time."""
+        (stored_prices, intervals) = self.store.load(inst_type, avail_zone)
+        self._spot_prices[(inst_type, avail_zone)] = {epoch + datetime.timedelta(microseconds=timestamp): price for timestamp, price in stored_prices.items()}
+        self._price_series[(inst_type, avail_zone)] = SpotPriceSeries(self._spot_prices[(inst_type, avail_zone)])
+        self._coverage[(inst_type, avail_zone)] = intervals
+
+    def _fetch_prices(self, inst_types: List[str], avail_zone: str, start_time: datetime, end_time: datetime) -> Dict[str, SpotPriceHistory]:
+        """Fetches the spot prices of several instance types in an interval with one paginated call, including the prices in effect at its start."""
+        prices: Dict[str, SpotPriceHistory] = {inst_type: {} for inst_type in inst_types}
+        previous_timestamps: Dict[str, datetime] = {}
         next_token = ""
         while True:
             # see https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ec2/client/describe_spot_price_history.html
             prices_response = self.ec2_client.describe_spot_price_history(
-                InstanceTypes=[inst_type],
+                InstanceTypes=inst_types,
                 ProductDescriptions=['Linux/UNIX (Amazon VPC)'],  # AWS API (sometimes?) normalizes to `Linux/UNIX`
                 AvailabilityZone=avail_zone,
                 StartTime=start_time,
@@ -534,46 +764,102 @@ class SpotPricing:
                 NextToken=next_token
             )
             for price in prices_response['SpotPriceHistory']:
-                if previous_ts is None:
-                    previous_ts = price['Timestamp']
+                inst_type = price['InstanceType']
+                previous_ts = previous_timestamps.get(inst_type, price['Timestamp'])
                 if previous_ts - price['Timestamp'] > datetime.timedelta(days=1, hours=1):
                     logger.warning("Expect max of one day one hour diff between price entries, not %s minus %s", previous_ts, price['Timestamp'])
-                prices[price['Timestamp']] = float(price['SpotPrice'])
-                previous_ts = price['Timestamp']
+                prices.setdefault(inst_type, {})[price['Timestamp']] = float(price['SpotPrice'])
+                previous_timestamps[inst_type] = price['Timestamp']
             next_token = prices_response['NextToken']
             if next_token == "":
                 break
-        self.spot_prices[(inst_type, avail_zone)] = prices
+        return prices
+
+    def _get_missing_intervals(self, inst_type: str, avail_zone: str, start_time: datetime, end_time: datetime) -> List[Interval]:
+        """Returns the parts of an interval that are not covered by the history, loads a persisted history on first use."""
+        key = (inst_type, avail_zone)
+        if key not in self._spot_prices and self.store is not None:
+            self._load_stored_prices(inst_type, avail_zone)
+        now = EstimationUtils.get_epoch_micros(datetime.datetime.now(tz=datetime.timezone.utc))
+        start_micros = EstimationUtils.get_epoch_micros(start_time)
+        end_micros = min(EstimationUtils.get_epoch_micros(end_time), now)  # later prices are not known yet
+        return SpotPriceStore.get_missing_intervals(self._coverage.get(key, []), start_micros, end_micros, self.min_fetch_gap)
+
+    def _merge_prices(self, inst_type: str, avail_zone: str, fetched_prices: SpotPriceHistory, fetched_intervals: List[Interval]) -> None:
+        """Merges fetched prices and their intervals into the history and persists them."""
+        key = (inst_type, avail_zone)
+        prices = {**self._spot_prices.get(key, {}), **fetched_prices}  # merged copy, readers keep a consistent history
+        coverage = SpotPriceStore.merge_intervals(self._coverage.get(key, []) + fetched_intervals)
+        self._spot_prices[key] = prices
+        self._price_series[key] = SpotPriceSeries(prices)
+        self._coverage[key] = coverage
+        if self.store is not None:
+            try:
+                fetched_micros = {EstimationUtils.get_epoch_micros(timestamp): price for timestamp, price in fetched_prices.items()}
+                self.store.save(inst_type, avail_zone, fetched_micros, coverage)
+            except Exception as e:
+                logger.warning('Could not persist spot prices of %s in %s:', inst_type, avail_zone, exc_info=e)
+
+    def _fetch_missing_prices(self, inst_type: str, avail_zone: str, missing_intervals: List[Interval]) -> List[Interval]:
+        """Fetches the prices of missing intervals without holding the lock, merges them, and returns the fetched intervals."""
+        fetched_prices: SpotPriceHistory = {}
+        for (missing_start, missing_end) in missing_intervals:
+            fetched_prices.update(self._fetch_prices([inst_type], avail_zone, epoch + datetime.timedelta(microseconds=missing_start),
+                                                     epoch + datetime.timedelta(microseconds=missing_end))[inst_type])
+        with self._lock:
+            self._merge_prices(inst_type, avail_zone, fetched_prices, missing_intervals)
+        return missing_intervals
+
+    def _populate_missing_prices(self, inst_type: str, avail_zone: str, start_time: datetime, end_time: datetime) -> None:
+        """
+            Fetches spot prices per instance type and availability zone for the parts of the given interval that are not covered yet
+            via EC2 API calls and merges them into the internal history map. Callers that join the fetch of a different interval check
+            their coverage again afterwards.
+        """
+        while True:
+            with self._lock:
+                missing_intervals = self._get_missing_intervals(inst_type, avail_zone, start_time, end_time)
+            if len(missing_intervals) == 0 or self.ec2_client is None:
+                return
+            fetched_intervals = self._fetches.run((inst_type, avail_zone), partial(self._fetch_missing_prices, inst_type, avail_zone, missing_intervals))
+            if fetched_intervals == missing_intervals:
+                return
+
+    def prefetch_prices(self, avail_zone: str, windows: Dict[str, Tuple[datetime, datetime]]) -> None:
+        """
+            Fetches the missing spot prices of several instance types in one availability zone up front, with one paginated call for all
+            types over the smallest window that spans their missing intervals. Later estimations of these types do not call the API.
+        """
+        missing_intervals: Dict[str, List[Interval]] = {}
+        with self._lock:
+            for inst_type, (start_time, end_time) in windows.items():
+                type_intervals = self._get_missing_intervals(inst_type, avail_zone, start_time, end_time)
+                if len(type_intervals) > 0:
+                    missing_intervals[inst_type] = type_intervals
+        if len(missing_intervals) == 0 or self.ec2_client is None:
+            return
+        fetch_start = min(type_intervals[0][0] for type_intervals in missing_intervals.values())
+        fetch_end = max(type_intervals[-1][1] for type_intervals in missing_intervals.values())
+        inst_types = sorted(missing_intervals.keys())
+        fetch_prices = partial(self._fetch_prices, inst_types, avail_zone, epoch + datetime.timedelta(microseconds=fetch_start),
+                               epoch + datetime.timedelta(microseconds=fetch_end))
+        fetched_prices = self._fetches.run((tuple(inst_types), avail_zone, fetch_start, fetch_end), fetch_prices)
+        with self._lock:
+            for inst_type in inst_types:
+                self._merge_prices(inst_type, avail_zone, fetched_prices.get(inst_type, {}), [(fetch_start, fetch_end)])
+
+    def estimate_prices_for_periods(self, inst_type: str, avail_zone: str, start_times: List[datetime], end_times: List[datetime]) -> np.ndarray:
+        """Derive spot estimations for several instances of one type in one availability zone with a single vectorized call."""
+        if len(start_times) == 0:
+            return np.zeros(0)
+        self._populate_missing_prices(inst_type, avail_zone, min(start_times), max(end_times))
+        start_micros = np.array([EstimationUtils.get_epoch_micros(start_time) for start_time in start_times], dtype=np.int64)
+        end_micros = np.array([EstimationUtils.get_epoch_micros(end_time) for end_time in end_times], dtype=np.int64)
+        price_series = self._price_series.get((inst_type, avail_zone))
+        if price_series is None:  # nothing fetched, e.g. without a client
+            return np.zeros(len(start_times))
+        return price_series.get_costs(start_micros, end_micros)
 
     def estimate_price_for_period(self, inst_type: str, avail_zone: str, start_time: datetime, end_time: datetime) -> float:
-        """Derive spot estimation by traversing through history and summing up interval costs."""
-        self._populate_missing_prices(inst_type, avail_zone, start_time, end_time)
-        prices: SpotPriceHistory = self.spot_prices[(inst_type, avail_zone)]
-        if len(prices) < 1:
-            return 0.0
-        if len(prices) == 1:  # API returned just one price point
-            relevant_price = next(iter(prices.values()))
-            seconds_passed = (end_time - start_time).total_seconds()
-            return EstimationUtils.get_normalized_cost(seconds_passed, relevant_price)
-        summed_price = 0.0
-        sorted_price_timestamps = sorted(prices.keys())
-        summed_until_timestamp = start_time
-        for key_id, price_timestamp in enumerate(sorted_price_timestamps):
-            next_id = key_id + 1
-            if next_id < len(sorted_price_timestamps) and price_timestamp < start_time <= sorted_price_timestamps[next_id]:  # active price right before instance start
-                if end_time <= sorted_price_timestamps[next_id]:  # start and end times within one spot price interval
-                    seconds_passed = (end_time - start_time).total_seconds()
-                    return EstimationUtils.get_normalized_cost(seconds_passed, prices[price_timestamp])
-                seconds_passed = (sorted_price_timestamps[next_id] - start_time).total_seconds()
-                summed_price += EstimationUtils.get_normalized_cost(seconds_passed, prices[price_timestamp])
-                summed_until_timestamp = sorted_price_timestamps[next_id]
-            elif price_timestamp > start_time:  # intermediate segment
-                seconds_passed = (price_timestamp - summed_until_timestamp).total_seconds()
-                summed_price += EstimationUtils.get_normalized_cost(seconds_passed, prices[sorted_price_timestamps[key_id - 1]])
-                summed_until_timestamp = price_timestamp
-            if key_id == len(sorted_price_timestamps) - 1 or end_time < sorted_price_timestamps[next_id]:  # last or last relevant price point
-                seconds_passed = (end_time - summed_until_timestamp).total_seconds()
-                summed_price += EstimationUtils.get_normalized_cost(seconds_passed, prices[sorted_price_timestamps[key_id]])
-                return summed_price
-        logger.warning("Spot estimation incomplete for %s in %s at %s/%s", inst_type, avail_zone, start_time, end_time)
-        return summed_price  # only reached if something unexpected happened
+        """Derive spot estimation from the cumulative costs at the instance's start and end times."""
+        return float(self.estimate_prices_for_periods(inst_type, avail_zone, [start_time], [end_time])[0])
@@ -10,14 +10,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Standalone script for installation."""
+"""Standalone script for installation, also builds the compact pricing indexes that the server loads."""
 import os
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from os import path, environ
 import json
 import gzip
-from typing import Set
+from typing import Set, Dict, Optional, Any, Callable, Iterator, Tuple, TextIO
 import argparse
 import requests
+if __package__ in (None, ''):  # run as a standalone script before the package is installed
+    sys.path.insert(0, path.dirname(path.dirname(path.dirname(path.abspath(__file__)))))
+from xonai_grafana.utils.logging import LoggerUtils
 
 ACTIVATED_PLATFORM = 'AWS_EMR'
 configured_platform = environ.get('ACTIVE_PLATFORM')
@@ -30,40 +38,318 @@ AWS_REGIONS = {'us-east-2', 'us-east-1', 'us-west-1', 'us-west-2', 'af-south-1',
                'eu-west-1', 'eu-west-2', 'eu-south-1', 'eu-west-3', 'eu-south-2', 'eu-north-1', 'eu-central-2', 'il-central-1', 'me-south-1',
                'me-central-1', 'sa-east-1'}
 # based on https://docs.aws.amazon.com/general/latest/gr/emr.html
+INDEX_FORMAT = 1  # bumped whenever the index layout changes, outdated indexes are ignored
+VERSIONS_FILE = 'versions.json'  # offer version URL per service & region of the last successful download
+DOWNLOAD_TIMEOUT = 300  # seconds without data before a request fails
+logger = LoggerUtils.create_logger('fetch cost info')
 
 
-def fetch_resources(regions: Set[str] = AWS_REGIONS) -> None:
-    """Method for calling APIs and writing their cost records to the local disks."""
-    region_index = requests.get(URL_BASE + '/offers/v1.0/aws/index.json').json()
-    aws_regions_response = requests.get(URL_BASE + region_index['offers']['ElasticMapReduce']['currentRegionIndexUrl']).json()
-    aws_region_urls_json = aws_regions_response['regions']
-    ec2_regions_response = requests.get(URL_BASE + region_index['offers']['AmazonEC2']['currentRegionIndexUrl']).json()
-    ec2_region_urls_json = ec2_regions_response['regions']
-    ec2_dir = os.path.join(resource_dir, 'ec2')
-    emr_dir = os.path.join(resource_dir, 'emr')
+def get_index_file(raw_file: str) -> str:
+    """Returns the path of the compact index for a raw offer file, e.g. ec2/us-east-1.index.json.gz for ec2/us-east-1.json.gz."""
+    return raw_file[:-len('.json.gz')] + '.index.json.gz'
+
+
+class OfferReader:
+    """
+        Incremental reader for AWS offer files. Objects are walked member by member while the text stream is read in chunks, so only single
+        SKU records are decoded at a time and peak memory does not depend on the file size.
+    """
+    chunk_size = 1 << 20  # characters
+
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        """Appends the next chunk to the unread part of the buffer, reads at least as much as is buffered so large values need few retries."""
+        chunk = self.stream.read(max(self.chunk_size, len(self.buffer) - self.position))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def _peek(self) -> str:
+        """Returns the next non-whitespace character without consuming it."""
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in ' \t\n\r':
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._fill():
+                raise ValueError('Unexpected end of offer file')
+
+    def _consume(self, expected: str) -> str:
+        char = self._peek()
+        if char not in expected:
+            raise ValueError(f'Offer file malformed, expected one of {expected!r} but found {char!r}')
+        self.position += 1
+        return char
+
+    def decode(self) -> Any:
+        """Decodes the next complete JSON value."""
+        while True:
+            self._peek()
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                if end < len(self.buffer) or self.eof:  # a number at the buffer end might continue in the next chunk
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def iter_members(self) -> Iterator[str]:
+        """Yields the keys of the next object, the caller consumes each member value before the iteration resumes."""
+        self._consume('{')
+        if self._peek() == '}':
+            self.position += 1
+            return
+        while True:
+            key = self.decode()
+            self._consume(':')
+            yield key
+            if self._consume(',}') == '}':
+                return
+
+    def skip_members(self) -> None:
+        """Skips the next object by decoding and dropping one member at a time."""
+        for _ in self.iter_members():
+            self.decode()
+
+
+def read_offer(offer_file: str, keep_product: Callable[[Dict], bool]) -> Tuple[Dict[str, Dict], Dict[str, Optional[float]]]:
+    """
+        Reads a gzipped offer file in one pass and returns the attributes of the kept products and their on-demand prices, both keyed by SKU.
+        Terms are filtered on the fly when they follow the products (as in AWS offer files), all on-demand prices are kept otherwise.
+    """
+    products: Dict[str, Dict] = {}
+    prices: Dict[str, Optional[float]] = {}
+    products_read = False
+    with gzip.open(offer_file, mode='rt') as f:
+        reader = OfferReader(f)
+        for key in reader.iter_members():
+            if key == 'products':
+                for sku in reader.iter_members():
+                    product = reader.decode()
+                    if keep_product(product):
+                        products[sku] = product['attributes']
+                products_read = True
+            elif key == 'terms':
+                for term_type in reader.iter_members():
+                    if term_type != 'OnDemand':  # e.g., reserved terms
+                        reader.skip_members()
+                        continue
+                    for sku in reader.iter_members():
+                        sku_terms = reader.decode()
+                        if not products_read or sku in products:
+                            prices[sku] = _get_on_demand_price(sku_terms)
+            else:
+                reader.decode()
+    return products, prices
+
+
+def _get_on_demand_price(sku_terms: Dict) -> Optional[float]:
+    """Returns the hourly on-demand USD price from the terms of a SKU, None if the offer lists more than one term."""
+    if len(sku_terms) > 1:
+        logger.warning('More than one SKU for %s', sku_terms)
+        return None
+    sku_term = next(iter(sku_terms.values()))
+    price_dimension = list(sku_term['priceDimensions'].values())[-1]
+    return float(price_dimension['pricePerUnit']['USD'])
+
+
+def _is_ec2_product(product: Dict) -> bool:
+    """Filters shared Linux instances."""
+    try:
+        attr = product['attributes']
+        return attr['tenancy'] == 'Shared' and attr['operatingSystem'] == 'Linux' and attr['operation'] == 'RunInstances' \
+            and attr['capacitystatus'] == 'Used' and 'instanceType' in attr
+    except KeyError:
+        return False
+
+
+def _is_emr_product(product: Dict) -> bool:
+    """Filters EMR surcharges."""
+    return product.get('attributes', {}).get('softwareType') == 'EMR'
+
+
+def _assemble_ec2_index(products: Dict[str, Dict], prices: Dict[str, Optional[float]]) -> Dict:
+    instance_type_info = {}
+    ec2_prices = {}
+    for sku, attr in products.items():
+        instance_type = attr['instanceType']
+        instance_type_info[instance_type] = attr
+        price = prices.get(sku)
+        if price is None:
+            continue
+        if instance_type in ec2_prices:
+            logger.warning('Instance price for %s already added', instance_type)
+            continue
+        ec2_prices[instance_type] = price
+    return {'format': INDEX_FORMAT, 'ec2_prices': ec2_prices, 'instance_type_info': instance_type_info}
+
+
+def _assemble_emr_index(products: Dict[str, Dict], prices: Dict[str, Optional[float]]) -> Dict:
+    emr_prices = {}
+    for sku, attr in products.items():
+        if prices.get(sku) is not None:
+            emr_prices[attr['instanceType']] = prices[sku]
+    return {'format': INDEX_FORMAT, 'emr_prices': emr_prices}
+
+
+def _select_offer(offer: Dict, keep_product: Callable[[Dict], bool]) -> Tuple[Dict[str, Dict], Dict[str, Optional[float]]]:
+    """Same as :func:`read_offer` for an offer that has already been parsed."""
+    products = {sku: product['attributes'] for sku, product in offer['products'].items() if keep_product(product)}
+    on_demand_terms = offer['terms']['OnDemand']
+    return products, {sku: _get_on_demand_price(on_demand_terms[sku]) for sku in products if sku in on_demand_terms}
+
+
+def build_ec2_index(offer: Dict) -> Dict:
+    """Extracts the prices and attributes of shared Linux instances from a parsed EC2 offer."""
+    return _assemble_ec2_index(*_select_offer(offer, _is_ec2_product))
+
+
+def build_emr_index(offer: Dict) -> Dict:
+    """Extracts the EMR surcharges per instance type from a parsed EMR offer."""
+    return _assemble_emr_index(*_select_offer(offer, _is_emr_product))
+
+
+def stream_ec2_index(offer_file: str) -> Dict:
+    """Extracts the prices and attributes of shared Linux instances from a gzipped EC2 offer file with bounded memory."""
+    return _assemble_ec2_index(*read_offer(offer_file, _is_ec2_product))
+
+
+def stream_emr_index(offer_file: str) -> Dict:
+    """Extracts the EMR surcharges per instance type from a gzipped EMR offer file with bounded memory."""
+    return _assemble_emr_index(*read_offer(offer_file, _is_emr_product))
+
+
+@contextmanager
+def _replace_atomically(target_file: str) -> Iterator[str]:
+    """Yields a temporary path next to the target file that replaces the target in one rename, readers never see half-written files."""
+    file_descriptor, temp_file = tempfile.mkstemp(dir=path.dirname(target_file) or '.', prefix='.' + path.basename(target_file), suffix='.tmp')
+    os.close(file_descriptor)
+    try:
+        yield temp_file
+        os.replace(temp_file, target_file)
+    finally:
+        if path.exists(temp_file):
+            os.remove(temp_file)
+
+
+def write_index(index: Dict, index_file: str) -> None:
+    """Writes a compact index next to its raw offer file."""
+    with _replace_atomically(index_file) as temp_file:
+        with gzip.open(temp_file, 'wb') as f:
+            f.write(json.dumps(index, separators=(',', ':')).encode())
+
+
+def read_index(index_file: str) -> Optional[Dict]:
+    """Returns a compact index, None if it was written in an outdated format."""
+    with gzip.open(index_file, mode='rt') as f:
+        index = json.loads(f.read())
+    return index if index.get('format') == INDEX_FORMAT else None
+
+
+def index_existing_files(regions: Set[str]) -> None:
+    """Builds the compact indexes from previously downloaded offer files."""
     for aws_region in regions:
-        print(f'--------------- {aws_region}')
-        if ACTIVATED_PLATFORM == 'AWS_EMR':
-            print(f'Writing EMR resource file for region {aws_region}')
-            emr_region_url = URL_BASE + aws_region_urls_json[aws_region]['currentVersionUrl']
-            region_info_emr = json.dumps(requests.get(emr_region_url).json())
-            emr_file = os.path.join(emr_dir, aws_region + '.json.gz')
-            with gzip.open(emr_file, "wb") as f:
-                f.write(region_info_emr.encode())
-            print(f'Completed writing EMR file for region {aws_region} to {emr_file}')
-        print(f'Writing EC2 resource file for region {aws_region} (more time-consuming than its EMR counterpart)')
-        ec2_region_url = URL_BASE + ec2_region_urls_json[aws_region]['currentVersionUrl']
-        region_info_ec2 = json.dumps(requests.get(ec2_region_url).json())
-        ec2_file = os.path.join(ec2_dir, aws_region + '.json.gz')
-        with gzip.open(ec2_file, 'wb') as f:
-            f.write(region_info_ec2.encode())
-        print(f'Completed writing EC2 file for region {aws_region} to {ec2_file}')
-        print('---------------')
+        for service, stream_index in (('emr', stream_emr_index), ('ec2', stream_ec2_index)):
+            raw_file = os.path.join(resource_dir, service, aws_region + '.json.gz')
+            if not path.exists(raw_file):
+                continue
+            write_index(stream_index(raw_file), get_index_file(raw_file))
+            print(f'Completed writing index for {raw_file}')
+
+
+def read_versions() -> Dict[str, str]:
+    """Returns the offer version URLs of previous downloads, keyed by service/region."""
+    versions_file = path.join(resource_dir, VERSIONS_FILE)
+    if not path.exists(versions_file):
+        return {}
+    with open(versions_file) as f:
+        return json.load(f)
+
+
+def write_versions(versions: Dict[str, str]) -> None:
+    with _replace_atomically(path.join(resource_dir, VERSIONS_FILE)) as temp_file:
+        with open(temp_file, 'w') as f:
+            json.dump(versions, f, indent=1, sort_keys=True)
+
+
+def download_offer(offer_url: str, offer_file: str, stream_index: Callable[[str], Dict]) -> None:
+    """
+        Streams an offer into a gzip file without parsing it, then builds its compact index from the written file. The index is moved into
+        place before the offer and is not older than it, so readers never pick up an offer without its matching index.
+    """
+    with _replace_atomically(offer_file) as temp_file:
+        with requests.get(offer_url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            with gzip.open(temp_file, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1 << 20):
+                    f.write(chunk)
+        write_index(stream_index(temp_file), get_index_file(offer_file))
+
+
+def fetch_resources(regions: Set[str] = AWS_REGIONS, workers: int = 4, force: bool = False) -> None:
+    """
+        Method for calling APIs and writing their cost records to the local disks. Regions are downloaded concurrently, offers whose version
+        was downloaded before are skipped unless forced.
+    """
+    region_index = requests.get(URL_BASE + '/offers/v1.0/aws/index.json', timeout=DOWNLOAD_TIMEOUT).json()
+    services = [('ec2', 'AmazonEC2', stream_ec2_index)]
+    if ACTIVATED_PLATFORM == 'AWS_EMR':
+        services.append(('emr', 'ElasticMapReduce', stream_emr_index))
+    versions = read_versions()
+    versions_lock = threading.Lock()
+    downloads = []
+    for service, offer_code, stream_index in services:
+        region_urls_json = requests.get(URL_BASE + region_index['offers'][offer_code]['currentRegionIndexUrl'], timeout=DOWNLOAD_TIMEOUT).json()['regions']
+        for aws_region in sorted(regions):
+            if aws_region not in region_urls_json:
+                print(f'No {service.upper()} offer for region {aws_region}, skipping')
+                continue
+            version_url = region_urls_json[aws_region]['currentVersionUrl']
+            offer_file = os.path.join(resource_dir, service, aws_region + '.json.gz')
+            version_key = f'{service}/{aws_region}'
+            if not force and versions.get(version_key) == version_url and path.exists(offer_file) and path.exists(get_index_file(offer_file)):
+                print(f'{service.upper()} file for region {aws_region} is up to date, skipping')
+                continue
+            downloads.append((version_key, version_url, offer_file, stream_index))
+
+    def download(version_key: str, version_url: str, offer_file: str, stream_index: Callable[[str], Dict]) -> None:
+        print(f'Writing {version_key} resource file')
+        download_offer(URL_BASE + version_url, offer_file, stream_index)
+        with versions_lock:
+            versions[version_key] = version_url
+            write_versions(versions)
+        print(f'Completed writing {version_key} resource file to {offer_file}')
+
+    failures = 0
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = {executor.submit(download, *download_args): download_args[0] for download_args in downloads}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                failures += 1
+                print(f'Downloading {futures[future]} failed: {e}')
+    if failures > 0:
+        raise RuntimeError(f'{failures} resource file(s) could not be downloaded')
 
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Standalone script for fetching cost info")
     parser.add_argument("regions", nargs='?', help="comma separated list of AWS regions", default='*')
+    parser.add_argument("--index-only", action='store_true', help="only build the compact indexes from previously downloaded files")
+    parser.add_argument("--workers", type=int, default=4, help="number of concurrent downloads")
+    parser.add_argument("--force", action='store_true', help="download offers again even if their version has not changed")
     args = parser.parse_args()
     region_arg: str = args.regions.strip()
     relevant_regions: Set[str] = set()
@@ -78,8 +364,11 @@ def main() -> None:
                 print(f'Supplied region {supplied_string} not a known region, skipping')
     if len(relevant_regions) == 0:
         print(f'No valid region supplied ({region_arg}), exiting')
+    if args.index_only:
+        index_existing_files(relevant_regions)
+        return
     print(f'Running fetch_cost_info.py for platform {ACTIVATED_PLATFORM}, downloading resources for regions {relevant_regions}')
-    fetch_resources(relevant_regions)
+    fetch_resources(relevant_regions, args.workers, args.force)
     print(f'Finished downloading resources for the following regions: {relevant_regions}')
 
 
@@ -0,0 +1,98 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module containing the persistent store for spot price histories."""
+import sqlite3
+import threading
+from typing import Dict, List, Tuple
+
+"""Type aliases."""
+Interval = Tuple[int, int]  # epoch microseconds, start inclusive & end exclusive
+MicrosHistory = Dict[int, float]  # epoch microseconds to hourly spot price
+
+
+class SpotPriceStore:
+    """
+        Persists spot price histories and the time intervals they cover per instance type & availability zone in a local SQLite file,
+        so restarts and repeated estimations do not call ec2:DescribeSpotPriceHistory again. Safe to share between threads.
+    """
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self._connection = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)  # transactions are explicit
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connection.execute('PRAGMA journal_mode=WAL')  # readers in other processes are not blocked by writes
+            self._connection.execute('CREATE TABLE IF NOT EXISTS spot_prices (instance_type TEXT, avail_zone TEXT, timestamp INTEGER, price REAL, '
+                                     'PRIMARY KEY (instance_type, avail_zone, timestamp)) WITHOUT ROWID')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS spot_coverage (instance_type TEXT, avail_zone TEXT, start INTEGER, end INTEGER, '
+                                     'PRIMARY KEY (instance_type, avail_zone, start)) WITHOUT ROWID')
+
+    def load(self, inst_type: str, avail_zone: str) -> Tuple[MicrosHistory, List[Interval]]:
+        """Returns the stored prices and covered intervals of an instance type in an availability zone."""
+        with self._lock:
+            prices = self._connection.execute('SELECT timestamp, price FROM spot_prices WHERE instance_type = ? AND avail_zone = ?',
+                                              (inst_type, avail_zone)).fetchall()
+            intervals = self._connection.execute('SELECT start, end FROM spot_coverage WHERE instance_type = ? AND avail_zone = ? ORDER BY start',
+                                                 (inst_type, avail_zone)).fetchall()
+        return dict(prices), [(start, end) for (start, end) in intervals]
+
+    def save(self, inst_type: str, avail_zone: str, prices: MicrosHistory, intervals: List[Interval]) -> None:
+        """Adds fetched prices and replaces the covered intervals in one transaction."""
+        with self._lock:
+            try:
+                self._connection.execute('BEGIN')
+                self._connection.executemany('INSERT OR REPLACE INTO spot_prices VALUES (?, ?, ?, ?)',
+                                             [(inst_type, avail_zone, timestamp, price) for timestamp, price in prices.items()])
+                self._connection.execute('DELETE FROM spot_coverage WHERE instance_type = ? AND avail_zone = ?', (inst_type, avail_zone))
+                self._connection.executemany('INSERT INTO spot_coverage VALUES (?, ?, ?, ?)',
+                                             [(inst_type, avail_zone, start, end) for (start, end) in intervals])
+                self._connection.execute('COMMIT')
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    @classmethod
+    def merge_intervals(cls, intervals: List[Interval]) -> List[Interval]:
+        """Returns sorted, non-overlapping intervals, touching intervals are joined."""
+        merged: List[Interval] = []
+        for (start, end) in sorted(intervals):
+            if len(merged) > 0 and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    @classmethod
+    def get_missing_intervals(cls, covered: List[Interval], start: int, end: int, min_length: int = 0) -> List[Interval]:
+        """
+            Returns the sub-intervals of [start, end) that the sorted, merged intervals do not cover. Gaps shorter than min_length are ignored
+            if they border covered intervals, e.g. the last minutes of running clusters, windows without any coverage are always returned.
+        """
+        missing: List[Interval] = []
+        current = start
+        for (covered_start, covered_end) in covered:
+            if covered_end <= current:
+                continue
+            if covered_start >= end:
+                break
+            if covered_start > current:
+                missing.append((current, covered_start))
+            current = max(current, covered_end)
+        if current < end:
+            missing.append((current, end))
+        covered_bounds = {bound for interval in covered for bound in interval}
+        return [(missing_start, missing_end) for (missing_start, missing_end) in missing
+                if missing_end - missing_start >= min_length or (missing_start not in covered_bounds and missing_end not in covered_bounds)]
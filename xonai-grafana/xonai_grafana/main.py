@@ -11,23 +11,39 @@
 # limitations under the License.
 
 """Module containing the Grafana query endpoints."""
-from typing import List, Dict, Tuple, Set, Iterator
-from fastapi import FastAPI, status, Depends
+import json
+from contextlib import asynccontextmanager
+from time import perf_counter
+from typing import List, Dict, Tuple, Set, Iterator, Optional
+from fastapi import FastAPI, status, Depends, Response
 from dateutil.parser import parse
 from starlette.middleware.cors import CORSMiddleware
 from databricks.sdk.service.compute import ClusterDetails
-from xonai_grafana.cost_estimation.estimator import DbxClusterType
+from xonai_grafana.cost_estimation.estimator import DbxClusterType, PricingWatcher
 from xonai_grafana.schemata.cloud_objects import DescribedEmrCluster, SupportedPlatforms, DbxCluster
 from xonai_grafana.schemata.grafana_objects import GrafanaTables, PanelType, TableResponse, Query, Target, ClusterData, VariableQuery
+from xonai_grafana.utils.caching import SingleFlight
 from xonai_grafana.utils.dependencies import Inject, get_cloud_env
 from xonai_grafana.utils.logging import LoggerUtils
+from xonai_grafana.utils import metrics
 from xonai_grafana.utils.tsdb import TsdbUtils, QueryType, MaxAvg, IdPair
+from xonai_grafana.utils.tsdb_client import get_int_env
 from xonai_grafana.utils.cloud import DbxUtils, EmrUtils, CostMap, ClusterUtils
 
 logger = LoggerUtils.create_logger(__name__)
-active_region, activated_platform = get_cloud_env()  # active_region is global, used and maybe reset in main loop
-logger.info('Launching UI server for %s with initial region %s', activated_platform, active_region)
-app = FastAPI()  # main application object
+initial_region, activated_platform = get_cloud_env()  # dashboards select other regions per request
+logger.info('Launching UI server for %s with initial region %s', activated_platform, initial_region)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    """Polls for refreshed resource files while the server runs."""
+    pricing_watcher.start()
+    yield
+    pricing_watcher.stop()
+
+
+app = FastAPI(lifespan=lifespan)  # main application object
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000"],  # default Grafana port
@@ -35,7 +51,10 @@ app.add_middleware(
     allow_headers=["*"],
     allow_methods=["*"],
 )
-injection = Inject(active_region, activated_platform)  # embeds caches and cloud/database clients
+injection = Inject(initial_region, activated_platform)  # embeds caches and cloud/database clients
+panel_flights = SingleFlight()  # identical panel queries that arrive concurrently share one computation
+panel_values = {panel.value for panel in PanelType}
+pricing_watcher = PricingWatcher(injection.pricing_registry, interval=get_int_env('XONAI_PRICING_RELOAD_SEC', 60))  # started by the lifespan handler
 
 
 def get_dependencies() -> Inject:
@@ -67,6 +86,11 @@ def return_payload_options():
     return []
 
 
+def get_panel_label(target_panel: str) -> str:
+    """Returns the metric label for a panel target, unknown targets share one label."""
+    return target_panel if target_panel in panel_values else 'unknown'
+
+
 @app.post("/query", response_model=List[TableResponse], status_code=status.HTTP_200_OK)
 def main_loop(query: Query, inj: Inject = Depends(get_dependencies)):
     """
@@ -74,12 +98,26 @@ def main_loop(query: Query, inj: Inject = Depends(get_dependencies)):
         Determines execution path by pattern matching the supplied panel target argument against :class:`PanelType`.
         Grafana query payloads are automatically parsed as :class:`Query`.
         Returns a single element list of JSON objects corresponding to :class:`TableResponse`.
+        Concurrent identical queries (e.g., several viewers of the same board) are coalesced into one computation.
     """
-    response: List[TableResponse] = []
     if len(query.targets) == 0:
-        return response
+        return []
+    target: Target = query.targets[0]
+    try:
+        normalized_range = (TsdbUtils.convert_to_unixs(query.range['from']), TsdbUtils.convert_to_unixs(query.range['to']))
+    except Exception:  # malformed ranges are reported by the panel computation
+        normalized_range = (str(query.range.get('from')), str(query.range.get('to')))
+    flight_key = (target.target, normalized_range, json.dumps(target.payload, sort_keys=True))
+    start = perf_counter()
+    response = list(panel_flights.run(flight_key, lambda: compute_panel(query, inj)))
+    metrics.panel_latency.labels(get_panel_label(target.target)).observe(perf_counter() - start)
+    return response
+
+
+def compute_panel(query: Query, inj: Inject) -> List[TableResponse]:
+    """Computes the response of the main loop for the first panel target."""
+    response: List[TableResponse] = []
     target: Target = query.targets[0]
-    global active_region
     try:
         target_panel = target.target
         start_string = query.range['from']  # e.g., 2024-02-02T13:12:52.121Z
@@ -106,11 +144,8 @@ def main_loop(query: Query, inj: Inject = Depends(get_dependencies)):
                     cluster_types.add(str(cluster_type))
                 response.append(TableResponse(rows=[[', '.join(cluster_types)]], columns=[{"text": " ", "type": "string"}]))
             return response
-        selected_region = target.payload['region']  # region relevant for all panels below
-        if active_region != selected_region:  # region change via drop-down list
-            logger.debug('Active region was %s, selected region is %s now', active_region, selected_region)
-            active_region = selected_region
-            inj.reinitialize(active_region)
+        selected_region = target.payload['region']  # region relevant for all panels below, selected via drop-down list
+        inj = inj.for_region(selected_region)
         if target_panel == PanelType.INSTANCEINFO:  # ec2 instance type panel
             instance_type: str = target.payload["instance_type"]
             instance_type = instance_type.replace('\\', '')  # Sometimes flaky dot encoding by Grafana
@@ -138,14 +173,11 @@ def main_loop(query: Query, inj: Inject = Depends(get_dependencies)):
             cost_list: List[CostMap] = []
             utilization_list: List[Tuple[MaxAvg, MaxAvg]] = []
             if activated_platform is SupportedPlatforms.AWS_EMR:
-                cluster_list: List[DescribedEmrCluster] = list(EmrUtils.get_cluster_descriptions(inj, start_string, end_string))
+                cluster_list: List[DescribedEmrCluster] = EmrUtils.get_cluster_descriptions(inj, start_string, end_string)
                 inj.tsdb_client.fill_api_gaps(cluster_list, start_sec, end_sec, activated_platform)  # fill potential API gaps
-                for cluster in cluster_list:
-                    if 'skip_costs' not in target.payload:
-                        cluster_cost = EmrUtils.check_cost_cache(cluster.Id, inj)
-                        cost_list.append(cluster_cost)
-                    utilizations: Tuple[MaxAvg, MaxAvg] = inj.tsdb_client.get_cluster_utilizations(cluster)
-                    utilization_list.append(utilizations)
+                if 'skip_costs' not in target.payload:
+                    cost_list = EmrUtils.get_costs([cluster.Id for cluster in cluster_list], inj)  # same order as cluster_list
+                utilization_list = inj.tsdb_client.get_clusters_utilizations(cluster_list)
                 if 'skip_costs' not in target.payload:
                     response.append(GrafanaTables.get_emr_clist_table(cluster_list, utilization_list, cost_list))
                 else:
@@ -156,7 +188,7 @@ def main_loop(query: Query, inj: Inject = Depends(get_dependencies)):
                 inj.tsdb_client.fill_api_gaps(relevant_details, start_sec, end_sec, activated_platform)  # fill potential API gaps
                 for cluster_detail in relevant_details:
                     cost_list.append(DbxUtils.estimate_costs(start_sec, end_sec, cluster_detail.Id, query.get_plan(), inj))
-                    utilization_list.append(inj.tsdb_client.get_cluster_utilizations(cluster_detail))
+                utilization_list = inj.tsdb_client.get_clusters_utilizations(relevant_details)
                 response.append(GrafanaTables.get_dbx_clist_table(relevant_details, cost_list, utilization_list))
             return response
         if target_panel in (PanelType.APPLIST, PanelType.COMPCOSTS, PanelType.COMPUTIL):  # general overview boards
@@ -205,6 +237,7 @@ def main_loop(query: Query, inj: Inject = Depends(get_dependencies)):
             return response
     except Exception:  # all uncaught exceptions (client errors) in helper methods
         logger.exception('Uncaught exception in main loop occurred')
+        metrics.panel_errors.labels(get_panel_label(target.target)).inc()
     return response
 
 
@@ -217,17 +250,12 @@ def main_loop(query: Query, inj: Inject = Depends(get_dependencies)):
 @app.post("/variable")
 def return_variable(query: VariableQuery, inj: Inject = Depends(get_dependencies)):
     """Endpoint for variable call from Grafana, returns a list of cluster ids."""
-    global active_region
     selected_region = query.payload['region']
     created_after = parse(query.range['from'])
     created_before = parse(query.range['to'])
     payload = []
-    kwargs = {'CreatedAfter': created_after, 'CreatedBefore': created_before}
-    if active_region != selected_region:  # region change via drop-down list
-        logger.debug('Active region was %s, selected region is %s now', active_region, selected_region)
-        active_region = selected_region
-        inj.reinitialize(active_region)
-    cluster_ids = EmrUtils.get_cluster_ids(inj.client_emr, kwargs)
+    inj = inj.for_region(selected_region)  # region selected via drop-down list
+    cluster_ids = EmrUtils.get_cluster_ids(inj, created_after, created_before)  # listing is shared with the cluster list panel
     for cluster_id in cluster_ids:
         payload.append({"__text": cluster_id})
     return payload
@@ -245,6 +273,18 @@ def return_tag_values():
     pass
 
 
+@app.get("/internal/metrics", status_code=status.HTTP_200_OK)
+def return_internal_metrics():
+    """Endpoint for scraping the server's own latency, call count, and cache metrics in Prometheus format."""
+    return Response(content=metrics.get_exposition(), media_type=metrics.content_type)
+
+
+@app.post("/internal/reload-pricing", status_code=status.HTTP_202_ACCEPTED)
+def reload_pricing(region: Optional[str] = None):
+    """Endpoint for reloading the pricing info of one or all resident regions in the background, e.g. after running fetch_cost_info.py."""
+    return {'regions': injection.pricing_registry.reload(None if region is None else [region])}
+
+
 @app.post("/test", status_code=status.HTTP_200_OK)
 def test_connection_expl(query_arg: Dict):
     """Custom test endpoint."""
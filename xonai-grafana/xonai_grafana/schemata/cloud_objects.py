@@ -52,12 +52,14 @@ class AllClusters:
 
 class Ec2Instance:
     """Represents an EC2 instance, used for cost calculations."""
-    def __init__(self, creation_ts, termination_ts, instance_type, market_type, ebs_volumes):
+    def __init__(self, creation_ts, termination_ts, instance_type, market_type, ebs_volumes, instance_id: Optional[str] = None, has_ended: bool = True):
         self.creation_ts = creation_ts  # EMR instance group param, correlates to EC2 instance startup time
-        self.termination_ts = termination_ts
+        self.termination_ts = termination_ts  # current time for running instances
         self.instance_type = instance_type
         self.market_type = market_type
         self.ebs_volumes = ebs_volumes
+        self.instance_id = instance_id  # EMR instance ID
+        self.has_ended = has_ended
 
 
 class InstanceResGroup:
@@ -85,6 +87,10 @@ class ClusterStatus(BaseModel):
     Timeline: ClusterTimeline
 
 
+class ClusterInstanceAttributes(BaseModel):
+    Ec2AvailabilityZone: Optional[str] = None
+
+
 class ListedCluster(BaseModel):
     """Domain object for list_clusters AWS API calls."""
     Id: str
@@ -104,6 +110,16 @@ class DescribedEmrCluster(ListedCluster):
     """Domain object for describe_cluster AWS API calls."""
     ReleaseLabel: str
     Tags: List[Dict]
+    Ec2InstanceAttributes: Optional[ClusterInstanceAttributes] = None  # absent in dummies & descriptions cached by earlier versions
+    InstanceCollectionType: Optional[str] = None  # INSTANCE_GROUP | INSTANCE_FLEET, absent like the instance attributes
+
+    def get_avail_zone(self) -> Optional[str]:
+        return None if self.Ec2InstanceAttributes is None else self.Ec2InstanceAttributes.Ec2AvailabilityZone
+
+    def with_listing(self, listed_cluster: ListedCluster) -> Self:
+        """Returns a copy with the state, timeline, and instance hours of a more recent list_clusters response."""
+        return self.model_copy(update={'Name': listed_cluster.Name, 'Status': listed_cluster.Status,
+                                       'NormalizedInstanceHours': listed_cluster.NormalizedInstanceHours})
 
     def _flatten_tags(self) -> List[List[str]]:
         """Flatten cluster tags for display in dashboard table."""
@@ -207,7 +223,3 @@ class DbxCluster:
         start_redir = AllClusters.get_redirect_ms(first)
         end_redir = AllClusters.get_redirect_ms(last, False, offset=240000)
         return DbxCluster((cluster_id, '', 'TERMINATED', first, start_redir, last, end_redir, 'NA', 'NA', 'NA'))
-
-
-"""Type aliases."""
-ClusterCache = Dict[str, DescribedEmrCluster]
@@ -0,0 +1,106 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import tempfile
+import threading
+import time
+import unittest
+from os import path
+from xonai_grafana.utils.caching import LruCache, SingleFlight, PersistentCache
+
+
+class LruCacheTestCase(unittest.TestCase):
+    def test_weight_bound(self):
+        cache = LruCache(10)
+        cache.put('a', 1, weight=4)
+        cache.put('b', 2, weight=4)
+        self.assertEqual(cache.get('a'), 1)  # b is now least recently used
+        cache.put('c', 3, weight=4)
+        self.assertNotIn('b', cache)
+        self.assertEqual((cache.get('a'), cache.get('c'), cache.weight, cache.evictions), (1, 3, 8, 1))
+        cache.put('d', 4, weight=11)  # larger than the cache
+        self.assertNotIn('d', cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_expiry(self):
+        cache = LruCache(10)
+        cache.put('a', 1, ttl=0)
+        cache.put('b', 2, ttl=60)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual((cache.hits, cache.misses, cache.weight), (1, 1, 1))
+        self.assertAlmostEqual(cache.get_hit_ratio(), 0.5)
+        self.assertFalse(cache.replace('a', 3))  # expired
+        self.assertTrue(cache.replace('b', 3))  # keeps weight & expiry
+        self.assertEqual((cache.get('b'), cache.weight), (3, 1))
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def test_coalescing(self):
+        flights = SingleFlight()
+        calls = []
+        release = threading.Event()
+
+        def compute():
+            calls.append(1)
+            release.wait(5)
+            return ['table']
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flights.run(('panel', 1, 2), compute))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        while flights.coalesced < 3:  # all followers joined the leader
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [['table']] * 4)
+        self.assertEqual(flights.run(('panel', 1, 2), lambda: ['new']), ['new'])  # finished flights are not cached
+
+    def test_shared_error(self):
+        flights = SingleFlight()
+        with self.assertRaises(ValueError):
+            flights.run('key', lambda: int('x'))
+        self.assertEqual(flights.run('key', lambda: 1), 1)
+
+
+class PersistentCacheTestCase(unittest.TestCase):
+    def test_two_tiers(self):
+        with tempfile.TemporaryDirectory() as db_path:
+            db_file = path.join(db_path, 'cache.db')
+            cache = PersistentCache('cluster_costs', 2, db_file, json.dumps, json.loads)
+            for cluster_id in ('j-1', 'j-2', 'j-3'):
+                cache[cluster_id] = {'MASTER.EC2': 1.5, 'TOTAL': 1.5}
+            self.assertEqual(len(cache.memory), 2)  # bounded in memory
+            self.assertNotIn('j-1', cache.memory)
+            self.assertIn('j-1', cache)  # found on disk without deserializing
+            self.assertNotIn('j-1', cache.memory)
+            self.assertEqual(cache.get('j-1'), {'MASTER.EC2': 1.5, 'TOTAL': 1.5})  # loaded from disk and promoted
+            self.assertIn('j-1', cache.memory)
+            self.assertNotIn('j-4', cache)
+            with self.assertRaises(KeyError):
+                _ = cache['j-4']
+            other_process_cache = PersistentCache('cluster_costs', 2, db_file, json.dumps, json.loads)  # e.g., after a restart
+            self.assertEqual(other_process_cache['j-3'], {'MASTER.EC2': 1.5, 'TOTAL': 1.5})
+            cache.close()
+            other_process_cache.close()
+        memory_cache = PersistentCache('cluster_costs', 2, None, json.dumps, json.loads)
+        memory_cache['j-1'] = {}
+        self.assertEqual(memory_cache.get('j-1'), {})
+        with self.assertRaises(ValueError):
+            PersistentCache('costs; DROP TABLE x', 2, None, json.dumps, json.loads)
+
+
+if __name__ == '__main__':
+    unittest.main()
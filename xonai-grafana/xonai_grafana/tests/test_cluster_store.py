@@ -0,0 +1,89 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import unittest
+from datetime import datetime, timezone
+from unittest.mock import MagicMock
+from xonai_grafana.cost_estimation.estimator import EmrCostEstimator
+from xonai_grafana.schemata.cloud_objects import DescribedEmrCluster
+from xonai_grafana.utils.caching import PersistentCache
+from xonai_grafana.utils.cluster_store import ClusterMetadataStore
+
+
+class ClusterStoreTestCase(unittest.TestCase):
+    @staticmethod
+    def get_emr_client(states: dict) -> MagicMock:
+        def get_status(cluster_id: str) -> dict:
+            timeline = {'CreationDateTime': datetime(2024, 3, 1, tzinfo=timezone.utc)}
+            if 'TERMINATED' in states[cluster_id]:
+                timeline['EndDateTime'] = datetime(2024, 3, 2, tzinfo=timezone.utc)
+            return {'State': states[cluster_id], 'Timeline': timeline}
+        emr_client = MagicMock()
+        emr_client.meta.region_name = 'us-east-1'
+        emr_client.list_clusters.side_effect = lambda **kwargs: {'Clusters': [
+            {'Id': cluster_id, 'Name': cluster_id, 'Status': get_status(cluster_id), 'NormalizedInstanceHours': 8} for cluster_id in states]}
+        emr_client.describe_cluster.side_effect = lambda ClusterId: {'Cluster': {
+            'Id': ClusterId, 'Name': ClusterId, 'Status': get_status(ClusterId), 'NormalizedInstanceHours': 4, 'ReleaseLabel': 'emr-7.0.0',
+            'Tags': [{'Key': 'team', 'Value': 'data'}], 'Ec2InstanceAttributes': {'Ec2AvailabilityZone': 'us-east-1a', 'Ec2SubnetId': 'subnet-1'}}}
+        return emr_client
+
+    def test_listed_descriptions(self):
+        states = {'j-1': 'RUNNING', 'j-2': 'TERMINATED', 'j-3': 'WAITING'}
+        emr_client = self.get_emr_client(states)
+        store = ClusterMetadataStore(PersistentCache('cluster_descriptions', 100, None, DescribedEmrCluster.model_dump_json,
+                                                     DescribedEmrCluster.model_validate_json))
+        (created_after, created_before) = (datetime(2024, 3, 1, tzinfo=timezone.utc), datetime(2024, 3, 3, tzinfo=timezone.utc))
+        listed_clusters = store.list_clusters(emr_client, created_after, created_before)
+        self.assertEqual(store.list_clusters(emr_client, created_after, created_before), listed_clusters)  # listing is reused
+        self.assertEqual(emr_client.list_clusters.call_count, 1)
+        cluster_descs = store.describe_listed(emr_client, listed_clusters)
+        self.assertEqual([cluster_desc.Id for cluster_desc in cluster_descs], ['j-1', 'j-2', 'j-3'])
+        self.assertEqual(emr_client.describe_cluster.call_count, 3)
+        self.assertEqual(cluster_descs[0].NormalizedInstanceHours, 8)  # taken from the listing
+        self.assertEqual(cluster_descs[0].Tags, [{'Key': 'team', 'Value': 'data'}])
+        self.assertIn('j-2', store.cluster_cache)
+        states['j-1'] = 'TERMINATED'
+        store.listings.clear()
+        cluster_descs = store.describe_listed(emr_client, store.list_clusters(emr_client, created_after, created_before))
+        self.assertEqual(emr_client.describe_cluster.call_count, 3)  # tags are known, state comes from the listing
+        self.assertEqual(cluster_descs[0].Status.State, 'TERMINATED')
+        self.assertEqual(store.cluster_cache['j-1'].get_avail_zone(), 'us-east-1a')
+        estimator = EmrCostEstimator(emr_client, MagicMock(), 'us-east-1', cluster_store=store)
+        self.assertEqual(estimator._get_avail_zone('j-3'), 'us-east-1a')
+        self.assertEqual(emr_client.describe_cluster.call_count, 3)  # described by the panel before
+        store.cluster_cache['j-4'] = DescribedEmrCluster.create_dummy('j-4', created_after, created_before)
+        states['j-4'] = 'TERMINATED'
+        self.assertEqual(estimator._get_avail_zone('j-4'), 'us-east-1a')  # described again, the cached description lacks the zone
+        self.assertEqual(store.describe_all(emr_client, ['j-4', 'j-2', 'j-4'])[0].ReleaseLabel, 'emr-7.0.0')
+        self.assertEqual(emr_client.describe_cluster.call_count, 4)
+
+    def test_active_expiry(self):
+        states = {'j-1': 'RUNNING', 'j-2': 'TERMINATED'}
+        emr_client = self.get_emr_client(states)
+        store = ClusterMetadataStore(PersistentCache('cluster_descriptions', 100, None, DescribedEmrCluster.model_dump_json,
+                                                     DescribedEmrCluster.model_validate_json))
+        store.active_ttl = 0.2
+        (created_after, created_before) = (datetime(2024, 3, 1, tzinfo=timezone.utc), datetime(2024, 3, 3, tzinfo=timezone.utc))
+        store.describe_listed(emr_client, store.list_clusters(emr_client, created_after, created_before))
+        self.assertEqual(emr_client.describe_cluster.call_count, 2)
+        time.sleep(0.12)
+        store.describe_listed(emr_client, store.list_clusters(emr_client, created_after, created_before))  # listing does not renew the TTL
+        self.assertEqual(emr_client.describe_cluster.call_count, 2)
+        time.sleep(0.12)
+        cluster_descs = store.describe_listed(emr_client, store.list_clusters(emr_client, created_after, created_before))
+        self.assertEqual(emr_client.describe_cluster.call_count, 3)  # active description expired
+        self.assertEqual(cluster_descs[0].NormalizedInstanceHours, 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,9 +10,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import MagicMock
 
+from xonai_grafana.schemata.cloud_objects import SupportedPlatforms
 from xonai_grafana.tests.utilities import TestUtils
+from xonai_grafana.utils.caching import LruCache, PersistentCache, SingleFlight
+from xonai_grafana.utils.cluster_store import ClusterMetadataStore
 from xonai_grafana.utils.cloud import EmrUtils, ClusterUtils
 
 
@@ -45,5 +55,57 @@ class EmrUtilsTestCase(unittest.TestCase):
         self.assertEqual(added_costs['CORE.EBS'], 14.0)
 
 
+    def test_concurrent_costs(self):
+        running_estimations = []
+        max_running = [0]
+        lock = threading.Lock()
+
+        def estimate_cluster_cost(cluster_id):
+            with lock:
+                running_estimations.append(cluster_id)
+                max_running[0] = max(max_running[0], len(running_estimations))
+            time.sleep(0.05)
+            with lock:
+                running_estimations.remove(cluster_id)
+            return {'TOTAL': float(cluster_id[2:])}
+        emr_client = MagicMock()
+        emr_client.describe_cluster.side_effect = lambda ClusterId: {'Cluster': {
+            'Id': ClusterId, 'Name': ClusterId, 'NormalizedInstanceHours': 1, 'ReleaseLabel': 'emr-7.0.0', 'Tags': [],
+            'Status': {'State': 'TERMINATED', 'Timeline': {'CreationDateTime': datetime(2024, 3, 1), 'EndDateTime': datetime(2024, 3, 2)}}}}
+        calc = MagicMock()
+        calc.estimate_cluster_cost.side_effect = estimate_cluster_cost
+        cluster_store = ClusterMetadataStore(PersistentCache('cluster_descriptions', 100, None, str, str))
+        inj = SimpleNamespace(client_emr=emr_client, calc=calc, cost_cache=PersistentCache('cluster_costs', 100, None, json.dumps, json.loads),
+                              cluster_store=cluster_store, cost_executor=ThreadPoolExecutor(4), cost_flights=SingleFlight(),
+                              instance_cost_cache=LruCache(100))
+        inj.cost_cache['j-3'] = {'TOTAL': 30.0}
+        cluster_ids = [f'j-{cluster_id}' for cluster_id in range(12)] + ['j-5']
+        costs = EmrUtils.get_costs(cluster_ids, inj)
+        self.assertEqual([cost['TOTAL'] for cost in costs], [0.0, 1.0, 2.0, 30.0] + [float(cluster_id) for cluster_id in range(4, 12)] + [5.0])
+        self.assertEqual(calc.estimate_cluster_cost.call_count, 11)  # cached and duplicate clusters are not estimated
+        self.assertGreater(max_running[0], 1)
+        self.assertLessEqual(max_running[0], 4)  # bounded by the pool
+        self.assertEqual(EmrUtils.get_costs(cluster_ids, inj), costs)  # terminated clusters are now cached
+        self.assertEqual(calc.estimate_cluster_cost.call_count, 11)
+        inj.cost_executor.shutdown()
+
+
+class ClusterUtilsTestCase(unittest.TestCase):
+    def test_active_ids_cache(self):
+        emr_client = MagicMock()
+        emr_client.list_clusters.return_value = {'Clusters': []}
+        tsdb_client = MagicMock()
+        tsdb_client.get_resources.return_value = (0, 0, 0, 0)
+        inj = SimpleNamespace(platform=SupportedPlatforms.AWS_EMR, current_region='us-east-1', client_emr=emr_client, tsdb_client=tsdb_client,
+                              active_ids_cache=LruCache(4), active_ids_ttl=60)
+        ClusterUtils.get_active_resources(inj, 1710170000)
+        ClusterUtils.get_active_resources(inj, 1710170000)
+        self.assertEqual(emr_client.list_clusters.call_count, 1)
+        self.assertEqual(tsdb_client.get_resources.call_count, 2)
+        inj.current_region = 'us-west-2'
+        ClusterUtils.get_active_resources(inj, 1710170000)
+        self.assertEqual(emr_client.list_clusters.call_count, 2)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -13,11 +13,21 @@
 import unittest
 import gzip
 import json
+import os
+import random
+import tempfile
+from datetime import datetime, timedelta, timezone
 from os import path
 from typing import List
-from xonai_grafana.cost_estimation.estimator import Ec2EmrPricing, EmrCostEstimator
-from xonai_grafana.schemata.cloud_objects import InstanceResGroup
+import numpy as np
+from unittest.mock import MagicMock, patch
+from botocore.exceptions import ClientError
+from xonai_grafana.cost_estimation.estimator import Ec2EmrPricing, EmrCostEstimator, InstanceColumns
+from xonai_grafana.cost_estimation import fetch_cost_info
+from xonai_grafana.cost_estimation.fetch_cost_info import build_ec2_index, build_emr_index, write_index, stream_ec2_index, stream_emr_index, OfferReader
+from xonai_grafana.schemata.cloud_objects import InstanceResGroup, Ec2Instance
 from xonai_grafana.tests.utilities import TestUtils
+from xonai_grafana.utils.caching import LruCache
 
 
 class EmrEstimatorTestCase(unittest.TestCase):
@@ -43,6 +53,7 @@ class EmrEstimatorTestCase(unittest.TestCase):
         with gzip.open(inst_fleet_file, mode="rt") as f:
             cls.instance_fleet_json = json.loads(f.read())
         cls.hours_run = 2.5
+        cls.resource_path = resource_path
 
     def test_info_lookup(self):
         cost_map: Ec2EmrPricing = Ec2EmrPricing('us-east-1', '')
@@ -130,6 +141,208 @@ class EmrEstimatorTestCase(unittest.TestCase):
         expected += 10 * 0.125 * 0.931323 * EmrEstimatorTestCase.hours_run / 720  # "VolumeType":"io1", "SizeInGB":10
         self.assertEqual(ebs_cost, expected)
 
+    def test_cluster_estimation(self):
+        emr_client = MagicMock()
+        start = datetime(2023, 12, 1, 10, tzinfo=timezone.utc)
+        timeline = {'CreationDateTime': start, 'EndDateTime': start + timedelta(hours=2)}
+        emr_client.describe_cluster.return_value = {'Cluster': {
+            'Id': 'j-1', 'Name': 'cluster', 'Status': {'State': 'TERMINATED', 'Timeline': timeline}, 'NormalizedInstanceHours': 8,
+            'ReleaseLabel': 'emr-7.0.0', 'Tags': [], 'Ec2InstanceAttributes': {'Ec2AvailabilityZone': 'us-east-1a'}, 'InstanceCollectionType': 'INSTANCE_FLEET'}}
+        emr_client.list_instance_fleets.return_value = EmrEstimatorTestCase.instance_fleet_json
+        fleet_ids = [fleet['Id'] for fleet in EmrEstimatorTestCase.instance_fleet_json['InstanceFleets']]
+        fleet_instances = [{'Status': {'Timeline': timeline}, 'InstanceType': 'instance_1', 'Market': 'ON_DEMAND', 'EbsVolumes': []},
+                           {'Status': {'Timeline': timeline}, 'InstanceType': 'spot_type_1', 'Market': 'SPOT', 'EbsVolumes': []},
+                           {'Status': {'Timeline': timeline}, 'InstanceType': 'spot_type_2', 'Market': 'SPOT', 'EbsVolumes': []}]
+        instances = [{**instance, 'InstanceFleetId': fleet_id} for fleet_id in fleet_ids for instance in fleet_instances]
+        emr_client.list_instances.side_effect = lambda **kwargs: {'Instances': instances[3:], 'Marker': 'm'} if kwargs.get('Marker') is None \
+            else {'Instances': instances[:3]}  # master fleet on the second page
+        ec2_client = MagicMock()
+        ec2_client.describe_spot_price_history.side_effect = lambda InstanceTypes, **kwargs: {'NextToken': '', 'SpotPriceHistory': [
+            {'InstanceType': inst_type, 'Timestamp': datetime(2023, 12, 1, tzinfo=timezone.utc), 'SpotPrice': '0.5'} for inst_type in InstanceTypes]}
+        estimator = EmrCostEstimator(emr_client, ec2_client, 'us-east-1', EmrEstimatorTestCase.resource_path)
+        cost_map = estimator.estimate_cluster_cost('j-1')
+        self.assertEqual(ec2_client.describe_spot_price_history.call_count, 1)  # one batched call for all spot types of all fleets
+        self.assertEqual(ec2_client.describe_spot_price_history.call_args.kwargs['InstanceTypes'], ['spot_type_1', 'spot_type_2'])
+        fleet_count = len(EmrEstimatorTestCase.instance_fleet_json['InstanceFleets'])
+        master_type = EmrEstimatorTestCase.instance_fleet_json['InstanceFleets'][0]['InstanceFleetType']
+        self.assertAlmostEqual(cost_map[master_type + '.EC2'], 2 * 1.0 + 2 * 2 * 0.5, places=12)
+        self.assertAlmostEqual(cost_map[master_type + '.EMR'], 2 * 0.1, places=12)
+        self.assertAlmostEqual(cost_map['TOTAL'], sum(value for key, value in cost_map.items() if key != 'TOTAL'), places=12)
+        self.assertEqual(len(cost_map), 3 * fleet_count + 1)
+        emr_client.list_instance_groups.assert_not_called()  # collection type from the description
+        self.assertEqual(emr_client.describe_cluster.call_count, 1)  # shared by zone & collection type lookups
+        self.assertEqual([call.kwargs for call in emr_client.list_instances.call_args_list], [{'ClusterId': 'j-1'}, {'ClusterId': 'j-1', 'Marker': 'm'}])
+
+    def test_collection_type_fallback(self):
+        emr_client = MagicMock()
+        emr_client.describe_cluster.side_effect = lambda ClusterId: {'Cluster': {  # without collection type
+            'Id': ClusterId, 'Name': 'cluster', 'Status': {'State': 'RUNNING', 'Timeline': {'CreationDateTime': datetime(2023, 12, 1, tzinfo=timezone.utc)}},
+            'NormalizedInstanceHours': 8, 'ReleaseLabel': 'emr-7.0.0', 'Tags': []}}
+        emr_client.list_instance_groups.side_effect = ClientError({'Error': {'Code': 'InvalidRequestException', 'Message': 'Instance fleet cluster'}},
+                                                                  'ListInstanceGroups')
+        emr_client.list_instance_fleets.return_value = EmrEstimatorTestCase.instance_fleet_json
+        emr_client.list_instances.return_value = {'Instances': []}
+        estimator = EmrCostEstimator(emr_client, MagicMock(), 'us-east-1', EmrEstimatorTestCase.resource_path)
+        self.assertEqual(len(estimator.get_instance_columns('j-1').groups), len(EmrEstimatorTestCase.instance_fleet_json['InstanceFleets']))
+        self.assertEqual(len(estimator.get_instance_columns('j-1').groups), len(EmrEstimatorTestCase.instance_fleet_json['InstanceFleets']))
+        self.assertEqual(emr_client.list_instance_groups.call_count, 1)  # learned collection type is kept
+        emr_client.list_instance_groups.side_effect = ClientError({'Error': {'Code': 'AccessDeniedException', 'Message': ''}}, 'ListInstanceGroups')
+        with self.assertRaises(ClientError):  # unrelated errors are not mistaken for fleet clusters
+            estimator.get_instance_columns('j-2')
+
+    def test_columnar_costs(self):
+        rng = random.Random(7)
+        ec2_client = MagicMock()
+        ec2_client.describe_spot_price_history.side_effect = lambda InstanceTypes, **kwargs: {'NextToken': '', 'SpotPriceHistory': [
+            {'InstanceType': inst_type, 'Timestamp': datetime(2023, 12, 1, hour, tzinfo=timezone.utc), 'SpotPrice': str(rng.uniform(0.1, 0.9))}
+            for inst_type in InstanceTypes for hour in range(24)]}
+        estimator = EmrCostEstimator(MagicMock(), ec2_client, 'us-east-1', EmrEstimatorTestCase.resource_path)
+        devices = [{'VolumeSpecification': {'VolumeType': 'gp3', 'SizeInGB': 32}}, {'VolumeSpecification': {'VolumeType': 'st1', 'SizeInGB': 500}}]
+        groups = [InstanceResGroup('ig-1', 'instance_1', 'MASTER'), InstanceResGroup('ig-2', 'instance_2', 'CORE', devices),
+                  InstanceResGroup('ig-3', 'instance_1', 'TASK', devices[:1]), InstanceResGroup('ig-4', 'instance_3', 'TASK'),
+                  InstanceResGroup('ig-5', 'instance_2', 'TASK')]
+        group_instances = []
+        for group_size in (1, 40, 25, 30, 0):
+            instances = []
+            for _ in range(group_size):
+                creation_ts = datetime(2023, 12, 1, 1, tzinfo=timezone.utc) + timedelta(microseconds=rng.randrange(10 ** 10))
+                termination_ts = creation_ts + timedelta(microseconds=rng.randrange(1, 6 * 10 ** 10))
+                instances.append(Ec2Instance(creation_ts, termination_ts, rng.choice(['instance_1', 'instance_2', 'instance_3', 'unknown']),
+                                             rng.choice(['ON_DEMAND', 'SPOT']), []))
+            group_instances.append(instances)
+        columns = InstanceColumns(groups, group_instances)
+        cost_map = estimator.aggregate_costs(columns, *estimator.estimate_instance_costs(columns, 'us-east-1a'))
+        expected_map = {}  # instance-by-instance reference
+        for instance_group, instances in zip(groups, group_instances):
+            for instance in instances:
+                hours_run = (instance.termination_ts - instance.creation_ts).total_seconds() / 3600
+                if instance.market_type == 'SPOT':
+                    ec2_cost = estimator.spot_pricing.estimate_price_for_period(instance.instance_type, 'us-east-1a', instance.creation_ts, instance.termination_ts)
+                else:
+                    ec2_cost = estimator.ec2_emr_pricing.get_ec2_price(instance.instance_type) * hours_run
+                emr_cost = estimator.ec2_emr_pricing.get_emr_price(instance.instance_type) * hours_run
+                ebs_cost = EmrCostEstimator._estimate_ebs_costs(instance_group.ebs_block_devices, hours_run)
+                for (component, cost) in (('.EC2', ec2_cost), ('.EMR', emr_cost), ('.EBS', ebs_cost)):
+                    expected_map.setdefault(instance_group.group_type + component, 0)
+                    expected_map[instance_group.group_type + component] += cost
+                expected_map.setdefault('TOTAL', 0)
+                expected_map['TOTAL'] += ec2_cost + emr_cost + ebs_cost
+        self.assertEqual(list(cost_map.items()), list(expected_map.items()))  # same keys, order, and floats
+        self.assertEqual(estimator.aggregate_costs(InstanceColumns(groups, [[], [], [], [], []]), np.zeros(0), np.zeros(0), np.zeros(0)), {})
+
+    def test_incremental_costs(self):
+        ec2_client = MagicMock()
+        ec2_client.describe_spot_price_history.side_effect = lambda InstanceTypes, **kwargs: {'NextToken': '', 'SpotPriceHistory': [
+            {'InstanceType': inst_type, 'Timestamp': datetime(2023, 12, 1, hour, tzinfo=timezone.utc), 'SpotPrice': str(0.1 + hour / 100)}
+            for inst_type in InstanceTypes for hour in range(24)]}
+        estimator = EmrCostEstimator(MagicMock(), ec2_client, 'us-east-1', EmrEstimatorTestCase.resource_path, instance_cost_cache=LruCache(1000))
+        groups = [InstanceResGroup('ig-1', 'instance_1', 'MASTER'), InstanceResGroup('ig-2', 'instance_2', 'TASK')]
+        start = datetime(2023, 12, 1, 1, tzinfo=timezone.utc)
+        instances = [Ec2Instance(start + timedelta(minutes=i), start + timedelta(hours=2, minutes=3 * i), ['instance_1', 'instance_2'][i % 2],
+                                 ['ON_DEMAND', 'SPOT'][i % 3 == 0], [], f'ci-{i}', i % 4 != 0) for i in range(20)]  # every fourth one runs
+        columns = InstanceColumns(groups, [instances[:1], instances[1:]])
+        expected_costs = estimator.estimate_instance_costs(columns, 'us-east-1a')
+        for _ in range(2):
+            with patch.object(estimator, 'estimate_instance_costs', wraps=estimator.estimate_instance_costs) as estimate:
+                costs = estimator.estimate_incremental_costs('j-1', columns, 'us-east-1a')
+            for (cost, expected_cost) in zip(costs, expected_costs):
+                self.assertEqual(cost.tolist(), expected_cost.tolist())
+        self.assertEqual(estimate.call_args.args[0].instance_ids, [f'ci-{i}' for i in range(0, 20, 4)])  # only running instances are priced again
+        self.assertEqual(sorted(estimator.instance_cost_cache.get('j-1').keys()), sorted(f'ci-{i}' for i in range(20) if i % 4 != 0))
+        columns = InstanceColumns(groups, [instances[:1], instances[1:] + [Ec2Instance(start, start + timedelta(hours=1), 'instance_2', 'SPOT', [], 'ci-20')]])
+        with patch.object(estimator, 'estimate_instance_costs', wraps=estimator.estimate_instance_costs) as estimate:
+            estimator.estimate_incremental_costs('j-1', columns, 'us-east-1a')
+        self.assertEqual(estimate.call_args.args[0].instance_ids, [f'ci-{i}' for i in range(0, 20, 4)] + ['ci-20'])  # newly listed instance
+
+    def test_index_loading(self):
+        raw_pricing: Ec2EmrPricing = Ec2EmrPricing('us-east-1', EmrEstimatorTestCase.resource_path)
+        with tempfile.TemporaryDirectory() as index_path:
+            os.mkdir(path.join(index_path, 'ec2'))
+            os.mkdir(path.join(index_path, 'emr'))
+            write_index(build_ec2_index(TestUtils.sku_info_ec2), path.join(index_path, 'ec2', 'us-east-1.index.json.gz'))
+            write_index(build_emr_index(TestUtils.sku_info_emr), path.join(index_path, 'emr', 'us-east-1.index.json.gz'))
+            indexed_pricing: Ec2EmrPricing = Ec2EmrPricing('us-east-1', index_path)  # raw offer files absent
+            self.assertEqual(indexed_pricing.ec2_prices, raw_pricing.ec2_prices)
+            self.assertEqual(indexed_pricing.emr_prices, raw_pricing.emr_prices)
+            self.assertEqual(indexed_pricing.instance_type_info, raw_pricing.instance_type_info)
+            stale_index = {'format': 1, 'ec2_prices': {'instance_1': 9.0}, 'instance_type_info': {}}
+            write_index(stale_index, path.join(index_path, 'ec2', 'us-east-1.index.json.gz'))
+            raw_file = path.join(index_path, 'ec2', 'us-east-1.json.gz')
+            with gzip.open(raw_file, "wb") as f:
+                f.write(json.dumps(TestUtils.sku_info_ec2).encode())
+            os.utime(raw_file, (path.getmtime(raw_file) + 10, path.getmtime(raw_file) + 10))  # offer file newer than its index
+            self.assertEqual(Ec2EmrPricing('us-east-1', index_path).ec2_prices, raw_pricing.ec2_prices)
+
+    def test_streaming_offer_parser(self):
+        offer = json.loads(json.dumps(TestUtils.sku_info_ec2))
+        offer['products']['sku3'] = {'sku': 'sku3', 'attributes': {'instanceType': 'instance_3', 'tenancy': 'Dedicated'}}
+        offer['terms']['Reserved'] = {'sku1': {'sku1.r': {'priceDimensions': {'sku1.r.1': {'pricePerUnit': {'USD': '0.5'}}}}}}
+        offer['publicationDate'] = '2024-06-01T00:00:00Z'
+        chunk_size = OfferReader.chunk_size
+        OfferReader.chunk_size = 7  # records span many chunks
+        try:
+            with tempfile.TemporaryDirectory() as offer_path:
+                offer_file = path.join(offer_path, 'us-east-1.json.gz')
+                with gzip.open(offer_file, "wb") as f:
+                    f.write(json.dumps(offer, indent=2).encode())
+                self.assertEqual(stream_ec2_index(offer_file), build_ec2_index(offer))
+                self.assertEqual(stream_ec2_index(offer_file)['ec2_prices'], {'instance_1': 1.0, 'instance_2': 2.0})
+                reordered_offer = {'terms': offer['terms'], 'products': offer['products']}  # terms before products
+                with gzip.open(offer_file, "wb") as f:
+                    f.write(json.dumps(reordered_offer).encode())
+                self.assertEqual(stream_ec2_index(offer_file), build_ec2_index(offer))
+                with gzip.open(offer_file, "wb") as f:
+                    f.write(json.dumps(TestUtils.sku_info_emr).encode())
+                self.assertEqual(stream_emr_index(offer_file), build_emr_index(TestUtils.sku_info_emr))
+        finally:
+            OfferReader.chunk_size = chunk_size
+
+
+    def test_incremental_download(self):
+        offer_bytes = json.dumps(TestUtils.sku_info_ec2).encode()
+        version = {'url': '/offers/v1.0/aws/AmazonEC2/20240601/us-east-1/index.json'}
+        responses = {'/offers/v1.0/aws/index.json': {'offers': {'AmazonEC2': {'currentRegionIndexUrl': '/ec2/region_index.json'},
+                                                                 'ElasticMapReduce': {'currentRegionIndexUrl': '/emr/region_index.json'}}},
+                     '/ec2/region_index.json': {'regions': {'us-east-1': {'currentVersionUrl': version['url']}}},
+                     '/emr/region_index.json': {'regions': {}}}
+
+        def get(url, stream=False, **kwargs):
+            response = MagicMock()
+            response.__enter__.return_value = response
+            if stream:
+                self.assertEqual(url, fetch_cost_info.URL_BASE + version['url'])
+                response.iter_content.return_value = [offer_bytes[i:i + 100] for i in range(0, len(offer_bytes), 100)]
+            else:
+                response.json.return_value = responses[url[len(fetch_cost_info.URL_BASE):]]
+            return response
+
+        with tempfile.TemporaryDirectory() as resource_path, patch.object(fetch_cost_info, 'resource_dir', resource_path), \
+                patch.object(fetch_cost_info.requests, 'get', side_effect=get) as mocked_get:
+            os.mkdir(path.join(resource_path, 'ec2'))
+            fetch_cost_info.fetch_resources({'us-east-1', 'eu-west-1'}, workers=2)
+            offer_file = path.join(resource_path, 'ec2', 'us-east-1.json.gz')
+            with gzip.open(offer_file) as f:
+                self.assertEqual(f.read(), offer_bytes)
+            self.assertEqual(Ec2EmrPricing('us-east-1', resource_path).ec2_prices, {'instance_1': 1.0, 'instance_2': 2.0})
+            self.assertEqual(sorted(os.listdir(path.join(resource_path, 'ec2'))), ['us-east-1.index.json.gz', 'us-east-1.json.gz'])  # no temporary files left
+            downloads = sum(1 for call in mocked_get.call_args_list if call.kwargs.get('stream'))
+            fetch_cost_info.fetch_resources({'us-east-1'})  # unchanged version is skipped
+            self.assertEqual(sum(1 for call in mocked_get.call_args_list if call.kwargs.get('stream')), downloads)
+            version['url'] = '/offers/v1.0/aws/AmazonEC2/20240701/us-east-1/index.json'
+            responses['/ec2/region_index.json']['regions']['us-east-1']['currentVersionUrl'] = version['url']
+            index_file = fetch_cost_info.get_index_file(offer_file)
+            os.utime(index_file, (1, 1))
+            os.utime(offer_file, (1, 1))
+
+            def stream_index(temp_file):  # the offer must not be in place before its index
+                self.assertEqual(path.getmtime(offer_file), 1)
+                return stream_ec2_index(temp_file)
+            with patch.object(fetch_cost_info, 'stream_ec2_index', side_effect=stream_index):
+                fetch_cost_info.fetch_resources({'us-east-1'})
+            self.assertEqual(sum(1 for call in mocked_get.call_args_list if call.kwargs.get('stream')), downloads + 1)
+            self.assertGreater(path.getmtime(offer_file), 1)
+            self.assertGreaterEqual(path.getmtime(index_file), path.getmtime(offer_file))  # the new index is used, not the raw offer
+
 
 if __name__ == '__main__':
     unittest.main()
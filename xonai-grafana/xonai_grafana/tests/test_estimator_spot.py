@@ -10,11 +10,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import tempfile
+import threading
+import time
 import unittest
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from os import path
+from unittest.mock import MagicMock
 from dateutil.tz import tzutc
 from typing import Dict, Tuple
-from xonai_grafana.cost_estimation.estimator import SpotPricing, SpotPriceHistory
+import numpy as np
+from xonai_grafana.cost_estimation.estimator import SpotPricing, SpotPriceHistory, SpotPriceSeries, EstimationUtils
+from xonai_grafana.cost_estimation.spot_store import SpotPriceStore
 
 
 class SpotEstimatorTestCase(unittest.TestCase):
@@ -45,7 +53,7 @@ class SpotEstimatorTestCase(unittest.TestCase):
         seventh = ((sorted_price_timestamps[7] - sorted_price_timestamps[6]).total_seconds() * spot_prices[sorted_price_timestamps[6]]) / 3600
         eight = ((end_time - sorted_price_timestamps[7]).total_seconds() * spot_prices[sorted_price_timestamps[7]]) / 3600
         theoretical_price = first + second + third + fourth + fifth + sixth + seventh + eight
-        self.assertEqual(estimated_price, theoretical_price)
+        self.assertAlmostEqual(estimated_price, theoretical_price, places=12)  # prefix sums add segments in a different order
         # Appending price point past end date, shouldn't change estimation
         spot_price_sample: Dict[Tuple[str, str], SpotPriceHistory] = {
             (self.inst_type, self.avail_zone): {
@@ -56,7 +64,7 @@ class SpotEstimatorTestCase(unittest.TestCase):
                 datetime(2023, 12, 1, 10, 16, 50, tzinfo=tzutc()): 0.087, datetime(2023, 11, 30, 22, 17, 22, tzinfo=tzutc()): 0.0867}}
         self.estimator.spot_prices = spot_price_sample
         estimated_price = self.estimator.estimate_price_for_period(self.inst_type, self.avail_zone, start_time, end_time)
-        self.assertEqual(estimated_price, theoretical_price)
+        self.assertAlmostEqual(estimated_price, theoretical_price, places=12)
         # Prepending price point before start date, shouldn't change estimation
         spot_price_sample: Dict[Tuple[str, str], SpotPriceHistory] = {
             (self.inst_type, self.avail_zone): {
@@ -69,7 +77,7 @@ class SpotEstimatorTestCase(unittest.TestCase):
         }
         self.estimator.spot_prices = spot_price_sample
         estimated_price = self.estimator.estimate_price_for_period(self.inst_type, self.avail_zone, start_time, end_time)
-        self.assertEqual(estimated_price, theoretical_price)
+        self.assertAlmostEqual(estimated_price, theoretical_price, places=12)
 
     def test_short_running(self):
         spot_price_sample = {(self.inst_type, self.avail_zone): {datetime(2023, 11, 30, 22, 17, 22, tzinfo=tzutc()): 0.0867}}
@@ -143,5 +151,121 @@ class SpotEstimatorTestCase(unittest.TestCase):
         self.assertEqual(estimated_price, theoretical_price_2)
 
 
+    def test_vectorized_periods(self):
+        prices: SpotPriceHistory = {datetime(2023, 12, 1, 10, tzinfo=tzutc()): 0.1, datetime(2023, 12, 1, 12, tzinfo=tzutc()): 0.2,
+                                    datetime(2023, 12, 1, 13, tzinfo=tzutc()): 0.4}
+        self.estimator.spot_prices = {(self.inst_type, self.avail_zone): prices}
+        start_times = [datetime(2023, 12, 1, 11, tzinfo=tzutc()), datetime(2023, 12, 1, 10, 15, tzinfo=tzutc()), datetime(2023, 12, 1, 12, 30, tzinfo=tzutc()),
+                       datetime(2023, 12, 1, 13, 30, tzinfo=tzutc())]
+        end_times = [datetime(2023, 12, 1, 14, tzinfo=tzutc()), datetime(2023, 12, 1, 10, 30, tzinfo=tzutc()), datetime(2023, 12, 1, 12, 45, tzinfo=tzutc()),
+                     datetime(2023, 12, 1, 15, 30, tzinfo=tzutc())]
+        estimated_prices = self.estimator.estimate_prices_for_periods(self.inst_type, self.avail_zone, start_times, end_times)
+        expected_prices = [0.1 + 0.2 + 0.4, 0.25 * 0.1, 0.25 * 0.2, 2 * 0.4]
+        for estimated_price, expected_price in zip(estimated_prices, expected_prices):
+            self.assertAlmostEqual(estimated_price, expected_price, places=12)
+        for start_time, end_time, estimated_price in zip(start_times, end_times, estimated_prices):
+            self.assertEqual(self.estimator.estimate_price_for_period(self.inst_type, self.avail_zone, start_time, end_time), estimated_price)
+        self.assertEqual(len(self.estimator.estimate_prices_for_periods(self.inst_type, self.avail_zone, [], [])), 0)
+        series = SpotPriceSeries(prices)  # first price also applies before its timestamp
+        start_micros = np.array([EstimationUtils.get_epoch_micros(datetime(2023, 12, 1, 9, tzinfo=tzutc()))])
+        self.assertAlmostEqual(series.get_costs(start_micros, start_micros + 3600 * 10 ** 6)[0], 0.1, places=12)
+
+
+    @classmethod
+    def describe_spot_price_history(cls, InstanceTypes, StartTime, EndTime, **kwargs):
+        """Hourly price changes on 2023-12-01, prices of the second instance type are twice as high."""
+        prices = []
+        for type_id, inst_type in enumerate(InstanceTypes):
+            history = [{'InstanceType': inst_type, 'Timestamp': datetime(2023, 12, 1, hour, tzinfo=tzutc()), 'SpotPrice': str((type_id + 1) * hour / 100)}
+                       for hour in range(24)]
+            in_effect = [entry for entry in history if entry['Timestamp'] <= StartTime][-1:]  # price in effect at start time
+            prices.extend(in_effect + [entry for entry in history if StartTime < entry['Timestamp'] <= EndTime])
+        return {'SpotPriceHistory': prices, 'NextToken': ''}
+
+    def test_coverage_aware_fetching(self):
+        ec2_client = MagicMock()
+        ec2_client.describe_spot_price_history.side_effect = self.describe_spot_price_history
+        with tempfile.TemporaryDirectory() as db_path:
+            store = SpotPriceStore(path.join(db_path, 'spot_prices.db'))
+            estimator = SpotPricing(ec2_client, store)
+            start_time = datetime(2023, 12, 1, 4, 30, tzinfo=tzutc())
+            end_time = datetime(2023, 12, 1, 8, 30, tzinfo=tzutc())
+            estimated_price = estimator.estimate_price_for_period(self.inst_type, self.avail_zone, start_time, end_time)
+            self.assertAlmostEqual(estimated_price, (0.5 * 4 + 5 + 6 + 7 + 0.5 * 8) / 100, places=12)
+            self.assertEqual(ec2_client.describe_spot_price_history.call_count, 1)
+            estimator.estimate_price_for_period(self.inst_type, self.avail_zone, datetime(2023, 12, 1, 5, tzinfo=tzutc()), end_time)  # covered
+            self.assertEqual(ec2_client.describe_spot_price_history.call_count, 1)
+            wider_start = datetime(2023, 12, 1, 2, tzinfo=tzutc())
+            wider_end = datetime(2023, 12, 1, 10, tzinfo=tzutc())
+            estimated_price = estimator.estimate_price_for_period(self.inst_type, self.avail_zone, wider_start, wider_end)
+            self.assertAlmostEqual(estimated_price, sum(range(2, 10)) / 100, places=12)
+            fetched_intervals = [(call.kwargs['StartTime'], call.kwargs['EndTime']) for call in ec2_client.describe_spot_price_history.call_args_list[1:]]
+            self.assertEqual(fetched_intervals, [(wider_start, start_time), (end_time, wider_end)])  # only missing sub-intervals
+            restarted_estimator = SpotPricing(ec2_client, SpotPriceStore(store.db_file))  # histories survive restarts
+            self.assertEqual(restarted_estimator.estimate_price_for_period(self.inst_type, self.avail_zone, wider_start, wider_end), estimated_price)
+            self.assertEqual(ec2_client.describe_spot_price_history.call_count, 3)
+
+    def test_batched_prefetch(self):
+        ec2_client = MagicMock()
+        ec2_client.describe_spot_price_history.side_effect = self.describe_spot_price_history
+        estimator = SpotPricing(ec2_client)
+        windows = {'c4.xlarge': (datetime(2023, 12, 1, 2, tzinfo=tzutc()), datetime(2023, 12, 1, 4, tzinfo=tzutc())),
+                   'm5.xlarge': (datetime(2023, 12, 1, 6, tzinfo=tzutc()), datetime(2023, 12, 1, 8, tzinfo=tzutc()))}
+        estimator.prefetch_prices(self.avail_zone, windows)
+        self.assertEqual(ec2_client.describe_spot_price_history.call_count, 1)
+        self.assertEqual(ec2_client.describe_spot_price_history.call_args.kwargs['InstanceTypes'], ['c4.xlarge', 'm5.xlarge'])
+        c4_price = estimator.estimate_price_for_period('c4.xlarge', self.avail_zone, *windows['c4.xlarge'])
+        m5_price = estimator.estimate_price_for_period('m5.xlarge', self.avail_zone, *windows['m5.xlarge'])
+        self.assertEqual(ec2_client.describe_spot_price_history.call_count, 1)  # answered from prefetched histories
+        self.assertAlmostEqual(c4_price, 0.05, places=12)
+        self.assertAlmostEqual(m5_price, 2 * 0.13, places=12)
+        estimator.prefetch_prices(self.avail_zone, windows)  # covered
+        self.assertEqual(ec2_client.describe_spot_price_history.call_count, 1)
+
+    def test_coverage_intervals(self):
+        self.assertEqual(SpotPriceStore.merge_intervals([(5, 8), (0, 2), (2, 4), (7, 9)]), [(0, 4), (5, 9)])
+        self.assertEqual(SpotPriceStore.get_missing_intervals([(0, 4), (5, 9)], 1, 12), [(4, 5), (9, 12)])
+        self.assertEqual(SpotPriceStore.get_missing_intervals([(0, 4), (5, 9)], 1, 12, min_length=2), [(9, 12)])
+        self.assertEqual(SpotPriceStore.get_missing_intervals([], 1, 3), [(1, 3)])
+        self.assertEqual(SpotPriceStore.get_missing_intervals([(0, 4)], 1, 3), [])
+        self.assertEqual(SpotPriceStore.get_missing_intervals([], 1, 3, min_length=5), [(1, 3)])  # nothing covered
+        self.assertEqual(SpotPriceStore.get_missing_intervals([(10, 20)], 1, 3, min_length=5), [(1, 3)])
+        self.assertEqual(SpotPriceStore.get_missing_intervals([(0, 4)], 4, 6, min_length=5), [])  # borders coverage
+
+    def test_short_uncovered_window(self):
+        ec2_client = MagicMock()
+        ec2_client.describe_spot_price_history.side_effect = self.describe_spot_price_history
+        estimator = SpotPricing(ec2_client)
+        start_time = datetime(2023, 12, 1, 4, 30, tzinfo=tzutc())
+        estimated_price = estimator.estimate_price_for_period(self.inst_type, self.avail_zone, start_time, start_time + timedelta(minutes=10))
+        self.assertEqual(ec2_client.describe_spot_price_history.call_count, 1)  # shorter than the minimum fetch gap, but nothing is stored
+        self.assertAlmostEqual(estimated_price, 0.04 / 6, places=12)
+        estimator.estimate_price_for_period(self.inst_type, self.avail_zone, start_time, start_time + timedelta(minutes=20))
+        self.assertEqual(ec2_client.describe_spot_price_history.call_count, 1)  # remaining 10 minutes border the fetched window
+
+    def test_concurrent_fetches(self):
+        release = threading.Event()
+
+        def describe_spot_price_history(**kwargs):
+            if kwargs['InstanceTypes'] == [self.inst_type]:
+                release.wait(5)
+            return self.describe_spot_price_history(**kwargs)
+        ec2_client = MagicMock()
+        ec2_client.describe_spot_price_history.side_effect = describe_spot_price_history
+        estimator = SpotPricing(ec2_client)
+        window = (datetime(2023, 12, 1, 2, tzinfo=tzutc()), datetime(2023, 12, 1, 4, tzinfo=tzutc()))
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(estimator.estimate_price_for_period, self.inst_type, self.avail_zone, *window) for _ in range(2)]
+            deadline = time.monotonic() + 5
+            while estimator._fetches.coalesced == 0 and time.monotonic() < deadline:
+                time.sleep(0.001)
+            self.assertAlmostEqual(estimator.estimate_price_for_period('m5.xlarge', self.avail_zone, *window), 0.05, places=12)  # not blocked
+            release.set()
+            prices = [future.result() for future in futures]
+        self.assertEqual(prices, [0.05, 0.05])
+        self.assertEqual(estimator._fetches.coalesced, 1)
+        self.assertEqual(ec2_client.describe_spot_price_history.call_count, 2)  # one call per instance type
+
+
 if __name__ == '__main__':
     unittest.main()
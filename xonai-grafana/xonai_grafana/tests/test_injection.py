@@ -10,10 +10,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import tempfile
 import unittest
-from os import environ
+from os import environ, path
+from xonai_grafana.cost_estimation.estimator import PricingRegistry, PricingWatcher
 from xonai_grafana.schemata.cloud_objects import SupportedPlatforms
-from xonai_grafana.utils.dependencies import get_cloud_env
+from xonai_grafana.utils.dependencies import get_cloud_env, Inject
 
 
 class InjectionTestCase(unittest.TestCase):
@@ -34,6 +37,78 @@ class InjectionTestCase(unittest.TestCase):
         self.assertEqual(active_region, 'us-east-2')
         self.assertEqual(activated_platform, SupportedPlatforms.AWS_DBX)
 
+    def test_pricing_registry(self):
+        loaded_regions = []
+
+        def load_pricing(region):
+            loaded_regions.append(region)
+            return {'region': region, 'prices': list(range(100))}
+        registry = PricingRegistry(load_pricing, 10000)  # about two regions
+        self.assertEqual(registry.get('us-east-1')['region'], 'us-east-1')
+        registry.get('us-west-2')
+        registry.get('us-east-1')  # us-west-2 is now least recently used
+        self.assertEqual(loaded_regions, ['us-east-1', 'us-west-2'])
+        registry.get('eu-west-1')
+        self.assertNotIn('us-west-2', registry.pricings)
+        self.assertIn('us-east-1', registry.pricings)
+        registry.get('us-west-2')
+        self.assertEqual(loaded_regions, ['us-east-1', 'us-west-2', 'eu-west-1', 'us-west-2'])
+
+    def test_pricing_over_budget(self):
+        loaded_regions = []
+
+        def load_pricing(region):
+            loaded_regions.append(region)
+            return {'region': region, 'prices': list(range(100))}
+        registry = PricingRegistry(load_pricing, 1000)  # smaller than one region
+        registry.get('us-east-1')
+        self.assertEqual(registry.get('us-east-1')['region'], 'us-east-1')
+        self.assertEqual(loaded_regions, ['us-east-1'])  # stays resident
+        registry.get('us-west-2')
+        self.assertEqual(registry.pricings.keys(), ['us-west-2'])
+        self.assertEqual(registry.pricings.weight, 1000)
+
+    def test_pricing_reload(self):
+        versions = {}
+
+        def load_pricing(region):
+            versions[region] = versions.get(region, 0) + 1
+            return {'region': region, 'version': versions[region]}
+        registry = PricingRegistry(load_pricing, 10000)
+        with tempfile.TemporaryDirectory() as res_path:
+            os.mkdir(path.join(res_path, 'ec2'))
+            index_file = path.join(res_path, 'ec2', 'us-east-1.index.json.gz')
+            open(index_file, 'w').close()
+            watcher = PricingWatcher(registry, res_path)
+            registry.get('us-east-1')
+            previous_pricing = registry.get('us-east-1')
+            os.utime(index_file, (1, 1))
+            open(path.join(res_path, 'ec2', 'eu-west-1.index.json.gz'), 'w').close()  # region is not resident
+            self.assertEqual(watcher.check(), [])  # files changed, waits until they settle
+            self.assertEqual(watcher.check(), ['us-east-1'])
+            registry._reloader.submit(lambda: None).result()  # waits for the rebuild
+            self.assertEqual(previous_pricing['version'], 1)  # objects in use are not mutated
+            self.assertEqual(registry.get('us-east-1')['version'], 2)
+            self.assertEqual(watcher.check(), [])
+        self.assertEqual(registry.reload(['us-west-2']), [])
+        self.assertEqual(registry.reload(), ['us-east-1'])
+        registry._reloader.submit(lambda: None).result()
+        self.assertEqual(registry.get('us-east-1')['version'], 3)
+        self.assertNotIn('eu-west-1', versions)
+
+    def test_region_views(self):
+        environ['XONAI_SPOT_DB'] = ''  # spot prices and cluster caches only in memory
+        environ['XONAI_CACHE_DB'] = ''
+        inj = Inject('us-east-1', SupportedPlatforms.AWS_EMR)
+        self.assertIsNone(inj.spot_store)
+        self.assertIs(inj.for_region('us-east-1'), inj)
+        region_view = inj.for_region('us-west-2')
+        self.assertEqual((region_view.current_region, region_view.client_emr.meta.region_name, region_view.calc.region), ('us-west-2', 'us-west-2', 'us-west-2'))
+        self.assertEqual((inj.current_region, inj.client_emr.meta.region_name), ('us-east-1', 'us-east-1'))  # shared object unchanged
+        self.assertIs(region_view.cost_cache, inj.cost_cache)
+        self.assertIs(inj.for_region('us-west-2').calc, region_view.calc)  # clients are reused
+        inj.close_aws_clients()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,68 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from unittest.mock import MagicMock
+import boto3
+import httpx
+from botocore.stub import Stubber
+from xonai_grafana.utils import metrics
+from xonai_grafana.utils.caching import LruCache
+from xonai_grafana.utils.tsdb_client import TsdbConnection
+
+
+class MetricsTestCase(unittest.TestCase):
+    @staticmethod
+    def get_sample(name: str, labels: dict) -> float:
+        value = metrics.registry.get_sample_value(name, labels)
+        return 0.0 if value is None else value
+
+    def test_boto3_instrumentation(self):
+        client = boto3.client('emr', region_name='us-east-1', aws_access_key_id='key', aws_secret_access_key='secret')
+        metrics.instrument_boto3_client(client)
+        labels = {'service': 'emr', 'operation': 'ListClusters'}
+        calls_before = self.get_sample('xonai_cloud_requests_total', {**labels, 'outcome': 'ok'})
+        with Stubber(client) as stubber:
+            stubber.add_response('list_clusters', {'Clusters': []})
+            client.list_clusters()
+        self.assertEqual(self.get_sample('xonai_cloud_requests_total', {**labels, 'outcome': 'ok'}), calls_before + 1)
+        self.assertGreaterEqual(self.get_sample('xonai_cloud_request_seconds_count', labels), 1)
+
+    def test_dbx_path_labels(self):
+        self.assertEqual(metrics.get_dbx_path_label('/api/2.0/clusters/events'), '/api/2.0/clusters/events')
+        self.assertEqual(metrics.get_dbx_path_label('/api/2.0/accounts/9b2d-41f7/billable-usage/download'), '/api/2.0/accounts/{id}/billable-usage/download')
+        self.assertEqual(metrics.get_dbx_path_label('/api/2.1/unity-catalog/tables/main.sales.orders'), '/api/2.1/unity-catalog/tables/{id}')
+        workspace_client = MagicMock()
+        metrics.instrument_dbx_client(workspace_client)
+        labels = {'service': 'databricks', 'operation': 'GET /api/2.1/jobs/runs/{id}/output'}
+        calls_before = self.get_sample('xonai_cloud_requests_total', {**labels, 'outcome': 'ok'})
+        workspace_client.api_client.do('GET', '/api/2.1/jobs/runs/4711/output')
+        self.assertEqual(self.get_sample('xonai_cloud_requests_total', {**labels, 'outcome': 'ok'}), calls_before + 1)
+
+    def test_tsdb_and_cache_metrics(self):
+        cache = LruCache(1024)
+        metrics.register_cache('test_cache', cache)
+        connection = TsdbConnection('http://tsdb:8428', cache=cache)
+        connection.async_client.transport = httpx.MockTransport(lambda request: httpx.Response(200, json={'status': 'success', 'data': ['c1']}))
+        ok_before = self.get_sample('xonai_tsdb_requests_total', {'endpoint': 'label_values', 'outcome': 'ok'})
+        cached_before = self.get_sample('xonai_tsdb_requests_total', {'endpoint': 'label_values', 'outcome': 'cached'})
+        connection.get_label_values('cluster_id', {'end': 1000})
+        connection.get_label_values('cluster_id', {'end': 1000})
+        connection.close()
+        self.assertEqual(self.get_sample('xonai_tsdb_requests_total', {'endpoint': 'label_values', 'outcome': 'ok'}), ok_before + 1)
+        self.assertEqual(self.get_sample('xonai_tsdb_requests_total', {'endpoint': 'label_values', 'outcome': 'cached'}), cached_before + 1)
+        self.assertEqual(self.get_sample('xonai_cache_hit_ratio', {'cache': 'test_cache'}), 0.5)
+        self.assertIn(b'xonai_tsdb_response_bytes_total{endpoint="label_values"}', metrics.get_exposition())
+
+
+if __name__ == '__main__':
+    unittest.main()
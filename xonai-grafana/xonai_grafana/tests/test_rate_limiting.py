@@ -0,0 +1,84 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from time import monotonic
+from unittest.mock import MagicMock, patch
+import boto3
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError
+from xonai_grafana.cost_estimation.estimator import EmrCostEstimator, is_error_retrieable
+from xonai_grafana.utils import metrics
+from xonai_grafana.utils.rate_limiting import AwsRateLimiter, TokenBucket
+
+
+class RateLimitingTestCase(unittest.TestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(max_rate=100.0, burst=2)
+        self.assertEqual(bucket.acquire(), 0.0)
+        self.assertEqual(bucket.acquire(), 0.0)
+        start = monotonic()
+        self.assertGreater(bucket.acquire(), 0.0)  # burst is used up, waits for the refill
+        self.assertGreaterEqual(monotonic() - start, 0.005)
+        self.assertEqual(bucket.waiting, 0)
+        bucket.on_throttled()
+        bucket.on_throttled()  # within the cooldown period
+        self.assertEqual(bucket.rate, 50.0)
+        self.assertLessEqual(bucket.tokens, 0.0)
+        for _ in range(20):
+            bucket.on_success()
+        self.assertEqual(bucket.rate, 100.0)
+
+    def test_shared_buckets(self):
+        limiter = AwsRateLimiter()
+        clients = [boto3.client(service, region_name=region, aws_access_key_id='key', aws_secret_access_key='secret')
+                   for (service, region) in [('emr', 'us-east-1'), ('emr', 'us-east-1'), ('ec2', 'us-east-1'), ('emr', 'eu-west-1')]]
+        for client in clients:
+            limiter.attach(client)
+        self.assertEqual(len(limiter.buckets), 3)
+        self.assertEqual(limiter.get_bucket('emr', 'us-east-1').rate, 5.0)
+        self.assertEqual(limiter.get_bucket('ec2', 'us-east-1').rate, 20.0)
+        bucket = limiter.get_bucket('emr', 'us-east-1')
+        throttled_before = metrics.registry.get_sample_value('xonai_cloud_throttled_total', {'service': 'emr', 'region': 'us-east-1'}) or 0.0
+        responses = clients[1].meta.events.emit('before-send.emr.ListClusters', request=None)
+        self.assertTrue(all(response is None for (_, response) in responses))  # the request is sent
+        self.assertLess(bucket.tokens, bucket.burst)
+        throttled_response = {'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}, 'ResponseMetadata': {'HTTPStatusCode': 400}}
+        clients[0].meta.events.emit('needs-retry.emr.ListClusters', response=(AWSResponse('https://emr', 400, {}, None), throttled_response), attempts=1, caught_exception=None,
+                                    operation=None, request_dict={'context': {}})
+        self.assertEqual(bucket.rate, 2.5)
+        self.assertEqual(limiter.get_bucket('emr', 'eu-west-1').rate, 5.0)
+        self.assertEqual(metrics.registry.get_sample_value('xonai_cloud_throttled_total', {'service': 'emr', 'region': 'us-east-1'}), throttled_before + 1)
+        self.assertEqual(metrics.registry.get_sample_value('xonai_cloud_limiter_rate', {'service': 'emr', 'region': 'us-east-1'}), 2.5)
+        self.assertEqual(metrics.registry.get_sample_value('xonai_cloud_limiter_waiting', {'service': 'emr', 'region': 'us-east-1'}), 0.0)
+
+    def test_retrieable_errors(self):
+        def get_error(code: str, status: int) -> ClientError:
+            return ClientError({'Error': {'Code': code, 'Message': ''}, 'ResponseMetadata': {'HTTPStatusCode': status}}, 'DescribeCluster')
+        self.assertTrue(is_error_retrieable(get_error('ThrottlingException', 400)))
+        self.assertTrue(is_error_retrieable(get_error('RequestLimitExceeded', 503)))
+        self.assertTrue(is_error_retrieable(get_error('InternalServerError', 500)))
+        self.assertFalse(is_error_retrieable(get_error('InvalidRequestException', 400)))
+        self.assertFalse(is_error_retrieable(ValueError()))
+
+    def test_bounded_retries(self):
+        estimator = MagicMock()
+        estimator._get_avail_zone.side_effect = ClientError({'Error': {'Code': 'ThrottlingException', 'Message': ''}}, 'DescribeCluster')
+        with patch('retrying.time.sleep') as sleep:
+            with self.assertRaises(ClientError):
+                EmrCostEstimator.estimate_cluster_cost(estimator, 'j-1')
+        self.assertEqual(estimator._get_avail_zone.call_count, 5)  # persistent throttling gives up
+        self.assertEqual(sleep.call_count, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import json
+import time
+import unittest
+import httpx
+from xonai_grafana.utils.caching import LruCache
+from xonai_grafana.utils.tsdb_client import TsdbConnection, TsdbClientException
+
+
+class TsdbClientTestCase(unittest.TestCase):
+    def test_bounded_fan_out(self):
+        in_flight = {'current': 0, 'max': 0}
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            in_flight['current'] += 1
+            in_flight['max'] = max(in_flight['max'], in_flight['current'])
+            await asyncio.sleep(0.01)
+            in_flight['current'] -= 1
+            value = request.url.params['query']
+            return httpx.Response(200, json={'status': 'success', 'data': {'resultType': 'vector', 'result': [{'metric': {}, 'value': [0, value]}]}})
+        connection = TsdbConnection('http://tsdb:8428', max_concurrency=2)
+        connection.async_client.transport = httpx.MockTransport(handler)
+        queries = [f'query_{index}' for index in range(8)]
+        results = connection.run_all(connection.async_client.custom_query(query) for query in queries)
+        self.assertEqual([result[0]['value'][1] for result in results], queries)  # supplied order
+        self.assertEqual(in_flight['max'], 2)
+        self.assertEqual(connection.custom_query('single')[0]['value'][1], 'single')  # synchronous facade
+        connection.close()
+
+    def test_error_status(self):
+        connection = TsdbConnection('http://tsdb:8428')
+        connection.async_client.transport = httpx.MockTransport(lambda request: httpx.Response(422, text='bad query'))
+        with self.assertRaises(TsdbClientException):
+            connection.get_label_values('cluster_id')
+        connection.close()
+
+    def test_query_cache(self):
+        requests = []
+        payload = {'status': 'success', 'data': {'resultType': 'vector', 'result': [{'metric': {}, 'value': [0, '1']}]}}
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            requests.append(request.url.params['query'])
+            return httpx.Response(200, json=payload)
+        cache = LruCache(1024 * 1024)
+        connection = TsdbConnection('http://tsdb:8428', cache=cache)
+        connection.async_client.transport = httpx.MockTransport(handler)
+        past = round(time.time()) - 86400
+        connection.custom_query('up{job="node_scraper"}', {'time': past})
+        connection.custom_query(' up{job="node_scraper"}\n', {'time': past})  # surrounding whitespace is ignored
+        self.assertEqual(len(requests), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.weight, len(json.dumps(payload)) * connection.async_client.decoded_size_factor)  # weighed by response size
+        connection.custom_query('up{job="node  scraper"}', {'time': past})  # whitespace within label values matters
+        connection.custom_query('up{job="node_scraper"}', {'time': past + 10})  # other evaluation time
+        self.assertEqual(len(requests), 3)
+        connection.async_client.recent_ttl = 0  # windows that touch the present expire
+        connection.custom_query('up', {'time': round(time.time())})
+        connection.custom_query('up')
+        connection.custom_query('up')
+        self.assertEqual(len(requests), 6)
+        connection.close()
+
+    def test_retries(self):
+        responses = [httpx.ConnectError('connection refused'), httpx.Response(503, text='unavailable'),
+                     httpx.Response(200, json={'status': 'success', 'data': ['c1']})]
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+        connection = TsdbConnection('http://tsdb:8428')
+        connection.async_client.transport = httpx.MockTransport(handler)
+        connection.async_client.retry_backoff = 0.001
+        self.assertEqual(connection.get_label_values('cluster_id'), ['c1'])
+        self.assertEqual(len(responses), 0)
+        responses.extend(httpx.Response(500, text='overloaded') for _ in range(5))
+        with self.assertRaises(TsdbClientException):  # gives up after three retries
+            connection.get_label_values('cluster_id')
+        self.assertEqual(len(responses), 1)
+        connection.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
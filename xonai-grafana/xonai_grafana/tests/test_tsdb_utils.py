@@ -11,6 +11,7 @@
 # limitations under the License.
 
 import unittest
+from xonai_grafana.schemata.cloud_objects import SupportedPlatforms, DbxCluster
 from xonai_grafana.tests.utilities import TestUtils
 from xonai_grafana.utils.tsdb import TsdbUtils
 
@@ -40,7 +41,7 @@ class TsdbUtilsTestCase(unittest.TestCase):
         (max_val, mean) = tsdb_utils._summarize_stats(self.metric_data[0]['values'])
         metric_vals = [float(value[1]) for value in self.metric_data[0]['values']]
         self.assertEqual(max(metric_vals), max_val)
-        self.assertEqual(sum(metric_vals) / len(metric_vals), mean)
+        self.assertAlmostEqual(sum(metric_vals) / len(metric_vals), mean, places=12)  # pairwise summation
 
     def test_lookbacks(self):
         start = 1697875200  # Saturday, 21 October 2023 09:00:00 GMT+01:00
@@ -79,6 +80,136 @@ class TsdbUtilsTestCase(unittest.TestCase):
         self.assertEqual(start, '1710167280.299')
         self.assertEqual(end, '1710173301.361')
 
+    def test_regex_chunking(self):
+        self.assertEqual(TsdbUtils.escape_regex('j-1ABC'), 'j-1ABC')
+        self.assertEqual(TsdbUtils.escape_regex('app.1|x'), 'app\\\\.1\\\\|x')  # doubled for PromQL string literals
+        self.assertEqual(TsdbUtils.join_regex(['a', 'b', 'c']), 'a|b|c')
+        tsdb_utils = TsdbUtils()
+        tsdb_utils.max_matcher_length = 10
+        app_ids = ['app_1', 'app_2', 'app_3', 'app_4', 'app_5']
+        chunks = tsdb_utils._chunk_values(app_ids)
+        self.assertEqual(chunks, [['app_1'], ['app_2'], ['app_3'], ['app_4'], ['app_5']])
+        tsdb_utils.max_matcher_length = 12
+        chunks = tsdb_utils._chunk_values(app_ids)
+        self.assertEqual(chunks, [['app_1', 'app_2'], ['app_3', 'app_4'], ['app_5']])
+        self.assertEqual([app_id for chunk in chunks for app_id in chunk], app_ids)
+        self.assertEqual(tsdb_utils._chunk_values([]), [])
+
+    def test_bulk_app_resolution(self):
+        tsdb_utils = TsdbUtils()
+        tsdb_utils.max_matcher_length = 12
+        issued_queries = []
+
+        def grouped_query(query, params):
+            issued_queries.append(query)
+            return [{'metric': {'app_id': 'app_2', 'cluster_id': 'c2'}, 'value': [params['time'], '1']},
+                    {'metric': {'app_id': 'app_1', 'cluster_id': 'c1'}, 'value': [params['time'], '1']}]
+        tsdb_utils.prom_client.async_client.get_label_values = TestUtils.as_coroutine(lambda label, params: ['app_1', 'app_2', 'app_3'])
+        tsdb_utils.prom_client.async_client.custom_query = TestUtils.as_coroutine(grouped_query)
+        app_cluster_ids = tsdb_utils.get_app_cluster_ids(1697875200, 1697877900)
+        self.assertEqual(app_cluster_ids, [('app_1', 'c1'), ('app_2', 'c2')])  # app_3 unresolved
+        self.assertEqual(len(issued_queries), 2)  # two chunks instead of three per-app queries
+        self.assertIn('app_id=~"app_1|app_2"', issued_queries[0])
+
+    def test_instance_inventory(self):
+        tsdb_utils = TsdbUtils()
+        series = [{'__name__': 'up', 'job': 'node_scraper', 'cluster_id': 'c1', 'instance': 'i-2', 'instance_type': 'm5.xlarge', 'role': 'core'},
+                  {'__name__': 'up', 'job': 'node_scraper', 'cluster_id': 'c1', 'instance': 'i-1', 'instance_type': 'm5.2xlarge', 'role': 'master'},
+                  {'__name__': 'up', 'job': 'node_scraper', 'cluster_id': 'c2', 'instance': 'i-3', 'instance_type': 'm5.xlarge', 'role': 'core'},
+                  {'__name__': 'up', 'job': 'node_scraper', 'cluster_id': 'c1', 'instance': 'i-3', 'instance_type': 'm5.xlarge', 'role': 'core'}]
+        tsdb_utils.prom_client.async_client.get_series = TestUtils.as_coroutine(lambda params: series)
+
+        def grouped_query(query, params):
+            if query.startswith('min'):
+                return [{'metric': {'instance': 'i-1'}, 'value': [params['time'], '1710172091.361']},
+                        {'metric': {'instance': 'i-2'}, 'value': [params['time'], '1710172101.4']}]
+            return [{'metric': {'instance': 'i-1'}, 'value': [params['time'], '1710173301.361']}]
+        tsdb_utils.prom_client.async_client.custom_query = TestUtils.as_coroutine(grouped_query)
+        instance_times, type_role = tsdb_utils.get_instance_list('c.*', 1710170000, 1710180000, SupportedPlatforms.AWS_EMR)
+        self.assertEqual([times[0] for times in instance_times], ['i-1', 'i-2'])  # i-3 has two cluster IDs
+        self.assertEqual(instance_times[0][1:4], ('c1', 1710172091000, 1710173301000))
+        self.assertEqual(instance_times[1][1:4], ('c1', 1710172101000, 0))
+        self.assertEqual(type_role, [('m5.2xlarge', 'master'), ('m5.xlarge', 'core')])
+        _, type_role = tsdb_utils.get_instance_list('c.*', 1710170000, 1710180000, SupportedPlatforms.AWS_DBX)
+        self.assertEqual(type_role, [('m5.2xlarge', 'worker'), ('m5.xlarge', 'worker')])
+
+    def test_summarized_utilization(self):
+        tsdb_utils = TsdbUtils()
+        issued_queries = []
+
+        def summary_query(query, params):
+            issued_queries.append((query, params))
+            return [{'metric': {'cluster_id': 'c1', 'stat': 'max'}, 'value': [params['time'], '0.75']},
+                    {'metric': {'cluster_id': 'c1', 'stat': 'avg'}, 'value': [params['time'], '0.25']}]
+        tsdb_utils.prom_client.async_client.custom_query = TestUtils.as_coroutine(summary_query)
+        terminated_cluster = DbxCluster.create_dummy('c1', 1710170000000, 1710173600000)
+        cpu_util, mem_util = tsdb_utils.get_cluster_utilizations(terminated_cluster)
+        self.assertEqual(cpu_util, (0.75, 0.25))
+        self.assertEqual(mem_util, (0.75, 0.25))
+        self.assertEqual(len(issued_queries), 2)
+        self.assertIn('max_over_time((1 - (avg by (cluster_id) (irate(node_cpu_seconds_total{cluster_id="c1", mode="idle"}[40s]))))[3600s:10s])', issued_queries[0][0])
+        self.assertEqual(issued_queries[0][1]['time'], 1710173600)  # evaluated at termination time
+        active_cluster = DbxCluster(('c2', '', 'RUNNING', 1710170000000, 0, None, 0, 'NA', 'NA', 'NA'))
+        self.assertEqual(tsdb_utils.get_cluster_utilizations(active_cluster), ((None, None), (None, None)))
+        self.assertEqual(len(issued_queries), 2)
+
+    def test_window_grouping(self):
+        tsdb_utils = TsdbUtils()
+        windows = [(0, 'c1', 0.0, 7200.0), (1, 'c2', 3600.0, 10800.0), (2, 'c3', 100000.0, 101000.0), (3, 'c4', 100500.0, 102000.0),
+                   (4, 'c5', 200000.0, 210000.0)]
+        groups = tsdb_utils._group_windows(windows)
+        self.assertEqual([[window[1] for window in group] for group in groups], [['c1', 'c2'], ['c3', 'c4'], ['c5']])
+        tsdb_utils.max_matcher_length = 3
+        groups = tsdb_utils._group_windows(windows)
+        self.assertEqual(len(groups), 5)
+
+    def test_batched_utilizations(self):
+        tsdb_utils = TsdbUtils()
+        issued_queries = []
+
+        def grouped_query(query, params):
+            issued_queries.append(query)
+            return [{'metric': {'cluster_id': 'c1', 'stat': 'max'}, 'value': [params['time'], '0.8']},
+                    {'metric': {'cluster_id': 'c1', 'stat': 'avg'}, 'value': [params['time'], '0.4']},
+                    {'metric': {'cluster_id': 'c3', 'stat': 'max'}, 'value': [params['time'], '0.6']},
+                    {'metric': {'cluster_id': 'c3', 'stat': 'avg'}, 'value': [params['time'], '0.2']}]
+        tsdb_utils.prom_client.async_client.custom_query = TestUtils.as_coroutine(grouped_query)
+        clusters = [DbxCluster.create_dummy('c1', 1710170000000, 1710173600000),
+                    DbxCluster(('c2', '', 'RUNNING', 1710170000000, 0, None, 0, 'NA', 'NA', 'NA')),
+                    DbxCluster.create_dummy('c3', 1710171000000, 1710174600000),
+                    DbxCluster.create_dummy('c4', 1710172000000, 1710175600000)]
+        utilizations = tsdb_utils.get_clusters_utilizations(clusters)
+        self.assertEqual(len(issued_queries), 2)  # one CPU & one memory query for all terminated clusters
+        self.assertIn('cluster_id=~"c1|c3|c4"', issued_queries[0])
+        self.assertEqual(utilizations[0], ((0.8, 0.4), (0.8, 0.4)))
+        self.assertEqual(utilizations[1], ((None, None), (None, None)))  # active cluster
+        self.assertEqual(utilizations[2], ((0.6, 0.2), (0.6, 0.2)))
+        self.assertEqual(utilizations[3], ((None, None), (None, None)))  # no data in DB
+
+    def test_combined_resources(self):
+        tsdb_utils = TsdbUtils()
+        issued_queries = []
+
+        def resources_query(query, params):
+            issued_queries.append(query)
+            return [{'metric': {'resource': 'ram'}, 'value': [params['time'], '64000']}, {'metric': {'resource': 'nodes'}, 'value': [params['time'], '3']},
+                    {'metric': {'resource': 'cores'}, 'value': [params['time'], '12']}]
+        tsdb_utils.prom_client.async_client.custom_query = TestUtils.as_coroutine(resources_query)
+        self.assertEqual(tsdb_utils.get_resources('c1|c2', 1710170000, 1710173600), ('3', '12', '64000', 0.0))  # no disk series
+        self.assertEqual(len(issued_queries), 1)
+        self.assertIn('label_set(count(last_over_time(up{job="node_scraper", cluster_id=~"c1|c2"}[1h])), "resource", "nodes")', issued_queries[0])
+        self.assertEqual(tsdb_utils.get_resources('', 1710170000, 1710173600), (0, 0, 0, 0))
+        self.assertEqual(len(issued_queries), 1)
+
+    def test_array_parsing(self):
+        values = TsdbUtils.values_to_array([[1710170000, '0.5'], [1710170010, '1.5'], [1710170020, 'NaN']])
+        self.assertEqual(values[:2].tolist(), [0.5, 1.5])
+        self.assertEqual(TsdbUtils.summarize_array(values), (1.5, 1.0))  # NaN skipped
+        self.assertEqual(TsdbUtils.summarize_array(values[2:]), (0.0, 0.0))
+        self.assertEqual(TsdbUtils.summarize_array(values[:0]), (0.0, 0.0))
+        self.assertEqual(TsdbUtils.extract_multi_value([{'value': [0, '999.5']}, {'value': [0, '1000']}], False), '1000')  # numeric comparison
+        self.assertEqual(TsdbUtils()._summarize_stats([(0, 'x')]), (0.0, 0.0))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -12,11 +12,19 @@
 
 """Module containing test functionality."""
 from datetime import datetime
+from typing import Callable
 from dateutil.tz import tzlocal
 
 
 class TestUtils:
     """Wrapper for literals that are needed across different test cases."""
+    @staticmethod
+    def as_coroutine(function: Callable) -> Callable:
+        """Wraps a synchronous fake so it can replace a method of the async TSDB client."""
+        async def wrapper(*args, **kwargs):
+            return function(*args, **kwargs)
+        return wrapper
+
     cost_info = {
         "TOTAL": 1.0,
         "CORE.EC2": 2.0,
@@ -0,0 +1,273 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module containing caching functionality."""
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Callable, Dict, Generic, Hashable, List, Optional, Tuple, TypeVar
+from xonai_grafana.utils.logging import LoggerUtils
+
+logger = LoggerUtils.create_logger('caching')
+T = TypeVar('T')
+_absent = object()  # distinguishes absent entries from cached None values
+
+
+def estimate_size(obj: Any) -> int:
+    """Returns the approximate memory footprint in bytes of an object graph made of containers, strings, and numbers."""
+    seen = set()
+    pending = [obj]
+    size = 0
+    while len(pending) > 0:
+        current = pending.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+        if isinstance(current, dict):
+            pending.extend(current.keys())
+            pending.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            pending.extend(current)
+        elif hasattr(current, '__dict__'):
+            pending.append(vars(current))
+    return size
+
+
+class LruCache:
+    """
+        Thread-safe LRU cache bounded by the summed weight of its entries (e.g., entry count or bytes).
+        Entries can expire after a time-to-live, hits, misses, and evictions are counted.
+    """
+    def __init__(self, max_weight: int):
+        self.max_weight = max_weight
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[Hashable, Tuple[Any, int, Optional[float]]] = OrderedDict()  # value, weight, monotonic expiry
+        self._weight = 0
+        self._lock = threading.Lock()
+
+    def _remove(self, key: Hashable) -> None:
+        """Removes an entry, the lock must be held by the caller."""
+        (_, weight, _) = self._entries.pop(key)
+        self._weight -= weight
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Returns the cached value and marks it as recently used, the default is returned for absent or expired entries."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] <= monotonic():  # expired
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, weight: int = 1, ttl: Optional[float] = None) -> None:
+        """Caches a value, least recently used entries are evicted until the weight bound holds again. No expiry without ttl."""
+        if weight > self.max_weight:  # would evict everything else
+            return
+        expiry = None if ttl is None else monotonic() + ttl
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, weight, expiry)
+            self._weight += weight
+            while self._weight > self.max_weight:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def replace(self, key: Hashable, value: Any) -> bool:
+        """Replaces the value of an unexpired entry and keeps its weight, expiry, and recency. Returns whether the entry was present."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[2] is not None and entry[2] <= monotonic()):
+                return False
+            self._entries[key] = (value, entry[1], entry[2])
+            return True
+
+    def pop(self, key: Hashable) -> None:
+        """Removes an entry if present."""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self) -> None:
+        """Removes all entries, counters are kept."""
+        with self._lock:
+            self._entries.clear()
+            self._weight = 0
+
+    def keys(self) -> List[Hashable]:
+        """Returns the keys of all unexpired entries, from least to most recently used."""
+        with self._lock:
+            now = monotonic()
+            return [key for key, entry in self._entries.items() if entry[2] is None or entry[2] > now]
+
+    def get_hit_ratio(self) -> float:
+        """Returns the share of lookups that were answered from the cache."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    @property
+    def weight(self) -> int:
+        return self._weight
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:  # does not count as hit or miss
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and (entry[2] is None or entry[2] > monotonic())
+
+
+class PersistentCache(Generic[T]):
+    """
+        Two-tier cache with string keys: A bounded in-memory LRU in front of a table in a local SQLite file. Entries do not expire,
+        survive restarts, and are shared by all worker processes that use the same file. Values are stored with the supplied
+        (de)serialization functions. Without a file, or if the file cannot be used, only the in-memory tier is used.
+    """
+    def __init__(self, name: str, max_entries: int, db_file: Optional[str], serialize: Callable[[T], str], deserialize: Callable[[str], T]):
+        if not name.isidentifier():
+            raise ValueError(f'Cache name {name} is not a valid table name')
+        self.name = name
+        self.memory = LruCache(max_entries)
+        self.serialize = serialize
+        self.deserialize = deserialize
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        if db_file is not None and db_file != '':
+            try:
+                self._connection = sqlite3.connect(db_file, check_same_thread=False)
+                self._connection.execute('PRAGMA journal_mode=WAL')  # readers in other processes are not blocked by writes
+                self._connection.execute(f'CREATE TABLE IF NOT EXISTS {name} (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID')
+            except sqlite3.Error as e:
+                logger.warning('Could not open cache database %s, caching %s in memory only:', db_file, name, exc_info=e)
+                self._connection = None
+
+    def _load(self, key: str) -> Any:
+        """Returns the deserialized value from the on-disk tier, or the absent marker."""
+        if self._connection is None:
+            return _absent
+        try:
+            with self._lock:
+                row = self._connection.execute(f'SELECT value FROM {self.name} WHERE key = ?', (key,)).fetchone()
+            return _absent if row is None else self.deserialize(row[0])
+        except Exception as e:
+            logger.warning('Could not read %s from cache %s:', key, self.name, exc_info=e)
+            return _absent
+
+    def get(self, key: str, default: Optional[T] = None) -> Optional[T]:
+        """Returns the cached value, entries found on disk are promoted to the in-memory tier."""
+        value = self.memory.get(key, _absent)
+        if value is _absent:
+            value = self._load(key)
+            if value is _absent:
+                return default
+            self.memory.put(key, value)
+        return value
+
+    def put(self, key: str, value: T) -> None:
+        """Caches a value in memory and on disk."""
+        self.memory.put(key, value)
+        if self._connection is None:
+            return
+        try:
+            serialized_value = self.serialize(value)
+            with self._lock, self._connection:  # commits on success
+                self._connection.execute(f'INSERT OR REPLACE INTO {self.name} VALUES (?, ?)', (key, serialized_value))
+        except Exception as e:
+            logger.warning('Could not persist %s in cache %s:', key, self.name, exc_info=e)
+
+    def _exists(self, key: str) -> bool:
+        """Returns whether the on-disk tier contains a key without reading its value."""
+        if self._connection is None:
+            return False
+        try:
+            with self._lock:
+                return self._connection.execute(f'SELECT 1 FROM {self.name} WHERE key = ?', (key,)).fetchone() is not None
+        except Exception as e:
+            logger.warning('Could not look up %s in cache %s:', key, self.name, exc_info=e)
+            return False
+
+    def __contains__(self, key: str) -> bool:  # use get() to read the value, membership tests do not deserialize or promote entries
+        return key in self.memory or self._exists(key)
+
+    def __getitem__(self, key: str) -> T:
+        value = self.get(key, _absent)
+        if value is _absent:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: T) -> None:
+        self.put(key, value)
+
+    def close(self) -> None:
+        if self._connection is not None:
+            with self._lock:
+                self._connection.close()
+                self._connection = None
+
+
+class _Flight:
+    """Computation in progress, shared by all callers of the same key."""
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+        Coalesces concurrent calls with the same key: The first caller computes the result, callers that arrive while the computation
+        is in flight wait for it and share its result or exception. Nothing is kept once the computation has finished.
+    """
+    def __init__(self):
+        self.coalesced = 0  # number of calls that were answered by another computation
+        self._flights: Dict[Hashable, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def run(self, key: Hashable, function: Callable[[], T]) -> T:
+        """Returns the result of the function, joins an in-flight computation for the same key if there is one."""
+        with self._lock:
+            flight = self._flights.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = _Flight()
+                self._flights[key] = flight
+            else:
+                self.coalesced += 1
+        if not is_leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = function()
+            return flight.result
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
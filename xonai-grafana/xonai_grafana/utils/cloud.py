@@ -11,12 +11,14 @@
 # limitations under the License.
 
 """Module containing functionality related to cloud entities."""
+from concurrent.futures import Future
 from datetime import datetime
+from functools import partial
 from dateutil.parser import parse
 from typing import Dict, List, Iterator, Tuple, Optional, Set
 from databricks.sdk.service.compute import ClusterDetails, State
 from xonai_grafana.cost_estimation.estimator import DbxClusterType, CostMap
-from xonai_grafana.schemata.cloud_objects import ListedCluster, DescribedEmrCluster, EmrCluster, DbxCluster, SupportedPlatforms
+from xonai_grafana.schemata.cloud_objects import ListedCluster, DescribedEmrCluster, DbxCluster, SupportedPlatforms
 from xonai_grafana.utils.dependencies import Inject
 from xonai_grafana.utils.logging import LoggerUtils
 from xonai_grafana.utils.tsdb import TsdbUtils, TsdbQuery, IdPair
@@ -48,33 +50,34 @@ class ClusterUtils:
     @classmethod
     def get_total_utilization(cls, cluster_ids: Set[str], start: int, end: int, inj: Inject) -> Tuple[float, int]:
         """Determines total utilization of tracked clusters of known apps. Used for compute utilization panel."""
-        cpu_utils = 0.0
-        considered_clusters = 0
+        clusters: List[DescribedEmrCluster | DbxCluster] = []
         for relevant_id in cluster_ids:
             if inj.platform is SupportedPlatforms.AWS_EMR:
-                cluster_desc: DescribedEmrCluster = EmrUtils.check_cluster_cache(relevant_id, inj)
-                (cpu_util, _) = inj.tsdb_client.get_cluster_utilizations(cluster_desc)
-                if cpu_util[1] is not None:
-                    cpu_utils += cpu_util[1]
-                    considered_clusters += 1
+                clusters.append(EmrUtils.check_cluster_cache(relevant_id, inj))
             elif inj.platform is SupportedPlatforms.AWS_DBX:
-                cluster_first, cluster_last = inj.tsdb_client._get_cluster_times(relevant_id, start, end, SupportedPlatforms.AWS_DBX)
-                dummy_cluster: DbxCluster = DbxCluster.create_dummy(relevant_id, cluster_first * 1000, cluster_last * 1000)
-                (cpu_util, _) = inj.tsdb_client.get_cluster_utilizations(dummy_cluster)
-                if cpu_util[1] is not None:
-                    cpu_utils += cpu_util[1]
-                    considered_clusters += 1
+                cluster_first, cluster_last = inj.tsdb_client.get_cluster_times(relevant_id, start, end, SupportedPlatforms.AWS_DBX)
+                clusters.append(DbxCluster.create_dummy(relevant_id, cluster_first * 1000, cluster_last * 1000))
+        cpu_utils = 0.0
+        considered_clusters = 0
+        for (cpu_util, _) in inj.tsdb_client.get_clusters_utilizations(clusters):
+            if cpu_util[1] is not None:
+                cpu_utils += cpu_util[1]
+                considered_clusters += 1
         total_util = cpu_utils / considered_clusters if considered_clusters > 0 else 0
         return total_util, considered_clusters
 
     @classmethod
     def get_active_resources(cls, inj: Inject, start: int) -> Tuple[int, int, int, int]:
         """Fetches # active nodes, # CPUs, total RAM, and total disk from the DB. Used for active resources panel."""
-        active_ids: Set[str] = set()
-        if inj.platform == SupportedPlatforms.AWS_EMR:
-            active_ids = EmrUtils.get_active_cluster_ids(inj.client_emr)
-        if inj.platform == SupportedPlatforms.AWS_DBX:
-            active_ids = DbxUtils.get_active_cluster_ids(inj.client_dbx)
+        cache_key = (inj.platform, inj.current_region)
+        active_ids: Optional[Set[str]] = inj.active_ids_cache.get(cache_key)  # auto-refreshing panel, cluster APIs are only listed every few seconds
+        if active_ids is None:
+            active_ids = set()
+            if inj.platform == SupportedPlatforms.AWS_EMR:
+                active_ids = EmrUtils.get_active_cluster_ids(inj.client_emr)
+            if inj.platform == SupportedPlatforms.AWS_DBX:
+                active_ids = DbxUtils.get_active_cluster_ids(inj.client_dbx)
+            inj.active_ids_cache.put(cache_key, active_ids, ttl=inj.active_ids_ttl)
         concatenated_ids = '|'.join(active_ids)  # multi variable values in Grafana
         now = int(datetime.now().strftime('%s'))
         return inj.tsdb_client.get_resources(concatenated_ids, start, now)
@@ -111,13 +114,33 @@ class EmrUtils:
         cluster_ids = {cluster.Id for cluster in cluster_list}
         return cluster_ids
 
+    @classmethod
+    def get_costs(cls, cluster_ids: List[str], inj: Inject) -> List[CostMap]:
+        """
+            Returns the costs of several clusters in the supplied order. Cached costs are returned right away, cold estimations run
+            concurrently in the bounded worker pool that all requests share. Concurrent estimations of the same cluster are coalesced.
+        """
+        costs: List[Optional[CostMap]] = [None] * len(cluster_ids)
+        pending_positions: Dict[str, List[int]] = {}
+        for position, cluster_id in enumerate(cluster_ids):
+            cached_cost: Optional[CostMap] = inj.cost_cache.get(cluster_id)
+            if cached_cost is not None:
+                costs[position] = cached_cost
+            else:
+                pending_positions.setdefault(cluster_id, []).append(position)
+        futures: Dict[str, Future] = {}
+        for cluster_id in pending_positions.keys():
+            futures[cluster_id] = inj.cost_executor.submit(inj.cost_flights.run, cluster_id, partial(cls.check_cost_cache, cluster_id, inj))
+        for cluster_id, positions in pending_positions.items():
+            cluster_cost: CostMap = futures[cluster_id].result()
+            for position in positions:
+                costs[position] = cluster_cost
+        return costs
+
     @classmethod
     def get_clusters_costs(cls, cluster_ids: Set[str], inj: Inject) -> CostMap:
         """Helper function fetch costs for multiple clusters."""
-        calculated_prices: List[CostMap] = []
-        for cluster_id in cluster_ids:
-            calculated_price: CostMap = cls.check_cost_cache(cluster_id, inj)
-            calculated_prices.append(calculated_price)
+        calculated_prices: List[CostMap] = cls.get_costs(list(cluster_ids), inj)
         total_costs = ClusterUtils.add_costs(calculated_prices)
         return total_costs
 
@@ -130,32 +153,17 @@ class EmrUtils:
         return cls.check_cost_cache(cluster_string, inj)
 
     @classmethod
-    def get_cluster_ids(cls, emr_client, kwargs) -> Iterator[str]:
+    def get_cluster_ids(cls, inj: Inject, created_after: datetime, created_before: datetime) -> List[str]:
         """Return IDs of EMR clusters, used not for main but variables loop."""
-        while True:
-            cluster_list = emr_client.list_clusters(**kwargs)
-            for cluster in cluster_list['Clusters']:
-                yield cluster['Id']
-            try:
-                kwargs['Marker'] = cluster_list['Marker']
-            except KeyError:
-                break
+        return [listed_cluster.Id for listed_cluster in inj.cluster_store.list_clusters(inj.client_emr, created_after, created_before)]
 
     @classmethod
     def check_cluster_cache(cls, cluster_id: str, inj: Inject) -> DescribedEmrCluster:
         """
-            Check internal cache for given cluster ID and return info. If absent, query AWS API and put
-            the description into cache if cluster has terminated.
+            Return the description of a cluster from the shared metadata store. If absent, query AWS API, descriptions of terminated
+            clusters are cached persistently, those of active clusters for a short time.
         """
-        if cluster_id in inj.cluster_cache:
-            return inj.cluster_cache[cluster_id]
-        response_desc = inj.client_emr.describe_cluster(ClusterId=cluster_id)
-        if 'EndDateTime' not in response_desc['Cluster']['Status']['Timeline']:  # Active clusters
-            response_desc['Cluster']['Status']['Timeline']['EndDateTime'] = None
-        cluster_desc: DescribedEmrCluster = EmrCluster(**response_desc).Cluster
-        if 'TERMINATED' in cluster_desc.Status.State:  # TERMINATED'|'TERMINATED_WITH_ERRORS'
-            inj.cluster_cache[cluster_id] = cluster_desc
-        return cluster_desc
+        return inj.cluster_store.describe(inj.client_emr, cluster_id)
 
     @classmethod
     def check_cost_cache(cls, cluster_id: str, inj: Inject) -> CostMap:
@@ -163,8 +171,9 @@ class EmrUtils:
             Check internal cost cache for given cluster ID and return cost info. If absent, query AWS APIs and put cost info into cache if cluster
             has terminated.
         """
-        if cluster_id in inj.cost_cache:
-            return inj.cost_cache[cluster_id]
+        cached_cost: Optional[CostMap] = inj.cost_cache.get(cluster_id)
+        if cached_cost is not None:
+            return cached_cost
         try:
             cluster_desc: DescribedEmrCluster = cls.check_cluster_cache(cluster_id, inj)
             if not any(cluster_desc):  # cluster immediately terminated
@@ -174,36 +183,25 @@ class EmrUtils:
                 return cls._empty_costmap()
             if 'TERMINATED' in cluster_desc.Status.State:  # TERMINATED'|'TERMINATED_WITH_ERRORS'
                 inj.cost_cache[cluster_id] = estimated_cost
+                inj.instance_cost_cache.pop(cluster_id)  # instance costs are only needed while the cluster runs
             return estimated_cost
         except Exception as e:  # e.g., cancelled clusters might have missing API info
             logger.warning('Problems when getting cluster cost for %s', cluster_id, exc_info=e)
             return cls._empty_costmap()
 
     @classmethod
-    def get_cluster_descriptions(cls, inj: Inject, start: str, end: str) -> Iterator[DescribedEmrCluster]:
-        """Transform a sequence of listed clusters into a sequence of described clusters."""
-        kwargs = {'CreatedAfter': parse(start), 'CreatedBefore': parse(end)}
-        while True:
-            cluster_list = inj.client_emr.list_clusters(**kwargs)
-            for cluster in cluster_list['Clusters']:
-                if 'EndDateTime' not in cluster['Status']['Timeline']:  # Active clusters
-                    cluster['Status']['Timeline']['EndDateTime'] = None
-                listed_cluster: ListedCluster = ListedCluster(**cluster)
-                yield cls.check_cluster_cache(listed_cluster.Id, inj)
-            try:
-                kwargs['Marker'] = cluster_list['Marker']
-            except KeyError:
-                break
+    def get_cluster_descriptions(cls, inj: Inject, start: str, end: str) -> List[DescribedEmrCluster]:
+        """Transform a list of listed clusters into a list of described clusters, only clusters with unknown tags are described."""
+        listed_clusters: List[ListedCluster] = inj.cluster_store.list_clusters(inj.client_emr, parse(start), parse(end))
+        return inj.cluster_store.describe_listed(inj.client_emr, listed_clusters)
 
     @classmethod
     def get_app_list(cls, app_cluster_ids: List[IdPair], start: int, end: int, inj: Inject) -> Tuple[List[DescribedEmrCluster], List[Tuple[int, int]], List[CostMap]]:
         """Fetches cluster descriptions, task/cpu time pairs, and cluster costs. Used in general overview panel."""
-        cluster_descs: List[DescribedEmrCluster] = []
         app_times: List[Tuple[int, int]] = []  # application list panel
-        calculated_prices: List[CostMap] = []
-        for (app_id, cluster_id) in app_cluster_ids:
-            calculated_prices.append(EmrUtils.check_cost_cache(cluster_id, inj))
-            cluster_descs.append(EmrUtils.check_cluster_cache(cluster_id, inj))
+        calculated_prices: List[CostMap] = cls.get_costs([cluster_id for (_, cluster_id) in app_cluster_ids], inj)
+        cluster_descs: List[DescribedEmrCluster] = inj.cluster_store.describe_all(inj.client_emr, [cluster_id for (_, cluster_id) in app_cluster_ids])
+        for (app_id, _) in app_cluster_ids:
             app_times.append(inj.tsdb_client.get_task_cpu_time(app_id, start, end))
         return cluster_descs, app_times, calculated_prices
 
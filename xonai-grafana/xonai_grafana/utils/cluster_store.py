@@ -0,0 +1,140 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module containing the shared store of EMR cluster metadata."""
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from typing import Callable, Dict, List, Optional, TypeVar
+from xonai_grafana.schemata.cloud_objects import DescribedEmrCluster, EmrCluster, ListedCluster
+from xonai_grafana.utils.caching import LruCache, PersistentCache, SingleFlight
+from xonai_grafana.utils.logging import LoggerUtils
+
+logger = LoggerUtils.create_logger('cluster store')
+T = TypeVar('T')
+ClusterCache = PersistentCache[DescribedEmrCluster]
+
+
+class ClusterMetadataStore:
+    """
+        EMR cluster metadata shared by the cost estimators, the panels, and the variable endpoint. Listings are kept for a few seconds and
+        supply state, timeline, and instance hours. Clusters are only described when fields that listings lack are requested, e.g. tags or
+        the availability zone. Descriptions of terminated clusters are kept in the persistent cluster cache, descriptions of active clusters
+        expire after a TTL. Missing descriptions are fetched concurrently, concurrent requests for the same cluster or listing share one
+        API call.
+    """
+    def __init__(self, cluster_cache: ClusterCache, max_entries: int = 10000, concurrency: int = 8):
+        self.cluster_cache = cluster_cache  # descriptions of terminated clusters
+        self.active_descriptions = LruCache(max_entries)
+        self.active_ttl = 60  # seconds
+        self.listings = LruCache(64)  # listed clusters per region & creation time range
+        self.listing_ttl = 15  # seconds
+        self.flights = SingleFlight()
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='cluster-describe')
+
+    @classmethod
+    def is_terminated(cls, cluster: ListedCluster) -> bool:
+        return 'TERMINATED' in cluster.Status.State  # TERMINATED'|'TERMINATED_WITH_ERRORS'
+
+    def _get_cached(self, cluster_id: str) -> Optional[DescribedEmrCluster]:
+        cluster_desc: Optional[DescribedEmrCluster] = self.cluster_cache.get(cluster_id)
+        if cluster_desc is None:
+            cluster_desc = self.active_descriptions.get(cluster_id)
+        return cluster_desc
+
+    def _put(self, cluster_desc: DescribedEmrCluster) -> None:
+        if self.is_terminated(cluster_desc):
+            self.cluster_cache[cluster_desc.Id] = cluster_desc
+            self.active_descriptions.pop(cluster_desc.Id)
+        else:
+            self.active_descriptions.put(cluster_desc.Id, cluster_desc, ttl=self.active_ttl)
+
+    def _describe(self, emr_client, cluster_id: str) -> DescribedEmrCluster:
+        """Calls elasticmapreduce:DescribeCluster and caches the description."""
+        response_desc = emr_client.describe_cluster(ClusterId=cluster_id)
+        if 'EndDateTime' not in response_desc['Cluster']['Status']['Timeline']:  # Active clusters
+            response_desc['Cluster']['Status']['Timeline']['EndDateTime'] = None
+        cluster_desc: DescribedEmrCluster = EmrCluster(**response_desc).Cluster
+        self._put(cluster_desc)
+        return cluster_desc
+
+    def describe(self, emr_client, cluster_id: str) -> DescribedEmrCluster:
+        """Returns the cached description of a cluster, describes it on a miss."""
+        cluster_desc = self._get_cached(cluster_id)
+        if cluster_desc is None:
+            cluster_desc = self.flights.run(cluster_id, partial(self._describe, emr_client, cluster_id))
+        return cluster_desc
+
+    def describe_all(self, emr_client, cluster_ids: List[str]) -> List[DescribedEmrCluster]:
+        """Returns the descriptions of several clusters in the supplied order, missing descriptions are fetched concurrently."""
+        descriptions: Dict[str, Optional[DescribedEmrCluster]] = {cluster_id: self._get_cached(cluster_id) for cluster_id in cluster_ids}
+        futures: Dict[str, Future] = {}
+        for cluster_id, cluster_desc in descriptions.items():
+            if cluster_desc is None:
+                futures[cluster_id] = self.executor.submit(self.describe, emr_client, cluster_id)
+        for cluster_id, future in futures.items():
+            descriptions[cluster_id] = future.result()
+        return [descriptions[cluster_id] for cluster_id in cluster_ids]
+
+    def _get_described_field(self, emr_client, cluster_id: str, get_field: Callable[[DescribedEmrCluster], Optional[T]]) -> Optional[T]:
+        """Returns a field that only descriptions contain, descriptions cached without it (e.g. by earlier versions) are replaced once."""
+        value = get_field(self.describe(emr_client, cluster_id))
+        if value is None:
+            value = get_field(self.flights.run(cluster_id, partial(self._describe, emr_client, cluster_id)))
+        return value
+
+    def get_avail_zone(self, emr_client, cluster_id: str) -> str:
+        """Returns the availability zone of a cluster."""
+        return self._get_described_field(emr_client, cluster_id, DescribedEmrCluster.get_avail_zone)
+
+    def get_collection_type(self, emr_client, cluster_id: str) -> Optional[str]:
+        """Returns whether a cluster uses instance groups or fleets, None if DescribeCluster does not tell."""
+        return self._get_described_field(emr_client, cluster_id, lambda cluster_desc: cluster_desc.InstanceCollectionType)
+
+    def _list_clusters(self, emr_client, created_after: datetime, created_before: datetime) -> List[ListedCluster]:
+        """Calls elasticmapreduce:ListClusters for all pages and caches the listing."""
+        listed_clusters: List[ListedCluster] = []
+        kwargs = {'CreatedAfter': created_after, 'CreatedBefore': created_before}
+        while True:
+            cluster_list = emr_client.list_clusters(**kwargs)
+            for cluster in cluster_list['Clusters']:
+                listed_clusters.append(ListedCluster.create_listed_cluster(cluster))
+            try:
+                kwargs['Marker'] = cluster_list['Marker']
+            except KeyError:
+                break
+        self.listings.put((emr_client.meta.region_name, created_after, created_before), listed_clusters, ttl=self.listing_ttl)
+        return listed_clusters
+
+    def list_clusters(self, emr_client, created_after: datetime, created_before: datetime) -> List[ListedCluster]:
+        """Returns the clusters of the client's region created in a time range, listings are reused for a few seconds."""
+        key = (emr_client.meta.region_name, created_after, created_before)
+        listed_clusters: Optional[List[ListedCluster]] = self.listings.get(key)
+        if listed_clusters is None:
+            listed_clusters = self.flights.run(key, partial(self._list_clusters, emr_client, created_after, created_before))
+        return listed_clusters
+
+    def describe_listed(self, emr_client, listed_clusters: List[ListedCluster]) -> List[DescribedEmrCluster]:
+        """
+            Returns the descriptions of listed clusters, only clusters that were never described or whose descriptions expired are described.
+            Active clusters take state, timeline, and instance hours from the listing. Their cached descriptions are updated with these fields
+            but keep their expiry, so fields that only descriptions contain, e.g. tags, are refreshed periodically.
+        """
+        cluster_descs = self.describe_all(emr_client, [listed_cluster.Id for listed_cluster in listed_clusters])
+        for position, (listed_cluster, cluster_desc) in enumerate(zip(listed_clusters, cluster_descs)):
+            if not self.is_terminated(cluster_desc):
+                cluster_descs[position] = cluster_desc.with_listing(listed_cluster)
+                if self.is_terminated(cluster_descs[position]):
+                    self._put(cluster_descs[position])  # moves to the persistent cache
+                else:
+                    self.active_descriptions.replace(cluster_desc.Id, cluster_descs[position])
+        return cluster_descs
@@ -12,13 +12,23 @@
 
 """Module containing dependency injection functionality."""
 import boto3
-from typing import Tuple
-from os import environ
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from typing import Tuple, Dict, Self, Optional
+from os import environ, path
 from databricks.sdk import WorkspaceClient
-from xonai_grafana.cost_estimation.estimator import EmrCostEstimator, DbxPricing, CostCache
-from xonai_grafana.schemata.cloud_objects import SupportedPlatforms, AllClusters, ClusterCache
+from xonai_grafana.cost_estimation.estimator import EmrCostEstimator, DbxPricing, CostCache, Ec2EmrPricing, PricingRegistry, resource_path
+from xonai_grafana.cost_estimation.spot_store import SpotPriceStore
+from xonai_grafana.schemata.cloud_objects import SupportedPlatforms, AllClusters, DescribedEmrCluster
+from xonai_grafana.utils.caching import LruCache, PersistentCache, SingleFlight
+from xonai_grafana.utils.cluster_store import ClusterCache, ClusterMetadataStore
 from xonai_grafana.utils.logging import LoggerUtils
+from xonai_grafana.utils.metrics import register_cache, instrument_boto3_client, instrument_dbx_client
+from xonai_grafana.utils.rate_limiting import AwsRateLimiter
 from xonai_grafana.utils.tsdb import TsdbUtils
+from xonai_grafana.utils.tsdb_client import get_int_env
 
 
 logger = LoggerUtils.create_logger('dependencies')
@@ -42,40 +52,99 @@ def get_cloud_env() -> Tuple[str, SupportedPlatforms]:
 
 
 class Inject:
-    """Class for dependency injection, holds cloud clients and cluster caches."""
+    """
+        Class for dependency injection, holds cloud clients and cluster caches.
+        Region-specific dependencies are resolved with :func:`for_region`, pricing info of several regions stays resident in a registry.
+    """
     def __init__(self, region: str, platform: SupportedPlatforms):
         self.current_region = region
         self.platform = platform
         self.tsdb_client = TsdbUtils()
+        self.active_ids_cache = LruCache(len(AllClusters.aws_regions))  # active cluster IDs per platform & region
+        self.active_ids_ttl = 15  # seconds
+        register_cache('active_cluster_ids', self.active_ids_cache)
+        pricing_budget = get_int_env('XONAI_PRICING_BUDGET_MB', 512) * 1024 * 1024
+        self._region_lock = threading.Lock()
         if self.platform is SupportedPlatforms.AWS_EMR:
-            self.cluster_cache: ClusterCache = {}  # cache for cluster descriptions of terminated clusters
-            self.cost_cache: CostCache = {}  # cache for cluster costs of terminated clusters
-            self.client_emr = boto3.client('emr', region_name=self.current_region)
-            self.client_ec2 = boto3.client('ec2', region_name=self.current_region)
-            self.calc = EmrCostEstimator(emr_client=self.client_emr, ec2_client=self.client_ec2, region=self.current_region)
+            cache_db_file = environ.get('XONAI_CACHE_DB', path.join(resource_path, 'cluster_cache.db'))
+            cache_entries = get_int_env('XONAI_CLUSTER_CACHE_ENTRIES', 10000)
+            self.cluster_cache: ClusterCache = PersistentCache('cluster_descriptions', cache_entries, cache_db_file, DescribedEmrCluster.model_dump_json,
+                                                               DescribedEmrCluster.model_validate_json)  # descriptions of terminated clusters
+            self.cost_cache: CostCache = PersistentCache('cluster_costs', cache_entries, cache_db_file, json.dumps, json.loads)  # costs of terminated clusters
+            register_cache('cluster_descriptions', self.cluster_cache.memory)
+            self.cluster_store = ClusterMetadataStore(self.cluster_cache, cache_entries, get_int_env('XONAI_DESCRIBE_CONCURRENCY', 8))  # shared by all regions
+            register_cache('active_cluster_descriptions', self.cluster_store.active_descriptions)
+            register_cache('cluster_listings', self.cluster_store.listings)
+            self.cost_executor = ThreadPoolExecutor(max_workers=get_int_env('XONAI_COST_CONCURRENCY', 8), thread_name_prefix='cost-estimation')
+            self.cost_flights = SingleFlight()  # concurrent requests for the same cluster share one estimation
+            register_cache('cluster_costs', self.cost_cache.memory)
+            self.instance_cost_cache = LruCache(get_int_env('XONAI_INSTANCE_COST_ENTRIES', 1000000))  # costs of ended instances of running clusters
+            register_cache('instance_costs', self.instance_cost_cache)
+            self.pricing_registry = PricingRegistry(lambda pricing_region: Ec2EmrPricing(pricing_region, resource_path), pricing_budget)
+            (emr_rate, ec2_rate) = (get_int_env('XONAI_EMR_API_RATE', 5), get_int_env('XONAI_EC2_API_RATE', 20))  # requests per second
+            self.rate_limiter = AwsRateLimiter({'emr': (emr_rate, 2 * emr_rate), 'ec2': (ec2_rate, 2 * ec2_rate)})  # buckets are shared by all estimators
+            self.spot_store = self._open_spot_store()  # spot price histories of all regions, persisted across restarts
+            self.estimators: Dict[str, EmrCostEstimator] = {}  # region-specific clients & spot prices
+            self.calc = self._get_estimator(self.current_region)
+            self.client_emr = self.calc.emr_client
+            self.client_ec2 = self.calc.spot_pricing.ec2_client
         elif self.platform is SupportedPlatforms.AWS_DBX:
             self.client_dbx = WorkspaceClient()
-            self.calc = DbxPricing(self.current_region)
+            instrument_dbx_client(self.client_dbx)
+            self.pricing_registry = PricingRegistry(DbxPricing, pricing_budget)
+            self.calc = self.pricing_registry.get(self.current_region)
+        register_cache('pricing_regions', self.pricing_registry.pricings)
 
-    def reinitialize(self, selected_region) -> None:
-        """Gets called when a user changes the region variable in a dashboard."""
-        if selected_region == self.current_region:
-            logger.warning('Initiation attempted but selected region %s has not changed', selected_region)
-            return
-        logger.info('Initiating a region change from %s to %s', self.current_region, selected_region)
-        self.close_aws_clients()
-        self.current_region = selected_region
+    @classmethod
+    def _open_spot_store(cls) -> Optional[SpotPriceStore]:
+        """Opens the spot price database configured via env variable, spot prices are only kept in memory if it is disabled or unavailable."""
+        spot_db_file = environ.get('XONAI_SPOT_DB', path.join(resource_path, 'spot_prices.db'))
+        if spot_db_file == '':
+            return None
+        try:
+            return SpotPriceStore(spot_db_file)
+        except Exception as e:
+            logger.warning('Could not open spot price database %s:', spot_db_file, exc_info=e)
+            return None
+
+    def _get_estimator(self, region: str) -> EmrCostEstimator:
+        """Returns the EMR estimator of a region, its clients are created on first use."""
+        with self._region_lock:
+            if region not in self.estimators:
+                client_emr = boto3.client('emr', region_name=region)
+                client_ec2 = boto3.client('ec2', region_name=region)
+                instrument_boto3_client(client_emr)
+                instrument_boto3_client(client_ec2)
+                self.rate_limiter.attach(client_emr)
+                self.rate_limiter.attach(client_ec2)
+                self.estimators[region] = EmrCostEstimator(emr_client=client_emr, ec2_client=client_ec2, region=region, pricing_registry=self.pricing_registry,
+                                                           spot_store=self.spot_store, instance_cost_cache=self.instance_cost_cache,
+                                                           cluster_store=self.cluster_store)
+            return self.estimators[region]
+
+    def for_region(self, selected_region: str) -> Self:
+        """
+            Returns the dependencies for the region selected in a dashboard, caches and the database client are shared with all regions.
+            Nothing is reloaded or closed on region changes, so concurrent requests for different regions do not interfere.
+            Databricks pricing objects are looked up on every call since the registry swaps them in when resource files are reloaded.
+        """
+        if selected_region == self.current_region and self.platform is SupportedPlatforms.AWS_EMR:  # estimators resolve reloaded prices themselves
+            return self
+        region_view = copy(self)
+        region_view.current_region = selected_region
         if self.platform is SupportedPlatforms.AWS_EMR:
-            self.client_emr = boto3.client('emr', region_name=self.current_region)
-            self.client_ec2 = boto3.client('ec2', region_name=self.current_region)
-            self.calc = EmrCostEstimator(emr_client=self.client_emr, ec2_client=self.client_ec2, region=self.current_region)
+            region_view.calc = self._get_estimator(selected_region)
+            region_view.client_emr = region_view.calc.emr_client
+            region_view.client_ec2 = region_view.calc.spot_pricing.ec2_client
         elif self.platform is SupportedPlatforms.AWS_DBX:
-            self.calc = DbxPricing(self.current_region)
+            region_view.calc = self.pricing_registry.get(selected_region)
+        return region_view
 
     def close_aws_clients(self) -> None:
-        """Close AWS clients after a region change occurred."""
+        """Close AWS clients of all regions."""
         logger.debug('Closing clients')
         if self.platform is SupportedPlatforms.AWS_EMR:
-            self.client_emr.close()
-            self.client_ec2.close()
-            self.calc.close_clients()
+            with self._region_lock:
+                for estimator in self.estimators.values():
+                    estimator.close_clients()
+                self.estimators.clear()
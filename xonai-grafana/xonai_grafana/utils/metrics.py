@@ -0,0 +1,150 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module containing the self-instrumentation of the API server, exposed in Prometheus format."""
+import re
+import threading
+from functools import wraps
+from time import perf_counter
+from typing import Dict, Iterator
+from prometheus_client import CollectorRegistry, Counter, Histogram, ProcessCollector, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, Metric
+from prometheus_client.registry import Collector
+from xonai_grafana.utils.caching import LruCache
+
+registry = CollectorRegistry()  # separate from the default registry, only contains metrics of this server
+ProcessCollector(registry=registry)
+dbx_word = re.compile(r'[a-z_-]*')  # static segments of Databricks REST paths
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+tsdb_latency = Histogram('xonai_tsdb_request_seconds', 'Latency of TSDB requests', ['endpoint'], buckets=latency_buckets, registry=registry)
+tsdb_requests = Counter('xonai_tsdb_requests', 'TSDB requests by outcome (ok, error, cached)', ['endpoint', 'outcome'], registry=registry)
+tsdb_bytes = Counter('xonai_tsdb_response_bytes', 'Bytes received from the TSDB', ['endpoint'], registry=registry)
+cloud_latency = Histogram('xonai_cloud_request_seconds', 'Latency of AWS & Databricks API calls', ['service', 'operation'], buckets=latency_buckets,
+                          registry=registry)
+cloud_requests = Counter('xonai_cloud_requests', 'AWS & Databricks API calls by outcome (ok, error)', ['service', 'operation', 'outcome'], registry=registry)
+cloud_bytes = Counter('xonai_cloud_response_bytes', 'Bytes received from AWS APIs', ['service', 'operation'], registry=registry)
+cloud_throttled = Counter('xonai_cloud_throttled', 'AWS API calls rejected with a throttling error', ['service', 'region'], registry=registry)
+panel_latency = Histogram('xonai_panel_request_seconds', 'Latency of Grafana panel queries', ['panel'], buckets=latency_buckets, registry=registry)
+panel_errors = Counter('xonai_panel_errors', 'Grafana panel queries that failed with an exception', ['panel'], registry=registry)
+
+
+class CacheCollector(Collector):
+    """Exposes the counters and sizes of registered caches at scrape time."""
+    def __init__(self):
+        self.caches: Dict[str, LruCache] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, cache: LruCache) -> None:
+        """Adds a cache under the provided name, replaces an earlier cache with the same name."""
+        with self._lock:
+            self.caches[name] = cache
+
+    def collect(self) -> Iterator[Metric]:
+        hits = CounterMetricFamily('xonai_cache_hits', 'Cache lookups answered from a cache', labels=['cache'])
+        misses = CounterMetricFamily('xonai_cache_misses', 'Cache lookups that missed', labels=['cache'])
+        evictions = CounterMetricFamily('xonai_cache_evictions', 'Entries evicted to respect the cache bound', labels=['cache'])
+        hit_ratio = GaugeMetricFamily('xonai_cache_hit_ratio', 'Share of cache lookups answered from a cache', labels=['cache'])
+        weight = GaugeMetricFamily('xonai_cache_weight', 'Summed weight of cached entries, e.g., bytes', labels=['cache'])
+        with self._lock:
+            caches = list(self.caches.items())
+        for name, cache in caches:
+            hits.add_metric([name], cache.hits)
+            misses.add_metric([name], cache.misses)
+            evictions.add_metric([name], cache.evictions)
+            hit_ratio.add_metric([name], cache.get_hit_ratio())
+            weight.add_metric([name], cache.weight)
+        yield from (hits, misses, evictions, hit_ratio, weight)
+
+
+cache_collector = CacheCollector()
+registry.register(cache_collector)
+
+
+def register_cache(name: str, cache: LruCache) -> None:
+    """Exposes hit, miss, and eviction counts of a cache."""
+    cache_collector.register(name, cache)
+
+
+def get_tsdb_endpoint_label(endpoint: str) -> str:
+    """Returns a low-cardinality label for a TSDB API path, e.g. `query_range` for `/api/v1/query_range`."""
+    if endpoint.startswith('/api/v1/label/'):
+        return 'label_values'
+    return endpoint.rsplit('/', 1)[-1]
+
+
+def get_dbx_path_label(path: str) -> str:
+    """
+        Returns a low-cardinality label for a Databricks REST path, e.g. `/api/2.0/clusters/{id}/events` for a path with a cluster ID.
+        Segments after the API version that are not lowercase words, e.g. IDs or qualified names, are replaced with `{id}`.
+    """
+    segments = path.split('?', 1)[0].split('/')
+    return '/'.join(segment if position <= 2 or dbx_word.fullmatch(segment) else '{id}' for position, segment in enumerate(segments))
+
+
+def _before_boto_call(context: Dict, **kwargs) -> None:
+    context['xonai_start'] = perf_counter()
+
+
+def _after_boto_call(http_response, model, context: Dict, **kwargs) -> None:
+    labels = (model.service_model.service_name, model.name)
+    if 'xonai_start' in context:
+        cloud_latency.labels(*labels).observe(perf_counter() - context['xonai_start'])
+    outcome = 'ok' if http_response is not None and http_response.status_code < 400 else 'error'
+    cloud_requests.labels(*labels, outcome).inc()
+    content_length = http_response.headers.get('content-length') if http_response is not None else None
+    if content_length is not None:  # reading the body is avoided, it might be streamed
+        cloud_bytes.labels(*labels).inc(int(content_length))
+
+
+def _after_boto_call_error(model, context: Dict, **kwargs) -> None:  # e.g., connection errors
+    labels = (model.service_model.service_name, model.name)
+    if 'xonai_start' in context:
+        cloud_latency.labels(*labels).observe(perf_counter() - context['xonai_start'])
+    cloud_requests.labels(*labels, 'error').inc()
+
+
+def instrument_boto3_client(client) -> None:
+    """Records latency, outcome, and response size of every API call of a boto3 client via botocore events."""
+    events = client.meta.events
+    events.register_first('before-call.*.*', _before_boto_call, unique_id='xonai-metrics-before-call')
+    events.register('after-call.*.*', _after_boto_call, unique_id='xonai-metrics-after-call')
+    events.register('after-call-error.*.*', _after_boto_call_error, unique_id='xonai-metrics-after-call-error')
+
+
+def instrument_dbx_client(workspace_client) -> None:
+    """Records latency and outcome of every REST call of a Databricks workspace client, all services share its API client."""
+    api_client = workspace_client.api_client
+    send_request = api_client.do
+
+    @wraps(send_request)
+    def instrumented_do(method: str, path: str, *args, **kwargs):
+        labels = ('databricks', f'{method} {get_dbx_path_label(path)}')
+        start = perf_counter()
+        try:
+            response = send_request(method, path, *args, **kwargs)
+        except Exception:
+            cloud_requests.labels(*labels, 'error').inc()
+            raise
+        finally:
+            cloud_latency.labels(*labels).observe(perf_counter() - start)
+        cloud_requests.labels(*labels, 'ok').inc()
+        return response
+    api_client.do = instrumented_do
+
+
+def get_exposition() -> bytes:
+    """Returns all metrics in the Prometheus text format."""
+    return generate_latest(registry)
+
+
+content_type = CONTENT_TYPE_LATEST
@@ -0,0 +1,165 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module containing the client-side rate limiting of AWS API calls."""
+import threading
+from functools import partial
+from time import monotonic, sleep
+from typing import Dict, Iterator, Optional, Tuple
+from prometheus_client.core import GaugeMetricFamily, Metric
+from prometheus_client.registry import Collector
+from xonai_grafana.utils.logging import LoggerUtils
+from xonai_grafana.utils.metrics import registry, cloud_throttled
+
+logger = LoggerUtils.create_logger('rate limiting')
+# error codes of throttled AWS API calls, sent with 4xx status codes
+throttling_codes = {'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException', 'TooManyRequestsException',
+                    'RequestLimitExceeded', 'RequestThrottled', 'SlowDown', 'PriorRequestNotComplete', 'EC2ThrottledException'}
+
+
+def is_throttling_error(error_code: Optional[str]) -> bool:
+    return error_code in throttling_codes
+
+
+class TokenBucket:
+    """
+        Token bucket whose refill rate adapts to throttling: The rate is halved when AWS throttles a call and raised additively with every
+        successful call until the configured maximum is reached again. Callers reserve tokens in arrival order and sleep until theirs is due.
+    """
+    def __init__(self, max_rate: float, burst: int, min_rate: float = 0.5):
+        self.max_rate = max_rate  # tokens per second
+        self.min_rate = min_rate
+        self.burst = burst
+        self.rate = max_rate
+        self.rate_step = max_rate / 20  # additive increase per successful call
+        self.cooldown = 1.0  # seconds, throttled responses of calls that were sent together decrease the rate once
+        self.tokens = float(burst)
+        self.waiting = 0  # callers sleeping for a token
+        self._updated = monotonic()
+        self._decreased = float('-inf')
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        """Adds the tokens accrued since the last update, the lock must be held by the caller."""
+        self.tokens = min(float(self.burst), self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self) -> float:
+        """Takes a token and blocks until it is due, returns the seconds waited."""
+        with self._lock:
+            self._refill(monotonic())
+            self.tokens -= 1  # negative balances are reservations of waiting callers
+            wait_time = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+            if wait_time > 0:
+                self.waiting += 1
+        if wait_time > 0:
+            sleep(wait_time)
+            with self._lock:
+                self.waiting -= 1
+        return wait_time
+
+    def on_throttled(self) -> None:
+        """Halves the rate, at most once per cooldown period, and drops the accrued burst."""
+        with self._lock:
+            now = monotonic()
+            if now - self._decreased < self.cooldown:
+                return
+            self._refill(now)
+            self._decreased = now
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+            logger.info('AWS API throttled, lowering request rate to %.2f/s', self.rate)
+
+    def on_success(self) -> None:
+        """Raises the rate towards its maximum."""
+        if self.rate >= self.max_rate:
+            return
+        with self._lock:
+            self._refill(monotonic())
+            self.rate = min(self.max_rate, self.rate + self.rate_step)
+
+
+class AwsRateLimiter:
+    """
+        Paces the API calls of all attached boto3 clients with one adaptive token bucket per service & region, AWS applies its request
+        quotas per account and region. Tokens are taken in botocore's `before-send` event, so retries are paced as well.
+    """
+    default_limits: Dict[str, Tuple[float, int]] = {'emr': (5.0, 10), 'ec2': (20.0, 40)}  # requests per second & burst
+    fallback_limit: Tuple[float, int] = (5.0, 10)
+
+    def __init__(self, limits: Optional[Dict[str, Tuple[float, int]]] = None):
+        self.limits = {**self.default_limits, **(limits or {})}
+        self.buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self._lock = threading.Lock()
+        limiter_collector.register(self)
+
+    def get_bucket(self, service: str, region: str) -> TokenBucket:
+        """Returns the shared bucket of a service & region, creates it on first use."""
+        with self._lock:
+            if (service, region) not in self.buckets:
+                (max_rate, burst) = self.limits.get(service, self.fallback_limit)
+                self.buckets[(service, region)] = TokenBucket(max_rate, burst)
+            return self.buckets[(service, region)]
+
+    @classmethod
+    def _before_send(cls, bucket: TokenBucket, **kwargs) -> None:
+        bucket.acquire()  # returns None, a response would replace the HTTP request
+
+    @classmethod
+    def _observe_response(cls, bucket: TokenBucket, service: str, region: str, response: Optional[Tuple] = None, **kwargs) -> None:
+        if response is None:  # connection errors
+            return
+        (_, parsed_response) = response
+        error_code = parsed_response.get('Error', {}).get('Code') if isinstance(parsed_response, dict) else None
+        if is_throttling_error(error_code):
+            cloud_throttled.labels(service, region).inc()
+            bucket.on_throttled()
+        elif error_code is None:
+            bucket.on_success()
+
+    def attach(self, client) -> None:
+        """Registers the pacing and throttling detection handlers on a boto3 client."""
+        service = client.meta.service_model.service_name
+        region = client.meta.region_name
+        bucket = self.get_bucket(service, region)
+        events = client.meta.events
+        events.register('before-send.*.*', partial(self._before_send, bucket), unique_id='xonai-rate-limit-before-send')
+        events.register_first('needs-retry.*.*', partial(self._observe_response, bucket, service, region), unique_id='xonai-rate-limit-needs-retry')
+
+
+class RateLimiterCollector(Collector):
+    """Exposes the queue depth and current rate of every bucket at scrape time."""
+    def __init__(self):
+        self.limiter: Optional[AwsRateLimiter] = None
+        self._lock = threading.Lock()
+
+    def register(self, limiter: AwsRateLimiter) -> None:
+        """Exposes a limiter, replaces an earlier one."""
+        with self._lock:
+            self.limiter = limiter
+
+    def collect(self) -> Iterator[Metric]:
+        waiting = GaugeMetricFamily('xonai_cloud_limiter_waiting', 'AWS API calls waiting for a rate limiter token', labels=['service', 'region'])
+        rate = GaugeMetricFamily('xonai_cloud_limiter_rate', 'Current AWS API request rate per second of a rate limiter', labels=['service', 'region'])
+        with self._lock:
+            limiter = self.limiter
+        if limiter is not None:
+            with limiter._lock:
+                buckets = list(limiter.buckets.items())
+            for ((service, region), bucket) in buckets:
+                waiting.add_metric([service, region], bucket.waiting)
+                rate.add_metric([service, region], bucket.rate)
+        yield from (waiting, rate)
+
+
+limiter_collector = RateLimiterCollector()
+registry.register(limiter_collector)
@@ -16,9 +16,12 @@ from dateutil.tz import tzutc, tzlocal
 from enum import StrEnum
 from math import ceil
 from typing import Dict, List, Tuple, Optional, Set
-from prometheus_api_client import PrometheusConnect
+import numpy as np
 from xonai_grafana.schemata.cloud_objects import DescribedEmrCluster, SupportedPlatforms, AllClusters, DbxCluster
+from xonai_grafana.utils.caching import LruCache
 from xonai_grafana.utils.logging import LoggerUtils
+from xonai_grafana.utils.metrics import register_cache
+from xonai_grafana.utils.tsdb_client import TsdbConnection, get_tsdb_env
 
 logger = LoggerUtils.create_logger('tsdb utils')
 
@@ -26,6 +29,7 @@ logger = LoggerUtils.create_logger('tsdb utils')
 MaxAvg = Tuple[Optional[float], Optional[float]]
 IdPair = Tuple[str, str]
 IdPairTimes = Tuple[str, str, int, int, int, int]
+ClusterWindow = Tuple[int, str, float, float]  # list index, cluster ID, start & end in epoch seconds
 
 
 class QueryType(StrEnum):
@@ -39,13 +43,19 @@ class QueryType(StrEnum):
 class TsdbQuery:
     """Holds constants for database queries."""
     cpu_util = '1 - (avg by (cluster_id) (irate(node_cpu_seconds_total{cluster_id="%s", mode="idle"}%s)))'
+    cpu_util_multi = '1 - (avg by (cluster_id) (irate(node_cpu_seconds_total{cluster_id=~"%s", mode="idle"}%s)))'
     mem_util = '1 - (sum(node_memory_MemAvailable_bytes {cluster_id=~"%s"}) by (cluster_id)) / (sum(node_memory_MemTotal_bytes {cluster_id=~"%s"}) by (cluster_id))'
+    # Server-side max & average of a utilization expression, evaluated at a cluster's termination time
+    summary_query = 'label_set(max_over_time((%s)[%s:%s]), "stat", "max") or label_set(avg_over_time((%s)[%s:%s]), "stat", "avg")'
     app_cluster_id_query = 'last_over_time(spark_jvmCpuTime{app_id="%s", agent="driver"}[%s])'
+    app_cluster_ids_query = 'count by (app_id, cluster_id) (last_over_time(spark_jvmCpuTime{app_id=~"%s", agent="driver"}[%s]))'
     # Timestamp queries for nodes and clusters
     node_first = 'tfirst_over_time(up{job="node_scraper", cluster_id=~"%s", instance=~"%s"}[%s])'
     node_last = 'tlast_over_time(up{job="node_scraper", cluster_id=~"%s", instance=~"%s"}[%s])'
     cluster_first = 'tfirst_over_time(up{job="node_scraper", cluster_id=~"%s", %s}[%s])'  # >1 results without infix label
     cluster_last = 'tlast_over_time(up{job="node_scraper", cluster_id=~"%s", %s}[%s])'  # >1 result without infix label
+    nodes_first = 'min by (instance) (tfirst_over_time(up{job="node_scraper", cluster_id=~"%s"}[%s]))'
+    nodes_last = 'max by (instance) (tlast_over_time(up{job="node_scraper", cluster_id=~"%s"}[%s]))'
     # Master labels
     emr_master_label = 'role="master"'
     dbx_master_label = 'on_driver="true"'
@@ -59,15 +69,26 @@ class TsdbQuery:
     cpu_cores_query = 'count(last_over_time(node_cpu_seconds_total{job="node_scraper", mode="idle", cluster_id=~"%s"}[%s]))'
     total_ram_query = 'sum(last_over_time(node_memory_MemTotal_bytes{job="node_scraper", cluster_id=~"%s"}[%s]))'
     total_disk_query = 'sum(last_over_time(node_filesystem_size_bytes{job="node_scraper", cluster_id=~"%s", fstype!="tmpfs", mountpoint!~".*tmp.*"}[%s]))'
+    resources_query = ('label_set(%s, "resource", "nodes") or label_set(%s, "resource", "cores") or label_set(%s, "resource", "ram") or '
+                       'label_set(%s, "resource", "disk")')  # all four figures above in one instant query
+    # Characters that need escaping when label values are joined into a regex matcher
+    regex_specials = frozenset('\\.^$*+?()[]{}|')
 
 
 class TsdbUtils:
     """Utility class for time-series databases, mostly contains helper methods."""
 
     def __init__(self):
-        self.prom_client = PrometheusConnect(url="http://localhost:8428", disable_ssl=True)
+        tsdb_url, max_concurrency, cache_bytes = get_tsdb_env()
+        self.query_cache = LruCache(cache_bytes)  # results of queries over past windows never change
+        register_cache('tsdb_query', self.query_cache)
+        self.prom_client = TsdbConnection(tsdb_url, max_concurrency, self.query_cache)  # synchronous facade of the async client, keeps the PrometheusConnect API
         self.window_size = "[40s]"  # for utilization queries, scrape interval = 10s
         self.range_step = "10s"
+        self.server_side_stats = True  # summarize utilizations in the DB instead of pulling range query samples
+        self.group_span_factor = 2  # clusters share a utilization query if their joint window is at most twice the longest member window
+        self.min_group_span = 3600  # seconds, short-lived clusters are grouped more liberally
+        self.max_matcher_length = 2000  # max characters of a regex matcher in chunked queries, keeps GET URLs within server limits
 
     def _get_clusters_from_db(self, start: int, end: int) -> List[str]:
         """Returns cluster IDs fetched from the DB. Used when a tracked cluster from a longer time ago isn't covered by AWS APIs anymore."""
@@ -75,6 +96,82 @@ class TsdbUtils:
         clusters = self.prom_client.get_label_values('cluster_id', params_cluster)
         return clusters
 
+    def _chunk_values(self, values: List[str]) -> List[List[str]]:
+        """Splits label values into chunks whose regex alternation stays below the configured matcher length."""
+        chunks: List[List[str]] = []
+        current_chunk: List[str] = []
+        current_length = 0
+        for value in values:
+            value_length = len(self.escape_regex(value)) + 1  # separator
+            if len(current_chunk) > 0 and current_length + value_length > self.max_matcher_length:
+                chunks.append(current_chunk)
+                current_chunk = []
+                current_length = 0
+            current_chunk.append(value)
+            current_length += value_length
+        if len(current_chunk) > 0:
+            chunks.append(current_chunk)
+        return chunks
+
+    def _get_app_cluster_ids_serial(self, app_ids: List[str], start: int, end: int) -> List[IdPair]:
+        """Resolves the cluster ID of each application with one instant query per app."""
+        app_cluster_ids: List[IdPair] = []
+        for app_id in app_ids:
+            query = TsdbQuery.app_cluster_id_query % (app_id, self.get_lookback(start, end))
+            result = self.prom_client.custom_query(query, {'time': end})  # evaluation timestamp for instant query
+            if len(result) > 0 and 'metric' in result[0] and 'cluster_id' in result[0]['metric']:
+                cluster_id = result[0]['metric']['cluster_id']
+                app_cluster_ids.append((app_id, cluster_id))
+            else:  # possible in boundary cases, get_label_values less precise with time
+                logger.warning('Problem with retrieving cluster id for app id %s, %s', app_id, result)
+        return app_cluster_ids
+
+    def _get_app_cluster_ids_bulk(self, app_ids: List[str], start: int, end: int) -> List[IdPair]:
+        """Resolves the cluster IDs of all applications with one grouped instant query per chunk of app IDs, chunks are queried concurrently."""
+        lookback = self.get_lookback(start, end)
+        queries = [TsdbQuery.app_cluster_ids_query % (self.join_regex(chunk), lookback) for chunk in self._chunk_values(app_ids)]
+        chunk_results = self.prom_client.run_all(self.prom_client.async_client.custom_query(query, {'time': end}) for query in queries)
+        resolved_ids: Dict[str, str] = {}
+        for results in chunk_results:
+            for result in results:
+                metric = result.get('metric', {})
+                if 'app_id' not in metric or 'cluster_id' not in metric:
+                    logger.warning('App or cluster id missing in grouped result %s', result)
+                    continue
+                app_id = metric['app_id']
+                if app_id in resolved_ids and resolved_ids[app_id] != metric['cluster_id']:
+                    logger.warning('App id %s maps to clusters %s and %s', app_id, resolved_ids[app_id], metric['cluster_id'])
+                    continue
+                resolved_ids[app_id] = metric['cluster_id']
+        app_cluster_ids: List[IdPair] = []
+        for app_id in app_ids:  # preserve label value order of the serial variant
+            if app_id in resolved_ids:
+                app_cluster_ids.append((app_id, resolved_ids[app_id]))
+            else:  # possible in boundary cases, get_label_values less precise with time
+                logger.warning('Problem with retrieving cluster id for app id %s', app_id)
+        return app_cluster_ids
+
+    async def _fetch_grouped_values(self, query: str, eval_time: int, label: str) -> Dict[str, str]:
+        """Runs an instant query aggregated by a label and returns the sample values keyed by that label's values."""
+        grouped_values: Dict[str, str] = {}
+        for result in await self.prom_client.async_client.custom_query(query, {'time': eval_time}):
+            if label not in result.get('metric', {}) or len(result.get('value', [])) != 2:
+                logger.warning('Grouped TSDB result malformed: %s', result)
+                continue
+            grouped_values[result['metric'][label]] = result['value'][1]
+        return grouped_values
+
+    @classmethod
+    def _get_unique_label(cls, label_values: Dict[str, Set[str]], label: str, instance_id: str) -> Optional[str]:
+        """Returns the only value of a label collected from an instance's series, counterpart of :func:`get_label_value`."""
+        values = label_values.get(label, set())
+        if len(values) < 1:  # e.g., labels on Dbx worker nodes
+            return None
+        if len(values) > 1:
+            logger.warning('Not a unique value for label %s of instance %s: %s', label, instance_id, values)
+            return None
+        return next(iter(values))
+
     def _get_node_times(self, cluster_id: str, instance_id: str, start: int, eval_time: int) -> Tuple[float, float]:
         """Returns instance start/end times fetched from the DB in epoch seconds. Used for cluster instance panel."""
         lookback = self.get_lookback(start, eval_time)
@@ -114,39 +211,96 @@ class TsdbUtils:
         return instance_cluster
 
     def _summarize_stats(self, pairs: List[Tuple[int, str]]) -> Tuple[float, float]:
-        """Returns max and average value for timeseries samples. Used for utilization calculations."""
-        count = len(pairs)
-        running_sum = 0.0
-        max_val = 0.0
-        for pair in pairs:
-            try:
-                value = float(pair[1])
-                running_sum += value
-                max_val = value if value > max_val else max_val
-            except Exception as e:
-                logger.warning('Metrics to summarize malformed: %s', pairs, exc_info=e)
-                running_sum = 0.0
-                count = 0
-                break
-        mean = running_sum / count if count > 0 else 0.0
-        return max_val, mean
+        """Returns max and average value for timeseries samples. Used for utilization calculations without server-side stats."""
+        try:
+            values = self.values_to_array(pairs)
+        except Exception as e:
+            logger.warning('Metrics to summarize malformed: %s', pairs, exc_info=e)
+            return 0.0, 0.0
+        return self.summarize_array(values)
 
-    def _get_cluster_utilization(self, cluster_info: DescribedEmrCluster | DbxCluster, query: str) -> MaxAvg:
-        """Returns CPU or memory utilization (max & average) for a terminated EMR or DBx cluster."""
-        start_time: datetime = datetime.min
-        end_time: datetime = start_time
+    @classmethod
+    def _get_cluster_window(cls, cluster_info: DescribedEmrCluster | DbxCluster) -> Optional[Tuple[datetime, datetime]]:
+        """Returns creation and termination time of a terminated EMR or DBx cluster, None for active or unknown clusters."""
         if isinstance(cluster_info, DescribedEmrCluster):
             if 'TERMINATED' not in cluster_info.Status.State.upper():
-                return None, None
-            start_time = cluster_info.Status.Timeline.CreationDateTime
-            end_time = cluster_info.Status.Timeline.EndDateTime
-        elif isinstance(cluster_info, DbxCluster):
+                return None
+            return cluster_info.Status.Timeline.CreationDateTime, cluster_info.Status.Timeline.EndDateTime
+        if isinstance(cluster_info, DbxCluster):
             if 'TERMINATED' not in cluster_info.state.upper():
+                return None
+            return datetime.fromtimestamp(cluster_info.start / 1000.0, tzutc()), datetime.fromtimestamp(cluster_info.end / 1000.0, tzutc())
+        logger.warning('Unknown cluster type: %s', cluster_info)
+        return None
+
+    async def _fetch_summarized_utilization(self, cluster_info: DescribedEmrCluster | DbxCluster, query: str, start_time: datetime, end_time: datetime) -> MaxAvg:
+        """Returns max & average of a utilization expression computed by the DB with subqueries, only two scalars are transferred."""
+        window = f'{max(ceil((end_time - start_time).total_seconds()), 1)}s'
+        summary_query = TsdbQuery.summary_query % (query, window, self.range_step, query, window, self.range_step)
+        metric_data = await self.prom_client.async_client.custom_query(summary_query, {'time': end_time.timestamp()})
+        if len(metric_data) < 1:  # cluster without an agent installed
+            return None, None
+        stats: Dict[str, float] = {}
+        for result in metric_data:
+            stat = result.get('metric', {}).get('stat')
+            if stat in stats:  # something went wrong in the DB
+                logger.warning('More than one utilization series found for %s', cluster_info)
+                return None, None
+            try:
+                stats[stat] = float(result['value'][1])
+            except Exception as e:
+                logger.warning('Summarized metrics malformed: %s', result, exc_info=e)
                 return None, None
-            start_time = datetime.fromtimestamp(cluster_info.start / 1000.0, tzutc())
-            end_time = datetime.fromtimestamp(cluster_info.end / 1000.0, tzutc())
-        else:
-            logger.warning('Unknown cluster type: %s', cluster_info)
+        if 'max' not in stats or 'avg' not in stats:
+            logger.warning('Incomplete utilization summary for %s: %s', cluster_info, stats)
+            return None, None
+        return stats['max'], stats['avg']
+
+    def _group_windows(self, windows: List[ClusterWindow]) -> List[List[ClusterWindow]]:
+        """Groups cluster windows whose joint window stays close to the longest member window, keeps regex matchers within the length limit."""
+        groups: List[List[ClusterWindow]] = []
+        current_group: List[ClusterWindow] = []
+        group_start, group_end, longest_span, matcher_length = 0.0, 0.0, 0.0, 0
+        for window in sorted(windows, key=lambda entry: entry[2]):
+            (_, cluster_id, start, end) = window
+            id_length = len(self.escape_regex(cluster_id)) + 1  # separator
+            if len(current_group) > 0:
+                joint_span = max(group_end, end) - group_start
+                allowed_span = max(self.group_span_factor * max(longest_span, end - start), self.min_group_span)
+                if joint_span > allowed_span or matcher_length + id_length > self.max_matcher_length:
+                    groups.append(current_group)
+                    current_group = []
+            if len(current_group) == 0:
+                group_start, group_end, longest_span, matcher_length = start, end, 0.0, 0
+            current_group.append(window)
+            group_end = max(group_end, end)
+            longest_span = max(longest_span, end - start)
+            matcher_length += id_length
+        if len(current_group) > 0:
+            groups.append(current_group)
+        return groups
+
+    async def _fetch_grouped_summaries(self, query: str, start: float, end: float) -> Dict[str, MaxAvg]:
+        """Returns server-side max & average of a utilization expression aggregated by cluster_id, keyed by cluster ID."""
+        window = f'{max(ceil(end - start), 1)}s'
+        summary_query = TsdbQuery.summary_query % (query, window, self.range_step, query, window, self.range_step)
+        stats: Dict[str, Dict[str, float]] = {}
+        for result in await self.prom_client.async_client.custom_query(summary_query, {'time': end}):
+            metric = result.get('metric', {})
+            try:
+                stats.setdefault(metric['cluster_id'], {})[metric['stat']] = float(result['value'][1])
+            except Exception as e:
+                logger.warning('Summarized metrics malformed: %s', result, exc_info=e)
+        return {cluster_id: (stat['max'], stat['avg']) for cluster_id, stat in stats.items() if 'max' in stat and 'avg' in stat}
+
+    def _get_cluster_utilization(self, cluster_info: DescribedEmrCluster | DbxCluster, query: str) -> MaxAvg:
+        """Returns CPU or memory utilization (max & average) for a terminated EMR or DBx cluster."""
+        cluster_window = self._get_cluster_window(cluster_info)
+        if cluster_window is None:
+            return None, None
+        start_time, end_time = cluster_window
+        if self.server_side_stats:
+            return self.prom_client.run(self._fetch_summarized_utilization(cluster_info, query, start_time, end_time))
         metric_data = self.prom_client.custom_query_range(query, start_time=start_time, end_time=end_time, step=self.range_step)
         if len(metric_data) < 1:  # cluster without an agent installed
             return None, None
@@ -173,8 +327,10 @@ class TsdbUtils:
         try:
             first_query = TsdbQuery.cluster_first % (cluster_id, master_label, lookback)
             last_query = TsdbQuery.cluster_last % (cluster_id, master_label, lookback)  # multi values for interactive clusters possible
-            cluster_first = self.extract_multi_value(self.prom_client.custom_query(first_query, params))  # e.g., 1708704315.792
-            cluster_last = self.extract_multi_value(self.prom_client.custom_query(last_query, params), False)  # e.g., 1708704395.792
+            first_result, last_result = self.prom_client.run_all([self.prom_client.async_client.custom_query(first_query, params),
+                                                                  self.prom_client.async_client.custom_query(last_query, params)])
+            cluster_first = self.extract_multi_value(first_result)  # e.g., 1708704315.792
+            cluster_last = self.extract_multi_value(last_result, False)  # e.g., 1708704395.792
             cluster_start = round(float(cluster_first))
             cluster_end = round(float(cluster_last))
         except Exception as e:
@@ -193,6 +349,16 @@ class TsdbUtils:
         hours = ceil(diff / 3600)
         return f'{hours}h'
 
+    @classmethod
+    def escape_regex(cls, value: str) -> str:
+        """Escapes regex metacharacters in a label value, result is meant to be placed inside a quoted PromQL regex matcher."""
+        return ''.join('\\\\' + char if char in TsdbQuery.regex_specials else char for char in value)
+
+    @classmethod
+    def join_regex(cls, values: List[str]) -> str:
+        """Joins label values into a regex alternation like `a|b|c`, e.g. for `cluster_id=~` matchers."""
+        return '|'.join(cls.escape_regex(value) for value in values)
+
     @classmethod
     def convert_to_unixs(cls, timestring: str) -> int:
         """Converts the provided timestamp string into unix seconds."""
@@ -219,7 +385,7 @@ class TsdbUtils:
 
     @classmethod
     def extract_multi_value(cls, responses: List[Dict], mini: bool = True):
-        """Extracts the metric value from a TSDB response, supports multiple responses."""
+        """Extracts the metric value from a TSDB response, supports multiple responses. Values are compared numerically, the original string is returned."""
         if len(responses) == 0 or 'value' not in responses[0]:
             logger.warning('TSDB response (multi) malformed: %s', responses)
             return 0.0
@@ -233,8 +399,23 @@ class TsdbUtils:
                 continue
             extracted_vals.append(returned_value[1])
         if mini:
-            return min(extracted_vals)
-        return max(extracted_vals)
+            return min(extracted_vals, key=float)
+        return max(extracted_vals, key=float)
+
+    @classmethod
+    def values_to_array(cls, pairs: List[Tuple[int, str]]) -> np.ndarray:
+        """Converts the `[timestamp, "value"]` samples of a series into a float array, raises a ValueError for malformed values."""
+        return np.asarray([pair[1] for pair in pairs], dtype=np.float64)
+
+    @classmethod
+    def summarize_array(cls, values: np.ndarray) -> Tuple[float, float]:
+        """Returns max (at least 0) and mean of sample values, NaN samples are skipped."""
+        sample_count = np.count_nonzero(~np.isnan(values))
+        if sample_count == 0:
+            return 0.0, 0.0
+        max_val = float(np.fmax.reduce(values, initial=0.0))
+        mean = float(np.nansum(values)) / sample_count
+        return max_val, mean
 
     def get_nodes_starts_ends(self, cluster_var: str, start: int, end: int) -> List[IdPairTimes]:
         """Returns instance's cluster ID and start/end/redir times fetched from the DB in epoch seconds. Used for cluster instance panel."""
@@ -246,23 +427,17 @@ class TsdbUtils:
         return instance_times
 
     def get_resources(self, cluster_ids: str, start: int, eval_time: int) -> Tuple[int, int, int, int]:
-        """Fetches # active nodes, # CPUs, total RAM, and total disk from the DB. Used for active resources panel."""
+        """Fetches # active nodes, # CPUs, total RAM, and total disk from the DB with one combined query. Used for active resources panel."""
         if cluster_ids == '':
             return 0, 0, 0, 0
         lookback = self.get_lookback(start, eval_time)
-        params = {'time': eval_time}
-        nodes_query = TsdbQuery.nodes_up_query % (cluster_ids, lookback)
-        nodes_up_res = self.prom_client.custom_query(nodes_query, params)
-        nodes_up = self.extract_value(nodes_up_res)
-        cpu_query = TsdbQuery.cpu_cores_query % (cluster_ids, lookback)
-        cpu_cores_res = self.prom_client.custom_query(cpu_query, params)
-        cpu_cores = self.extract_value(cpu_cores_res)
-        ram_query = TsdbQuery.total_ram_query % (cluster_ids, lookback)
-        total_ram_res = self.prom_client.custom_query(ram_query, params)
-        total_ram = self.extract_value(total_ram_res)
-        disk_query = TsdbQuery.total_disk_query % (cluster_ids, lookback)
-        total_disk_res = self.prom_client.custom_query(disk_query, params)
-        total_disk = self.extract_value(total_disk_res)
+        query_args = (cluster_ids, lookback)
+        resources_query = TsdbQuery.resources_query % (TsdbQuery.nodes_up_query % query_args, TsdbQuery.cpu_cores_query % query_args,
+                                                       TsdbQuery.total_ram_query % query_args, TsdbQuery.total_disk_query % query_args)
+        resources = {}
+        for result in self.prom_client.custom_query(resources_query, {'time': eval_time}):
+            resources[result.get('metric', {}).get('resource')] = self.extract_value([result])
+        nodes_up, cpu_cores, total_ram, total_disk = (resources.get(resource, 0.0) for resource in ('nodes', 'cores', 'ram', 'disk'))
         return nodes_up, cpu_cores, total_ram, total_disk
 
     def get_consumed_time(self, entity_id: str, start: int, eval_time: int, query_type: QueryType) -> int:
@@ -326,11 +501,45 @@ class TsdbUtils:
     def get_cluster_utilizations(self, cluster_info: DescribedEmrCluster | DbxCluster) -> Tuple[MaxAvg, MaxAvg]:
         """Returns CPU and memory utilization (max & average) for a terminated EMR or DBx cluster."""
         cpu_util_query = TsdbQuery.cpu_util % (cluster_info.Id, self.window_size)
-        cpu_utilization = self._get_cluster_utilization(cluster_info, cpu_util_query)
         mem_util_query = TsdbQuery.mem_util % (cluster_info.Id, cluster_info.Id)
+        cluster_window = self._get_cluster_window(cluster_info)
+        if self.server_side_stats and cluster_window is not None:  # both summaries in parallel
+            cpu_utilization, mem_utilization = self.prom_client.run_all([
+                self._fetch_summarized_utilization(cluster_info, cpu_util_query, cluster_window[0], cluster_window[1]),
+                self._fetch_summarized_utilization(cluster_info, mem_util_query, cluster_window[0], cluster_window[1])])
+            return cpu_utilization, mem_utilization
+        cpu_utilization = self._get_cluster_utilization(cluster_info, cpu_util_query)
         mem_utilization = self._get_cluster_utilization(cluster_info, mem_util_query)
         return cpu_utilization, mem_utilization
 
+    def get_clusters_utilizations(self, clusters: List[DescribedEmrCluster | DbxCluster]) -> List[Tuple[MaxAvg, MaxAvg]]:
+        """
+            Returns CPU and memory utilizations (max & average) for several EMR or DBx clusters in the order of the supplied list.
+            Terminated clusters with compatible time windows share grouped `by (cluster_id)` queries, active clusters have no values.
+        """
+        if not self.server_side_stats:
+            return [self.get_cluster_utilizations(cluster) for cluster in clusters]
+        utilizations: List[Tuple[MaxAvg, MaxAvg]] = [((None, None), (None, None))] * len(clusters)
+        windows: List[ClusterWindow] = []
+        for index, cluster in enumerate(clusters):
+            cluster_window = self._get_cluster_window(cluster)
+            if cluster_window is not None:
+                windows.append((index, cluster.Id, cluster_window[0].timestamp(), cluster_window[1].timestamp()))
+        groups = self._group_windows(windows)
+        summary_calls = []
+        for group in groups:
+            cluster_regex = self.join_regex(list(dict.fromkeys(window[1] for window in group)))
+            group_start = min(window[2] for window in group)
+            group_end = max(window[3] for window in group)
+            summary_calls.append(self._fetch_grouped_summaries(TsdbQuery.cpu_util_multi % (cluster_regex, self.window_size), group_start, group_end))
+            summary_calls.append(self._fetch_grouped_summaries(TsdbQuery.mem_util % (cluster_regex, cluster_regex), group_start, group_end))
+        summaries = self.prom_client.run_all(summary_calls)  # all groups in parallel
+        for group_index, group in enumerate(groups):
+            cpu_stats, mem_stats = summaries[2 * group_index], summaries[2 * group_index + 1]
+            for (index, cluster_id, _, _) in group:
+                utilizations[index] = (cpu_stats.get(cluster_id, (None, None)), mem_stats.get(cluster_id, (None, None)))
+        return utilizations
+
     def get_label_value(self, label: str, instance_id: str, start: int, end: int) -> Optional[str]:
         """Returns value for a provided label and instance from the database."""
         matcher_inst = TsdbQuery.label_query % instance_id
@@ -349,22 +558,67 @@ class TsdbUtils:
         params_inst = {'start': start, 'end': end, 'match[]': matcher_inst}
         return self.prom_client.get_label_values('instance', params_inst)
 
-    def get_app_cluster_ids(self, start: int, end: int) -> List[IdPair]:
-        """Returns applications with cluster IDs from the database, used in general overview dashboard."""
-        app_cluster_ids: List[IdPair] = []
+    def get_app_cluster_ids(self, start: int, end: int, bulk: bool = True) -> List[IdPair]:
+        """
+            Returns applications with cluster IDs from the database, used in general overview dashboard.
+            The bulk mode resolves all apps with a few grouped queries, the serial mode issues one query per app.
+        """
         app_ids = self.prom_client.get_label_values('app_id', {'end': end, 'start': start})
-        for app_id in app_ids:
-            query = TsdbQuery.app_cluster_id_query % (app_id, self.get_lookback(start, end))
-            result = self.prom_client.custom_query(query, {'time': end})  # evaluation timestamp for instant query
-            if len(result) > 0 and 'metric' in result[0] and 'cluster_id' in result[0]['metric']:
-                cluster_id = result[0]['metric']['cluster_id']
-                app_cluster_ids.append((app_id, cluster_id))
-            else:  # possible in boundary cases, get_label_values less precise with time
-                logger.warning('Problem with retrieving cluster id for app id %s, %s', app_id, result)
-        return app_cluster_ids
+        if bulk:
+            return self._get_app_cluster_ids_bulk(app_ids, start, end)
+        return self._get_app_cluster_ids_serial(app_ids, start, end)
+
+    def get_instance_inventory(self, cluster_var: str, start: int, end: int, platform: SupportedPlatforms) -> Tuple[List[IdPairTimes], List[IdPair]]:
+        """
+            Returns core instance info for the given cluster ID(s) with three concurrent TSDB calls: One series call that fetches the label sets of all
+            instances and two grouped timestamp queries. Results are joined in memory.
+        """
+        lookback = self.get_lookback(start, end)
+        series_params = {'match[]': TsdbQuery.matcher_instances % cluster_var, 'start': start, 'end': end}
+        all_series, node_firsts, node_lasts = self.prom_client.run_all([
+            self.prom_client.async_client.get_series(series_params),
+            self._fetch_grouped_values(TsdbQuery.nodes_first % (cluster_var, lookback), end, 'instance'),
+            self._fetch_grouped_values(TsdbQuery.nodes_last % (cluster_var, lookback), end, 'instance')])
+        labels_per_instance: Dict[str, Dict[str, Set[str]]] = {}
+        for series_labels in all_series:
+            if 'instance' not in series_labels:
+                continue
+            instance_labels = labels_per_instance.setdefault(series_labels['instance'], {})
+            for label, value in series_labels.items():
+                instance_labels.setdefault(label, set()).add(value)
+        instance_times: List[IdPairTimes] = []
+        type_role: List[IdPair] = []
+        for instance_id in sorted(labels_per_instance):  # same order as label values calls
+            instance_labels = labels_per_instance[instance_id]
+            cluster_ids = instance_labels.get('cluster_id', set())
+            if len(cluster_ids) != 1:
+                logger.warning('Not a single cluster id %s for instance %s', cluster_ids, instance_id)
+                continue
+            node_start = 0
+            node_end = 0
+            try:
+                node_start = round(float(node_firsts.get(instance_id, 0))) * 1000
+                node_end = round(float(node_lasts.get(instance_id, 0))) * 1000
+            except Exception as e:
+                logger.warning('Instance %s end time %s malformed', instance_id, end, exc_info=e)
+            start_offset = AllClusters.get_redirect_ms(node_start)
+            end_offset = AllClusters.get_redirect_ms(node_end, False)
+            instance_times.append((instance_id, next(iter(cluster_ids)), node_start, node_end, start_offset, end_offset))
+            inst_type = self._get_unique_label(instance_labels, 'instance_type', instance_id)
+            node_role = ''
+            if platform is SupportedPlatforms.AWS_EMR:
+                node_role = self._get_unique_label(instance_labels, 'role', instance_id)
+            elif platform is SupportedPlatforms.AWS_DBX:
+                role_value = self._get_unique_label(instance_labels, 'on_driver', instance_id)
+                node_role = 'driver' if role_value == 'true' else 'worker'
+            type_role.append((inst_type, node_role))
+        return instance_times, type_role
 
-    def get_instance_list(self, cluster_var: str, start: int, end: int, platform: SupportedPlatforms) -> Tuple[List[IdPairTimes], List[IdPair]]:
-        """Returns core instance info for the given cluster ID(s)."""
+    def get_instance_list(self, cluster_var: str, start: int, end: int, platform: SupportedPlatforms,
+                          inventory: bool = True) -> Tuple[List[IdPairTimes], List[IdPair]]:
+        """Returns core instance info for the given cluster ID(s), the inventory mode avoids per-instance lookups."""
+        if inventory:
+            return self.get_instance_inventory(cluster_var, start, end, platform)
         instance_times: List[IdPairTimes] = self.get_nodes_starts_ends(cluster_var, start, end)
         type_role: List[IdPair] = []
         for instance_time in instance_times:
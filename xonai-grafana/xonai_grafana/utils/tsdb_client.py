@@ -0,0 +1,236 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module containing the HTTP clients for the time series database."""
+import asyncio
+import json
+import threading
+import time
+from datetime import datetime
+from os import environ
+from typing import Dict, List, Optional, Tuple, Any, Coroutine, Iterable, Hashable
+import httpx
+from xonai_grafana.utils.caching import LruCache
+from xonai_grafana.utils.logging import LoggerUtils
+from xonai_grafana.utils.metrics import tsdb_latency, tsdb_requests, tsdb_bytes, get_tsdb_endpoint_label
+
+logger = LoggerUtils.create_logger('tsdb client')
+try:  # optional faster decoder for large range query payloads
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+def get_int_env(name: str, default: int) -> int:
+    """Returns a positive integer from an env variable, the default is used when the variable is unset or malformed."""
+    configured_value = environ.get(name)
+    if configured_value is None or configured_value == '':
+        return default
+    try:
+        return max(int(configured_value), 1)
+    except ValueError:
+        logger.warning('Supplied value %s of %s is not an integer, ignoring', configured_value, name)
+        return default
+
+
+def get_tsdb_env() -> Tuple[str, int, int]:
+    """Returns the configured TSDB endpoint, the maximum number of concurrent requests, and the query cache size in bytes from env variables."""
+    tsdb_url = environ.get('XONAI_TSDB_URL', 'http://localhost:8428')
+    max_concurrency = get_int_env('XONAI_TSDB_CONCURRENCY', 8)
+    cache_bytes = get_int_env('XONAI_TSDB_CACHE_MB', 64) * 1024 * 1024
+    return tsdb_url, max_concurrency, cache_bytes
+
+
+class TsdbClientException(Exception):
+    """Raised when the TSDB answers with a non-200 status code."""
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class AsyncTsdbClient:
+    """
+        Asynchronous client for the Prometheus-compatible HTTP API of VictoriaMetrics.
+        Keeps connections alive in a pool and bounds the number of requests in flight.
+        Server errors (5xx) and transport errors are retried a few times with exponential backoff.
+        Results are cached when a query cache is supplied: Without expiry if the queried window lies in the past beyond a safety margin,
+        with a short time-to-live if the window touches the present. Cache entries are weighed by their response size times a fixed
+        factor, an estimate of the memory of decoded results. Cached results are shared and must not be mutated by callers.
+    """
+    def __init__(self, url: str, max_concurrency: int = 8, timeout: float = 60.0, transport: Optional[httpx.AsyncBaseTransport] = None,
+                 cache: Optional[LruCache] = None):
+        self.url = url.rstrip('/')
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.transport = transport  # custom transports are used in tests
+        self.cache = cache
+        self.safety_margin = 600  # seconds, samples of recent windows might still arrive
+        self.recent_ttl = 30  # seconds, time-to-live of results whose window touches the present
+        self.decoded_size_factor = 4  # decoded JSON takes several times its wire size, measuring it would stall the event loop
+        self.max_retries = 3
+        self.retry_backoff = 0.1  # seconds, doubled after every retry
+        self._client: Optional[httpx.AsyncClient] = None  # created lazily, bound to the event loop of its first request
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """Returns the pooled HTTP client, creates it on first use."""
+        if self._client is None:
+            limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+            self._client = httpx.AsyncClient(base_url=self.url, limits=limits, timeout=self.timeout, transport=self.transport)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    @classmethod
+    def _get_cache_key(cls, endpoint: str, params: Dict) -> Hashable:
+        """Returns a cache key from the endpoint and parameters, leading and trailing whitespace of queries is ignored."""
+        normalized_params = []
+        for name, value in sorted(params.items()):
+            normalized_value = value.strip() if name == 'query' else str(value)
+            normalized_params.append((name, normalized_value))
+        return endpoint, tuple(normalized_params)
+
+    def _get_ttl(self, params: Dict) -> Optional[float]:
+        """Returns no time-to-live for windows that lie completely in the past (immutable results), a short one otherwise."""
+        window_end = params.get('time', params.get('end'))
+        try:
+            if window_end is not None and float(window_end) < time.time() - self.safety_margin:
+                return None
+        except (TypeError, ValueError):
+            pass
+        return self.recent_ttl
+
+    async def _send(self, endpoint: str, params: Dict) -> httpx.Response:
+        """Sends a GET request once and returns a response with status code 200."""
+        endpoint_label = get_tsdb_endpoint_label(endpoint)
+        client = self._get_client()
+        async with self._semaphore:
+            start = time.perf_counter()
+            try:
+                response = await client.get(endpoint, params=params)
+            except Exception:
+                tsdb_requests.labels(endpoint_label, 'error').inc()
+                raise
+            finally:
+                tsdb_latency.labels(endpoint_label).observe(time.perf_counter() - start)
+        tsdb_bytes.labels(endpoint_label).inc(len(response.content))
+        if response.status_code != 200:
+            tsdb_requests.labels(endpoint_label, 'error').inc()
+            raise TsdbClientException(f'HTTP Status Code {response.status_code} ({response.content!r})', response.status_code)
+        tsdb_requests.labels(endpoint_label, 'ok').inc()
+        return response
+
+    @classmethod
+    def _is_retrieable(cls, error: Exception) -> bool:
+        """Returns whether a request failed with a transport error or a server error."""
+        if isinstance(error, TsdbClientException):
+            return error.status_code is not None and error.status_code >= 500
+        return isinstance(error, httpx.TransportError)
+
+    async def _get(self, endpoint: str, params: Dict) -> Any:
+        """Sends a GET request and returns the `data` field of the response, consults the query cache first."""
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self._get_cache_key(endpoint, params)
+            cached_data = self.cache.get(cache_key)
+            if cached_data is not None:
+                tsdb_requests.labels(get_tsdb_endpoint_label(endpoint), 'cached').inc()
+                return cached_data
+        attempt = 0
+        while True:
+            try:
+                response = await self._send(endpoint, params)
+                break
+            except Exception as e:
+                if attempt >= self.max_retries or not self._is_retrieable(e):
+                    raise
+                logger.warning('Retrying TSDB request to %s after error: %s', endpoint, e)
+                await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+                attempt += 1
+        data = json_loads(response.content)['data']
+        if cache_key is not None:
+            self.cache.put(cache_key, data, len(response.content) * self.decoded_size_factor, self._get_ttl(params))
+        return data
+
+    async def custom_query(self, query: str, params: Optional[Dict] = None) -> List[Dict]:
+        """Runs an instant query, e.g. with a `time` parameter as evaluation timestamp."""
+        data = await self._get('/api/v1/query', {'query': query, **(params or {})})
+        return data['result']
+
+    async def custom_query_range(self, query: str, start_time: datetime, end_time: datetime, step: str, params: Optional[Dict] = None) -> List[Dict]:
+        """Runs a range query between the provided times."""
+        range_params = {'query': query, 'start': round(start_time.timestamp()), 'end': round(end_time.timestamp()), 'step': step}
+        data = await self._get('/api/v1/query_range', {**range_params, **(params or {})})
+        return data['result']
+
+    async def get_label_values(self, label: str, params: Optional[Dict] = None) -> List[str]:
+        """Returns all values of a label, e.g. restricted by `match[]`, `start`, and `end` parameters."""
+        return await self._get(f'/api/v1/label/{label}/values', params or {})
+
+    async def get_series(self, params: Dict) -> List[Dict[str, str]]:
+        """Returns the label sets of all series matching the `match[]` parameter."""
+        return await self._get('/api/v1/series', params)
+
+    async def close(self) -> None:
+        """Closes pooled connections."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class TsdbConnection:
+    """
+        Synchronous facade for :class:`AsyncTsdbClient` with the query methods of `PrometheusConnect`.
+        Coroutines run on a dedicated event loop thread, so several independent queries of one panel can be executed in parallel.
+    """
+    def __init__(self, url: str, max_concurrency: int = 8, cache: Optional[LruCache] = None):
+        self.url = url
+        self.async_client = AsyncTsdbClient(url, max_concurrency, cache=cache)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_lock = threading.Lock()
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        """Returns the event loop of the background thread, starts it on first use."""
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='tsdb-loop', daemon=True).start()
+            return self._loop
+
+    def run(self, coroutine: Coroutine) -> Any:
+        """Runs a coroutine on the background loop and blocks until its result is available."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._get_loop()).result()
+
+    def run_all(self, coroutines: Iterable[Coroutine]) -> List:
+        """Runs coroutines concurrently and returns their results in the supplied order."""
+        async def gather_all():
+            return await asyncio.gather(*coroutines)
+        return self.run(gather_all())
+
+    def custom_query(self, query: str, params: Optional[Dict] = None) -> List[Dict]:
+        return self.run(self.async_client.custom_query(query, params))
+
+    def custom_query_range(self, query: str, start_time: datetime, end_time: datetime, step: str, params: Optional[Dict] = None) -> List[Dict]:
+        return self.run(self.async_client.custom_query_range(query, start_time, end_time, step, params))
+
+    def get_label_values(self, label: str, params: Optional[Dict] = None) -> List[str]:
+        return self.run(self.async_client.get_label_values(label, params))
+
+    def get_series(self, params: Dict) -> List[Dict[str, str]]:
+        return self.run(self.async_client.get_series(params))
+
+    def close(self) -> None:
+        """Closes pooled connections and stops the background loop."""
+        if self._loop is not None:
+            self.run(self.async_client.close())
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop = None